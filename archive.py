@@ -0,0 +1,199 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+import database
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT PRIMARY KEY,
+    digest TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cached (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS cached_used_at ON cached (used_at);
+'''
+
+
+class OriginalArchive:
+    """
+    An archive of the original images that posts were made from, so that
+    they can be re-rendered later (see `backfill.py`).
+
+    Originals are stored on S3 under a content-addressed key, i.e. their
+    SHA-256 digest, in a separate prefix from the renditions, so the same
+    image is only ever stored once. A local disk cache of at most `max_bytes`
+    sits in front of S3, and evicts the least recently used originals when
+    it's full. The cache and the names of the images made from each original
+    are tracked in a SQLite database in the cache directory.
+
+    Parameters
+    ----------
+    s3: A boto3 S3 client.
+    bucket: The bucket to store originals in.
+    prefix: The prefix of the originals' keys.
+    cache_dir: The directory of the local cache.
+    max_bytes: The largest total size of the originals in the local cache.
+    """
+
+    def __init__(self, s3, bucket, prefix, cache_dir, max_bytes = 1024 ** 3):
+        self.s3 = s3
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok = True)
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        return database.connect(os.path.join(self.cache_dir, 'archive.db'))
+
+    def key(self, digest):
+        return '{0}/{1}'.format(self.prefix, digest)
+
+    def path(self, digest):
+        return os.path.join(self.cache_dir, digest)
+
+    def put(self, digest, source, name = None):
+        """
+        Archives an original, unless it's already archived, and remembers
+        that the image called `name` was made from it. Originals given as
+        paths are also kept in the local cache.
+
+        Parameters
+        ----------
+        digest: The SHA-256 digest of the original, as a hex string.
+        source: The path to the original or a file object containing it.
+        name: The name of the image's files (e.g. "12-1").
+        """
+
+        if name is not None:
+            with self.connect() as db:
+                db.execute(
+                    'INSERT OR REPLACE INTO names (name, digest) VALUES (?, ?)',
+                    ( name, digest ),
+                )
+
+        if os.path.exists(self.path(digest)):
+            self.touch(digest)
+            return
+
+        # Originals in file objects (i.e. in memory mode) are streamed
+        # straight to S3, so they never touch the disk.
+        if not isinstance(source, str):
+            if not self.exists(digest):
+                logging.info('Archiving original {0}'.format(digest))
+                source.seek(0)
+                self.s3.upload_fileobj(source, self.bucket, self.key(digest))
+                source.seek(0)
+            return
+
+        # Copy the original into the cache first, then upload it from there.
+        with tempfile.NamedTemporaryFile(dir = self.cache_dir, delete = False) as f:
+            with open(source, 'rb') as original:
+                shutil.copyfileobj(original, f)
+
+        if not self.exists(digest):
+            logging.info('Archiving original {0}'.format(digest))
+            self.s3.upload_file(f.name, self.bucket, self.key(digest))
+
+        self.add(digest, f.name)
+
+    def exists(self, digest):
+        try:
+            self.s3.head_object(Bucket = self.bucket, Key = self.key(digest))
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ( '404', 'NoSuchKey' ):
+                raise
+            return False
+        return True
+
+    def get(self, digest):
+        """
+        Returns the path to an original in the local cache, downloading it
+        from S3 first if it isn't cached.
+        """
+
+        path = self.path(digest)
+        if os.path.exists(path):
+            self.touch(digest)
+            return path
+
+        logging.info('Fetching original {0}'.format(digest))
+        with tempfile.NamedTemporaryFile(dir = self.cache_dir, delete = False) as f:
+            self.s3.download_fileobj(self.bucket, self.key(digest), f)
+        self.add(digest, f.name)
+        return path
+
+    def lookup(self, name):
+        """
+        Returns the digest of the original that the image called `name` was
+        made from, or `None` if it wasn't archived.
+        """
+
+        with self.connect() as db:
+            row = db.execute(
+                'SELECT digest FROM names WHERE name = ?', ( name, )
+            ).fetchone()
+        return row[0] if row else None
+
+    def touch(self, digest):
+        with self.connect() as db:
+            db.execute(
+                'UPDATE cached SET used_at = ? WHERE digest = ?',
+                ( time.time(), digest ),
+            )
+
+    def add(self, digest, temp_path):
+        """
+        Moves a downloaded or copied original into the cache, evicting the
+        least recently used originals if the cache is full.
+        """
+
+        size = os.path.getsize(temp_path)
+        with self.lock:
+            os.replace(temp_path, self.path(digest))
+            with self.connect() as db:
+                db.execute('BEGIN IMMEDIATE')
+                db.execute(
+                    'INSERT OR REPLACE INTO cached (digest, size, used_at) '
+                    'VALUES (?, ?, ?)',
+                    ( digest, size, time.time() ),
+                )
+
+                total, = db.execute(
+                    'SELECT COALESCE(SUM(size), 0) FROM cached'
+                ).fetchone()
+                evicted = []
+                rows = db.execute(
+                    'SELECT digest, size FROM cached WHERE digest != ? '
+                    'ORDER BY used_at',
+                    ( digest, ),
+                ).fetchall()
+                for old, old_size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    evicted.append(old)
+                    total -= old_size
+                db.executemany(
+                    'DELETE FROM cached WHERE digest = ?',
+                    [ ( old, ) for old in evicted ],
+                )
+                db.execute('COMMIT')
+
+            for old in evicted:
+                try:
+                    os.remove(self.path(old))
+                except FileNotFoundError:
+                    pass
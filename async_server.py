@@ -0,0 +1,191 @@
+"""
+An asyncio (ASGI) entry point for the server, serving the same `/upload` and
+`/metrics` contract as the Bottle app in `server.py`. Webhooks are handled
+concurrently on the event loop, rather than one at a time as with Bottle's
+default server, so a slow client or a burst of Mailgun retries never holds up
+other webhooks.
+
+The pipeline's libraries (requests, boto3, GitPython) are blocking, so jobs
+are awaited on a thread pool, which in turn hands downloads, uploads and
+encodes to the pipeline's own pools.
+
+Run it with any ASGI server, e.g.
+
+    python async_server.py
+    uvicorn async_server:app --port 8080
+"""
+
+import asyncio
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from email.policy import HTTP
+from urllib.parse import parse_qsl
+
+import server
+from jobs import run_next
+from metrics import metrics
+
+# The largest webhook body that is accepted. Mailgun only sends attachments'
+# URLs, so webhooks are small.
+MAX_BODY_BYTES = server.config.getint('max-body-bytes', 1024 * 1024)
+
+
+def parse_form(content_type, body):
+    """
+    Parses a form-encoded (`application/x-www-form-urlencoded` or
+    `multipart/form-data`) request body.
+
+    Returns
+    -------
+    A dictionary of the form's fields. Files are skipped.
+    """
+
+    if content_type.startswith('multipart/form-data'):
+        message = BytesParser(policy = HTTP).parsebytes(
+            b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n' + body
+        )
+        return {
+            part.get_param('name', header = 'content-disposition'):
+                part.get_payload(decode = True).decode(
+                    part.get_content_charset('utf-8')
+                )
+            for part in message.iter_parts()
+            if part.get_filename() is None
+        }
+
+    return dict(parse_qsl(body.decode('utf-8'), keep_blank_values = True))
+
+
+async def read_body(receive):
+    """
+    Reads a request's body, up to `MAX_BODY_BYTES`.
+
+    Returns
+    -------
+    The body, or `None` if it's too large.
+    """
+
+    body = bytearray()
+    while True:
+        message = await receive()
+        body.extend(message.get('body', b''))
+        if len(body) > MAX_BODY_BYTES:
+            return None
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+async def respond(send, status, body = b'', content_type = 'text/plain; charset=utf-8'):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            ( b'content-type', content_type.encode('latin-1') ),
+            ( b'content-length', str(len(body)).encode('latin-1') ),
+        ],
+    })
+    await send({ 'type': 'http.response.body', 'body': body })
+
+
+async def upload(scope, receive, send):
+    body = await read_body(receive)
+    if body is None:
+        return await respond(send, 413)
+
+    headers = dict(scope['headers'])
+    content_type = headers.get(b'content-type', b'').decode('latin-1')
+
+    # Queueing the job writes to SQLite, so it's done off the event loop.
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(
+            None,
+            server.queue_upload,
+            parse_form(content_type, body),
+        )
+    except server.UploadRejected:
+        return await respond(send, 406)
+    except Exception as e:
+        logging.exception(e)
+        return await respond(send, 500)
+
+    await respond(send, 200)
+
+
+async def work(queue, handler, executor, poll_interval = 1.0):
+    """
+    Like `jobs.work`, but awaits jobs on `executor` instead of blocking a
+    thread of its own while the queue is empty.
+    """
+
+    loop = asyncio.get_running_loop()
+    while True:
+        # Errors from the queue itself (e.g. the database staying locked)
+        # are logged and retried, so that they never end the task.
+        try:
+            ran = await loop.run_in_executor(executor, run_next, queue, handler)
+        except Exception as e:
+            logging.exception(e)
+            ran = False
+
+        if not ran:
+            await asyncio.sleep(poll_interval)
+
+
+async def lifespan(receive, send):
+    workers = []
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            if server.jobs is not None:
+                server.jobs.recover()
+                server.resume_publishing()
+                count = server.config.getint('workers', 1)
+                executor = ThreadPoolExecutor(count, thread_name_prefix = 'worker')
+                workers = [
+                    asyncio.ensure_future(work(
+                        server.jobs,
+                        server.process_upload,
+                        executor,
+                        server.config.getfloat('queue-poll-interval', 1.0),
+                    ))
+                    for _ in range(count)
+                ]
+            await send({ 'type': 'lifespan.startup.complete' })
+        elif message['type'] == 'lifespan.shutdown':
+            for worker in workers:
+                worker.cancel()
+            if server.publisher is not None:
+                server.publisher.close()
+            await send({ 'type': 'lifespan.shutdown.complete' })
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    route = ( scope['method'], scope['path'] )
+    if route == ( 'POST', '/upload' ):
+        await upload(scope, receive, send)
+    elif route == ( 'GET', '/metrics' ):
+        await respond(
+            send,
+            200,
+            metrics.render().encode('utf-8'),
+            'text/plain; version=0.0.4; charset=utf-8',
+        )
+    else:
+        await respond(send, 404)
+
+
+if __name__ == '__main__':
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit('The async server needs an ASGI server: pip install uvicorn')
+
+    logging.info('Starting async server')
+    uvicorn.run(app, host = 'localhost', port = 8080, log_config = None)
@@ -0,0 +1,445 @@
+"""
+Re-renders the images of every post, e.g. after the rendition sizes, formats
+or encoder options in config.ini have changed.
+
+The originals are read from the archive (see `archive.py`) or from a directory
+where each image's original is named after its files, e.g. "12.jpg" for
+12-640.jpg or "12-1.png" for 12-1-640.jpg. They're rendered on a pool of
+processes, the new renditions are uploaded as they're ready, and finally the
+posts' tags are rewritten and committed in a single commit.
+
+Progress is checkpointed, so an interrupted backfill picks up where it left
+off when it's run again with the same checkpoint file. Checkpoints made with
+other rendition settings are dropped when a backfill starts, so running it
+again after changing them re-renders everything.
+
+    python backfill.py
+    python backfill.py --originals /path/to/originals --processes 4 --no-commit
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from tempfile import TemporaryDirectory
+
+from PIL import Image
+
+import database
+import server
+from posts import parse_oid
+
+# Matches the names of the images in a post's tags, e.g. "12-1" in
+# "{{ site.assets_url }}/12-1-640.jpg".
+ASSET_PATTERN = re.compile(r'\{\{ site\.assets_url \}\}/([\w-]+?)-\d+\.(?:jpg|webp|avif)')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rendered (
+    name TEXT PRIMARY KEY,
+    widths TEXT NOT NULL,
+    formats TEXT NOT NULL,
+    profile TEXT NOT NULL
+);
+'''
+
+
+def backfill_profile(formats):
+    """
+    Identifies the settings that renditions are currently made with: the
+    `rendition_profile` (sizes), and the formats and their encoder options.
+
+    Returns
+    -------
+    A short hash of the settings.
+    """
+
+    options = [ [ fmt, server.FORMATS[fmt][2] ] for fmt in formats ]
+    profile = json.dumps([ server.rendition_profile(), options ], sort_keys = True)
+    return hashlib.sha256(profile.encode('utf-8')).hexdigest()[:16]
+
+
+class Checkpoints:
+    """
+    Records which images have been re-rendered and uploaded, and the widths
+    and formats of their new renditions, in a SQLite database. Each image is
+    recorded with the `backfill_profile` it was rendered with.
+
+    Parameters
+    ----------
+    path: The path to the SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self.connect() as db:
+            # Checkpoints from before profiles were recorded can't be told
+            # apart from current ones, so they're dropped.
+            columns = [ row[1] for row in db.execute('PRAGMA table_info(rendered)') ]
+            if columns and 'profile' not in columns:
+                db.execute('DROP TABLE rendered')
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        return database.connect(self.path)
+
+    def put(self, name, widths, formats, profile):
+        with self.connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO rendered (name, widths, formats, profile) '
+                'VALUES (?, ?, ?, ?)',
+                ( name, json.dumps(widths), json.dumps(formats), profile ),
+            )
+
+    def all(self, profile):
+        """
+        Returns a dictionary of the name of each image rendered with the
+        `profile` to a tuple of its widths and formats.
+        """
+
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT name, widths, formats FROM rendered WHERE profile = ?',
+                ( profile, ),
+            )
+            return {
+                name: ( json.loads(widths), json.loads(formats) )
+                for name, widths, formats in rows
+            }
+
+    def discard_stale(self, profile):
+        """
+        Removes the checkpoints of images rendered with any other profile.
+
+        Returns
+        -------
+        The number of checkpoints removed.
+        """
+
+        with self.connect() as db:
+            return db.execute(
+                'DELETE FROM rendered WHERE profile != ?',
+                ( profile, ),
+            ).rowcount
+
+
+def find_images(posts_dir):
+    """
+    Finds the images in every post.
+
+    Returns
+    -------
+    A dictionary of each post's file name to the names of its images, in the
+    order they appear.
+    """
+
+    images = {}
+    for file_name in sorted(os.listdir(posts_dir)):
+        with open(os.path.join(posts_dir, file_name)) as f:
+            names = []
+            for name in ASSET_PATTERN.findall(f.read()):
+                if name not in names:
+                    names.append(name)
+        if names:
+            images[file_name] = names
+    return images
+
+
+def find_originals(originals):
+    """
+    Returns a dictionary of the names of the images in the `originals`
+    directory to their paths.
+    """
+
+    return {
+        os.path.splitext(file_name)[0]: os.path.join(originals, file_name)
+        for file_name in os.listdir(originals)
+    }
+
+
+def init_worker():
+    # Each worker process encodes its own renditions, rather than handing
+    # them to yet another pool of processes.
+    server.ENCODE_PROCESSES = 1
+    logging.disable(logging.INFO)
+
+
+def render(name, source, scratch, formats):
+    """
+    Makes an image's renditions from its original (see
+    `server.make_renditions`). Runs in the worker processes.
+
+    Returns
+    -------
+    A tuple of the renditions' widths, their paths and the number of pixels
+    in the original.
+    """
+
+    img = Image.open(source)
+    pixels = img.size[0] * img.size[1]
+    metadata = server.get_img_data(img)
+    widths, paths = server.make_renditions(
+        img,
+        metadata,
+        name,
+        formats,
+        scratch,
+        in_memory = False,
+    )
+    return widths, paths, pixels
+
+
+def rewrite_post(contents, rendered):
+    """
+    Replaces the tags of the re-rendered images in a post, and its OpenGraph
+    image.
+
+    Parameters
+    ----------
+    contents: The contents of the post's file.
+    rendered: A dictionary of the re-rendered images' names to tuples of
+    their widths and formats.
+
+    Returns
+    -------
+    The new contents of the post's file.
+    """
+
+    lines = contents.split('\n')
+    for i, line in enumerate(lines):
+        if line.startswith('og_image: '):
+            name = line[len('og_image: '):].rsplit('-', 1)[0]
+            if name in rendered:
+                widths, _ = rendered[name]
+                lines[i] = 'og_image: %s' % server.rendition_name(name, max(widths))
+            continue
+
+        # Each image's tag is on its own line (see `server.create_post`).
+        match = ASSET_PATTERN.search(line)
+        if match is None or match.group(1) not in rendered:
+            continue
+        name = match.group(1)
+        widths, formats = rendered[name]
+        indent = line[:len(line) - len(line.lstrip())]
+        lines[i] = indent + server.create_img_tag(
+            name,
+            widths,
+            'alt="' in line,
+            formats,
+        )
+
+    return '\n'.join(lines)
+
+
+def backfill(
+    originals,
+    checkpoints,
+    posts_dir,
+    processes = None,
+    upload_threads = 4,
+    commit = True,
+):
+    """
+    Re-renders and uploads every post's images, rewrites the posts and
+    commits them.
+
+    Parameters
+    ----------
+    originals: A directory of originals (see `find_originals`) or an
+    `OriginalArchive`.
+    checkpoints: The `Checkpoints` to record progress in.
+    posts_dir: The path to the blog's `_posts` directory.
+    processes: The number of processes to render images on.
+    upload_threads: The number of images to fetch or upload at the same time.
+    commit: Whether to commit and push the rewritten posts.
+
+    Returns
+    -------
+    A dictionary describing the throughput of the backfill.
+    """
+
+    start = time.monotonic()
+    images = find_images(posts_dir)
+    formats = server.RENDITION_FORMATS
+
+    # Images rendered with other settings have to be rendered again.
+    profile = backfill_profile(formats)
+    stale = checkpoints.discard_stale(profile)
+    if stale:
+        logging.info('Discarded %d checkpoints made with other settings' % stale)
+    done = checkpoints.all(profile)
+
+    # Archived originals are looked up by their digest and fetched (into the
+    # archive's local cache) as they're needed. The digests of originals in a
+    # directory are worked out from their contents.
+    if isinstance(originals, str):
+        locate = find_originals(originals).get
+        fetch = lambda source: source
+        identify = server.hash_file
+    else:
+        locate = originals.lookup
+        fetch = originals.get
+        identify = lambda source: source
+
+    # Posts that reused another post's renditions (see `server.find_renditions`)
+    # share its image name, but each image is only rendered once.
+    todo = []
+    seen = set()
+    missing = 0
+    for names in images.values():
+        for name in names:
+            if name in done or name in seen:
+                continue
+            seen.add(name)
+            source = locate(name)
+            if source is None:
+                logging.warning('No original for image %s' % name)
+                missing += 1
+            else:
+                todo.append(( name, source ))
+
+    logging.info('Re-rendering %d images (%d already done, %d missing)' % (
+        len(todo), len(done), missing,
+    ))
+
+    skipped = len(done)
+    rendered = pixels = uploaded_bytes = failed = 0
+
+    def upload(name, source, widths, paths):
+        results = server.upload_files(*paths)
+        server.delete(*paths)
+        if not server.DRY:
+            checkpoints.put(name, widths, formats, profile)
+
+            # Later repeats of the image reuse the new renditions.
+            if server.rendition_cache is not None:
+                server.rendition_cache.put(
+                    identify(source),
+                    name,
+                    widths,
+                    formats,
+                    server.rendition_profile(),
+                )
+        return sum(r['bytes'] for r in results)
+
+    with TemporaryDirectory(dir = server.TEMP_PATH, prefix = 'backfill-') as scratch, \
+            ProcessPoolExecutor(processes, initializer = init_worker) as pool, \
+            ThreadPoolExecutor(upload_threads) as uploader:
+
+        # Images are fetched and rendered a few at a time, so that fetched
+        # originals are rendered before they can be evicted from the cache.
+        # Uploads carry on in the background.
+        uploads = {}
+        chunk_size = (processes or os.cpu_count()) * 2
+        for i in range(0, len(todo), chunk_size):
+            chunk = todo[i:i + chunk_size]
+            fetches = [ uploader.submit(fetch, source) for _, source in chunk ]
+
+            renders = {}
+            for ( name, source ), fetched in zip(chunk, fetches):
+                try:
+                    path = fetched.result()
+                except Exception as e:
+                    logging.error('Could not fetch image %s (%r)' % (name, e))
+                    failed += 1
+                    continue
+                future = pool.submit(render, name, path, scratch, formats)
+                renders[future] = ( name, source )
+
+            for future in as_completed(renders):
+                name, source = renders[future]
+                try:
+                    widths, paths, image_pixels = future.result()
+                except Exception as e:
+                    logging.error('Could not render image %s (%r)' % (name, e))
+                    failed += 1
+                    continue
+                pixels += image_pixels
+                uploads[uploader.submit(upload, name, source, widths, paths)] = name
+
+        for future in as_completed(uploads):
+            try:
+                uploaded_bytes += future.result()
+                rendered += 1
+            except Exception as e:
+                logging.error('Could not upload image %s (%r)' % (uploads[future], e))
+                failed += 1
+
+    # Rewrite every post with re-rendered images, including ones that were
+    # rendered by an earlier, interrupted run.
+    done = checkpoints.all(profile)
+    oids = []
+    for file_name, names in images.items():
+        if not any(name in done for name in names):
+            continue
+        path = os.path.join(posts_dir, file_name)
+        with open(path) as f:
+            contents = f.read()
+        new_contents = rewrite_post(contents, done)
+        if new_contents != contents:
+            with open(path, 'w') as f:
+                f.write(new_contents)
+            oids.append(parse_oid(file_name))
+
+    if commit and oids and server.publisher is not None:
+        with server.publisher.lock:
+            server.publisher.commit(
+                sorted(oids),
+                'Re-render images in {0} posts'.format(len(oids)),
+            )
+        server.publisher.close()
+
+    seconds = time.monotonic() - start
+    return {
+        'images': rendered,
+        'skipped': skipped,
+        'missing': missing,
+        'failed': failed,
+        'posts_rewritten': len(oids),
+        'seconds': seconds,
+        'images_per_second': rendered / seconds if seconds else None,
+        'megapixels_per_second': pixels / 1e6 / seconds if seconds else None,
+        'bytes_uploaded': uploaded_bytes,
+    }
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--originals',
+        help = 'directory of the original images, named after their files, '
+        'instead of the archive',
+    )
+    parser.add_argument(
+        '--checkpoint',
+        default = server.rel('backfill.db'),
+        help = 'file to record progress in, so the backfill can be resumed',
+    )
+    parser.add_argument('--processes', type = int, default = os.cpu_count())
+    parser.add_argument('--upload-threads', type = int, default = 4)
+    parser.add_argument(
+        '--no-commit',
+        action = 'store_true',
+        help = "rewrite the posts, but don't commit or push them",
+    )
+    args = parser.parse_args(argv)
+
+    if args.originals is None and server.archive is None:
+        parser.error('--originals is needed when originals are not archived')
+
+    report = backfill(
+        args.originals or server.archive,
+        Checkpoints(args.checkpoint),
+        server.rel('blog/_posts'),
+        processes = args.processes,
+        upload_threads = args.upload_threads,
+        commit = not args.no_commit,
+    )
+    print(json.dumps(report, indent = 2, sort_keys = True))
+
+
+if __name__ == '__main__':
+    main()
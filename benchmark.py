@@ -0,0 +1,365 @@
+"""
+Benchmarks for the image pipeline, using synthetic photos.
+
+Each benchmark runs in a fresh process so that its peak RSS can be measured,
+and the results are printed (or written to --output) as JSON so that runs
+can be compared.
+
+    python benchmark.py --output before.json
+    python benchmark.py --photos 12mp,24mp --repeat 5
+    python benchmark.py --existing-posts 1000,20000
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+os.environ.setdefault('MODE', 'test')
+
+from PIL import Image
+
+# Width, height and the EXIF orientations to generate for each corpus.
+PHOTOS = {
+    '2mp': ( 1600, 1200 ),
+    '12mp': ( 4032, 3024 ),
+    '24mp': ( 6000, 4000 ),
+}
+ORIENTATIONS = [ 1, 3, 6, 8 ]
+
+
+def make_photo(width, height, orientation):
+    """
+    Makes a synthetic JPEG photo with an EXIF orientation and capture date.
+    Noise is blended into a gradient so that the photo compresses roughly
+    like a real one.
+
+    Returns
+    -------
+    The JPEG's bytes.
+    """
+
+    gradient = Image.linear_gradient('L').resize(( width, height ))
+    noise = Image.effect_noise(( width, height ), 64)
+    img = Image.merge('RGB', [
+        Image.blend(gradient, noise, 0.5),
+        noise,
+        gradient.transpose(Image.FLIP_LEFT_RIGHT),
+    ])
+
+    exif = Image.Exif()
+    exif[274] = orientation
+    exif[306] = '2017:05:05 13:21:05'
+
+    f = BytesIO()
+    img.save(f, 'JPEG', quality = 92, exif = exif.tobytes())
+    return f.getvalue()
+
+
+def make_corpus(names):
+    """
+    Returns a list of (name, JPEG bytes) tuples, one per photo size and
+    orientation.
+    """
+
+    return [
+        ( '{0}-o{1}'.format(name, o), make_photo(*PHOTOS[name], o) )
+        for name in names
+        for o in ORIENTATIONS
+    ]
+
+
+class FakeS3:
+    """
+    A file-backed stand-in for the S3 client, implementing the methods that
+    the server uses.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def upload_file(self, path, bucket, key, **kwargs):
+        shutil.copyfile(path, os.path.join(self.root, key))
+
+    def upload_fileobj(self, f, bucket, key, **kwargs):
+        with open(os.path.join(self.root, key), 'wb') as out:
+            shutil.copyfileobj(f, out)
+
+    def head_object(self, Bucket, Key):
+        return { 'ContentLength': os.path.getsize(os.path.join(self.root, Key)) }
+
+
+def bench_resize(corpus, repeat):
+    """
+    Measures decoding, resizing and encoding a photo into all renditions.
+    """
+
+    import server
+
+    timings = []
+    pixels = 0
+    for _ in range(repeat):
+        for _, data in corpus:
+            start = time.perf_counter()
+            img = Image.open(BytesIO(data))
+            pixels += img.size[0] * img.size[1]
+            metadata = server.get_img_data(img)
+            server.draft_image(img, max(server.RENDITION_WIDTHS))
+            resized = server.resize_image(img, metadata)
+            server.save_images(resized, [ BytesIO() for _ in resized ])
+            timings.append(time.perf_counter() - start)
+
+    return summarize(timings, megapixels = pixels / 1e6)
+
+
+def bench_process_image(corpus, repeat, in_memory = False):
+    """
+    Measures the whole `process_image` flow, against a file-backed S3.
+    """
+
+    import server
+
+    scratch = tempfile.mkdtemp()
+    bucket = tempfile.mkdtemp()
+    server.S3 = FakeS3(bucket)
+    server.TEMP_PATH = scratch
+    server.IN_MEMORY = in_memory
+    server.DRY = None
+
+    timings = []
+    oid = 0
+    try:
+        for _ in range(repeat):
+            for _, data in corpus:
+                if in_memory:
+                    source = BytesIO(data)
+                else:
+                    source = os.path.join(scratch, 'original.jpg')
+                    with open(source, 'wb') as f:
+                        f.write(data)
+
+                start = time.perf_counter()
+                server.process_image({ 'oid': oid, 'summary': '' }, source)
+                timings.append(time.perf_counter() - start)
+                oid += 1
+    finally:
+        shutil.rmtree(scratch)
+        shutil.rmtree(bucket)
+
+    return summarize(timings)
+
+
+def bench_commit(posts, existing = 0, direct = False):
+    """
+    Measures committing posts one at a time to a blog that already has
+    `existing` posts, either by writing git objects directly (with a
+    `PostIndex`) or with `git add` and `git commit`. Pushes (to a local bare
+    repository) happen in the background, as they do in the server, so only
+    the commits are timed.
+    """
+
+    from git import Repo
+    from posts import PostIndex
+    from publish import SitePublisher
+
+    root = tempfile.mkdtemp()
+    try:
+        origin = Repo.init(os.path.join(root, 'origin.git'), bare = True)
+        blog = Repo.init(os.path.join(root, 'blog'))
+        blog.git.config('user.email', 'bench@localhost')
+        blog.git.config('user.name', 'Benchmark')
+        blog.git.checkout('-b', 'master')
+        blog.git.remote('add', 'origin', origin.working_dir)
+
+        posts_dir = os.path.join(blog.working_dir, '_posts')
+        os.makedirs(posts_dir)
+        for oid in range(existing):
+            path = os.path.join(posts_dir, '2017-01-01-{0}.md'.format(oid))
+            with open(path, 'w') as f:
+                f.write('Post {0}\n'.format(oid))
+        with open(os.path.join(blog.working_dir, '_config.yml'), 'w') as f:
+            f.write('title: Benchmark\n')
+        blog.git.add('.')
+        blog.git.commit('-m', 'Add {0} posts'.format(existing))
+
+        post_index = PostIndex(
+            os.path.join(root, 'posts.db'),
+            posts_dir,
+        ) if direct else None
+        publisher = SitePublisher(
+            blog.git,
+            window = 0,
+            post_index = post_index,
+            push_delay = 3600,
+        )
+
+        timings = []
+        for oid in range(existing, existing + posts):
+            file_name = '2017-01-02-{0}.md'.format(oid)
+            with open(os.path.join(posts_dir, file_name), 'w') as f:
+                f.write('Post {0}\n'.format(oid))
+            if post_index is not None:
+                post_index.add(oid, file_name)
+
+            start = time.perf_counter()
+            publisher.add(oid)
+            timings.append(time.perf_counter() - start)
+
+        publisher.close()
+    finally:
+        shutil.rmtree(root)
+
+    result = summarize(timings)
+    result['existing_posts'] = existing
+    return result
+
+
+def bench_verify(count, backend = 'memory'):
+    """
+    Measures verifying a burst of webhook requests, a tenth of which are
+    replays, with the in-memory or SQLite replay cache.
+    """
+
+    import hashlib
+    import hmac
+
+    import server
+    from replay import ReplayCache, SQLiteReplayCache
+
+    root = tempfile.mkdtemp()
+    if backend == 'sqlite':
+        server.replay_cache = SQLiteReplayCache(os.path.join(root, 'replay.db'))
+    else:
+        server.replay_cache = ReplayCache()
+
+    timestamp = str(int(time.time()))
+    requests = []
+    for i in range(count):
+        token = '{0:050x}'.format(i - i % 10 if i % 10 == 9 else i)
+        message = (timestamp + token).encode('utf-8')
+        signature = hmac.new(server.MAILGUN_KEY, message, hashlib.sha256)
+        requests.append(( timestamp, token, signature.hexdigest() ))
+
+    timings = []
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            try:
+                server.verify_mailgun_request(*request)
+            except ValueError:
+                pass
+            timings.append(time.perf_counter() - start)
+    finally:
+        shutil.rmtree(root)
+
+    return summarize(timings)
+
+
+def summarize(timings, **extra):
+    ordered = sorted(timings)
+    total = sum(ordered)
+    result = {
+        'count': len(ordered),
+        'total_seconds': total,
+        'per_second': len(ordered) / total if total else None,
+        'p50_seconds': ordered[len(ordered) // 2],
+        'p95_seconds': ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)],
+        'p99_seconds': ordered[min(int(len(ordered) * 0.99), len(ordered) - 1)],
+        'max_seconds': ordered[-1],
+    }
+    for k, v in extra.items():
+        result[k] = v
+        result[k + '_per_second'] = v / total if total else None
+    return result
+
+
+def run_isolated(connection, f, args):
+    logging.disable(logging.INFO)
+    result = f(*args)
+
+    # `ru_maxrss` is in kilobytes on Linux and bytes on macOS.
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != 'darwin':
+        maxrss *= 1024
+    result['peak_rss_bytes'] = maxrss
+
+    connection.send(result)
+    connection.close()
+
+
+def isolated(f, *args):
+    """
+    Runs a benchmark in a new process and returns its results along with the
+    process's peak RSS.
+    """
+
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex = False)
+    process = context.Process(target = run_isolated, args = ( sender, f, args ))
+    process.start()
+    result = receiver.recv()
+    process.join()
+    return result
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--photos',
+        default = '2mp,12mp',
+        help = 'comma-separated photo sizes: {0}'.format(', '.join(PHOTOS)),
+    )
+    parser.add_argument('--repeat', type = int, default = 2)
+    parser.add_argument('--posts', type = int, default = 20)
+    parser.add_argument(
+        '--existing-posts',
+        default = '1000',
+        help = 'comma-separated numbers of posts already in the blog when '
+        'committing',
+    )
+    parser.add_argument('--verifications', type = int, default = 10000)
+    parser.add_argument('--output', help = 'file to write the JSON results to')
+    args = parser.parse_args(argv)
+
+    corpus = make_corpus(args.photos.split(','))
+
+    results = {
+        'photos': [ name for name, _ in corpus ],
+        'cpu_count': os.cpu_count(),
+        'benchmarks': {
+            'resize_encode': isolated(bench_resize, corpus, args.repeat),
+            'process_image': isolated(bench_process_image, corpus, args.repeat),
+            'process_image_in_memory': isolated(
+                bench_process_image, corpus, args.repeat, True
+            ),
+            'verify': isolated(bench_verify, args.verifications),
+            'verify_sqlite': isolated(bench_verify, args.verifications, 'sqlite'),
+        },
+    }
+
+    # Committing is measured with each method, against each archive size.
+    for existing in map(int, args.existing_posts.split(',')):
+        results['benchmarks']['commit_{0}'.format(existing)] = isolated(
+            bench_commit, args.posts, existing,
+        )
+        results['benchmarks']['commit_direct_{0}'.format(existing)] = isolated(
+            bench_commit, args.posts, existing, True,
+        )
+
+    output = json.dumps(results, indent = 2, sort_keys = True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import sqlite3
+from contextlib import contextmanager
+
+
+def open_database(path):
+    """
+    Opens a SQLite database in autocommit mode (transactions are started
+    explicitly, with `BEGIN IMMEDIATE`) and with write-ahead logging, so that
+    readers don't block the writer. Every store (the job queue, post index,
+    rendition cache, original archive, backfill checkpoints and replay cache)
+    opens its database this way.
+
+    Parameters
+    ----------
+    path: The path to the SQLite database file.
+
+    Returns
+    -------
+    A `sqlite3.Connection`.
+    """
+
+    db = sqlite3.connect(path, timeout = 30, isolation_level = None)
+    db.execute('PRAGMA journal_mode = WAL')
+    return db
+
+
+@contextmanager
+def connect(path):
+    """
+    Opens a database (see `open_database`) for the duration of a `with`
+    block, and closes it afterwards.
+    """
+
+    db = open_database(path)
+    try:
+        yield db
+    finally:
+        db.close()
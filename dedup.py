@@ -0,0 +1,127 @@
+import json
+import time
+
+import database
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS renditions (
+    digest TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    widths TEXT NOT NULL,
+    formats TEXT NOT NULL DEFAULT '["JPEG"]',
+    profile TEXT NOT NULL DEFAULT '',
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS renditions_used_at ON renditions (used_at);
+'''
+
+
+class RenditionCache:
+    """
+    A cache of images that have already been resized and uploaded, keyed by
+    the SHA-256 digest of the original image's contents. This lets repeated
+    images (e.g. retried webhooks or re-sent emails) reuse the renditions
+    that are already on S3.
+
+    Each image also records the rendition profile (see
+    `server.rendition_profile`) it was resized with, so that images resized
+    with other widths aren't reused.
+
+    The cache holds at most `max_entries` images. When it's full, the least
+    recently used images are evicted.
+
+    Parameters
+    ----------
+    path: The path to the SQLite database file.
+    max_entries: The largest number of images to remember.
+    """
+
+    def __init__(self, path, max_entries = 10000):
+        self.path = path
+        self.max_entries = max_entries
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+            # Caches from before renditions had formats only have JPEGs.
+            columns = [ c[1] for c in db.execute('PRAGMA table_info(renditions)') ]
+            if 'formats' not in columns:
+                db.execute(
+                    'ALTER TABLE renditions ADD COLUMN formats TEXT NOT NULL '
+                    'DEFAULT \'["JPEG"]\''
+                )
+
+            # ...and caches from before profiles never match one.
+            if 'profile' not in columns:
+                db.execute(
+                    'ALTER TABLE renditions ADD COLUMN profile TEXT NOT NULL '
+                    'DEFAULT \'\''
+                )
+
+    def connect(self):
+        return database.connect(self.path)
+
+    def get(self, digest, profile = None):
+        """
+        Looks up an image by its digest.
+
+        Parameters
+        ----------
+        digest: The SHA-256 digest of the original image.
+        profile: If given, images resized with any other profile are treated
+        as not cached.
+
+        Returns
+        -------
+        A tuple of the name of the image's files, a list of their widths and a
+        list of their formats, or `None` if the image isn't cached.
+        """
+
+        with self.connect() as db:
+            row = db.execute(
+                'SELECT name, widths, formats, profile FROM renditions WHERE digest = ?',
+                ( digest, ),
+            ).fetchone()
+            if row is None or profile is not None and row[3] != profile:
+                return None
+            db.execute(
+                'UPDATE renditions SET used_at = ? WHERE digest = ?',
+                ( time.time(), digest ),
+            )
+        return row[0], json.loads(row[1]), json.loads(row[2])
+
+    def put(self, digest, name, widths, formats = ( 'JPEG', ), profile = ''):
+        """
+        Remembers the renditions of an image, evicting the least recently used
+        images if the cache is full.
+        """
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                'INSERT OR REPLACE INTO renditions '
+                '(digest, name, widths, formats, profile, used_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (
+                    digest,
+                    name,
+                    json.dumps(widths),
+                    json.dumps(list(formats)),
+                    profile,
+                    time.time(),
+                ),
+            )
+            db.execute(
+                'DELETE FROM renditions WHERE digest IN ('
+                'SELECT digest FROM renditions ORDER BY used_at DESC '
+                'LIMIT -1 OFFSET ?)',
+                ( self.max_entries, ),
+            )
+            db.execute('COMMIT')
+
+    def remove(self, digest):
+        """
+        Forgets an image, e.g. because its renditions are no longer on S3.
+        """
+
+        with self.connect() as db:
+            db.execute('DELETE FROM renditions WHERE digest = ?', ( digest, ))
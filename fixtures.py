@@ -0,0 +1,25 @@
+import shutil
+import tempfile
+
+temp_dirs = []
+
+
+def make_temp_dir():
+    """
+    Makes a temporary directory for a test, which is removed (with everything
+    in it, e.g. databases or git repositories) by `remove_temp_dirs`.
+    """
+
+    path = tempfile.mkdtemp(prefix = 'uploader-test-')
+    temp_dirs.append(path)
+    return path
+
+
+def remove_temp_dirs():
+    """
+    Removes every directory made by `make_temp_dir`. Each test module calls
+    this from its `teardown`.
+    """
+
+    while temp_dirs:
+        shutil.rmtree(temp_dirs.pop(), ignore_errors = True)
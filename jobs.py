@@ -0,0 +1,332 @@
+import json
+import logging
+import threading
+import time
+
+import database
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DEAD = 'dead'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_status_run_at ON jobs (status, run_at);
+CREATE TABLE IF NOT EXISTS stages (
+    message_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    state TEXT,
+    done_at REAL NOT NULL,
+    PRIMARY KEY (message_id, stage)
+);
+CREATE TABLE IF NOT EXISTS message_posts (
+    oid INTEGER PRIMARY KEY,
+    message_id TEXT NOT NULL
+);
+'''
+
+
+class JobQueue:
+    """
+    A durable queue of jobs stored in a local SQLite database.
+
+    Jobs are claimed by workers, and are either completed (and removed) or
+    failed. Failed jobs are retried with exponential backoff until they run
+    out of attempts, at which point they are moved to the dead-letter area
+    (status 'dead') so that they can be inspected later.
+
+    Parameters
+    ----------
+    path: The path to the SQLite database file.
+    max_attempts: How many times a job is tried before it's marked dead.
+    backoff: The number of seconds to wait before the first retry. Each
+    subsequent retry waits twice as long as the one before it.
+    checkpoint_ttl: The number of seconds to remember the stages of an email
+    for (see `checkpoint`).
+    """
+
+    def __init__(
+        self,
+        path,
+        max_attempts = 5,
+        backoff = 30.0,
+        checkpoint_ttl = 30 * 24 * 3600.0,
+    ):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.checkpoint_ttl = checkpoint_ttl
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+
+    def connect(self):
+        return database.connect(self.path)
+
+    def put(self, payload):
+        """
+        Adds a job to the queue and returns its ID. `payload` must be
+        serializable as JSON.
+        """
+
+        now = time.time()
+        with self.connect() as db:
+            cursor = db.execute(
+                'INSERT INTO jobs (payload, status, run_at, created_at) '
+                'VALUES (?, ?, ?, ?)',
+                ( json.dumps(payload), QUEUED, now, now ),
+            )
+            return cursor.lastrowid
+
+    def claim(self):
+        """
+        Claims the oldest job that is ready to run.
+
+        Returns
+        -------
+        A tuple of the job's ID and its payload, or `None` if no job is ready.
+        """
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            row = db.execute(
+                'SELECT id, payload FROM jobs '
+                'WHERE status = ? AND run_at <= ? ORDER BY run_at, id LIMIT 1',
+                ( QUEUED, time.time() ),
+            ).fetchone()
+            if row is None:
+                db.execute('COMMIT')
+                return None
+            db.execute(
+                'UPDATE jobs SET status = ?, attempts = attempts + 1 '
+                'WHERE id = ?',
+                ( RUNNING, row[0] ),
+            )
+            db.execute('COMMIT')
+        return row[0], json.loads(row[1])
+
+    def complete(self, job_id):
+        """
+        Removes a successfully processed job from the queue.
+        """
+
+        with self.connect() as db:
+            db.execute('DELETE FROM jobs WHERE id = ?', ( job_id, ))
+
+    def fail(self, job_id, error):
+        """
+        Records a failed attempt at a job. The job is either scheduled to be
+        retried or, if it is out of attempts, moved to the dead-letter area.
+        """
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            attempts, = db.execute(
+                'SELECT attempts FROM jobs WHERE id = ?', ( job_id, )
+            ).fetchone()
+            if attempts >= self.max_attempts:
+                logging.error('Job {0} failed {1} times, giving up'.format(
+                    job_id, attempts
+                ))
+                status, run_at = DEAD, time.time()
+            else:
+                delay = self.backoff * 2 ** (attempts - 1)
+                logging.warning('Job {0} failed, retrying in {1}s'.format(
+                    job_id, delay
+                ))
+                status, run_at = QUEUED, time.time() + delay
+            db.execute(
+                'UPDATE jobs SET status = ?, run_at = ?, error = ? '
+                'WHERE id = ?',
+                ( status, run_at, error, job_id ),
+            )
+            db.execute('COMMIT')
+
+    def recover(self):
+        """
+        Requeues jobs that were left running, e.g. because the process was
+        killed while working on them, and forgets old checkpoints. Should only
+        be called before any workers are started.
+        """
+
+        with self.connect() as db:
+            db.execute(
+                'UPDATE jobs SET status = ? WHERE status = ?',
+                ( QUEUED, RUNNING ),
+            )
+
+            old = (
+                'SELECT message_id FROM stages '
+                'GROUP BY message_id HAVING MAX(done_at) < ?'
+            )
+            expired = time.time() - self.checkpoint_ttl
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                'DELETE FROM message_posts WHERE message_id IN (' + old + ')',
+                ( expired, ),
+            )
+            db.execute(
+                'DELETE FROM stages WHERE message_id IN (' + old + ')',
+                ( expired, ),
+            )
+            db.execute('COMMIT')
+
+    def checkpoint(self, message_id, stage, state = None, oids = ()):
+        """
+        Records that a stage of processing an email is done, so that a retry
+        of the email can pick up where it left off.
+
+        Parameters
+        ----------
+        message_id: The email's Message-Id.
+        stage: The name of the stage.
+        state: Anything about the stage that a retry needs, which must be
+        serializable as JSON.
+        oids: The OIDs of the email's posts, so that later stages can be
+        recorded by OID (see `checkpoint_posts`).
+        """
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                'INSERT OR REPLACE INTO stages (message_id, stage, state, done_at) '
+                'VALUES (?, ?, ?, ?)',
+                ( message_id, stage, json.dumps(state), time.time() ),
+            )
+            db.executemany(
+                'INSERT OR REPLACE INTO message_posts (oid, message_id) '
+                'VALUES (?, ?)',
+                [ ( oid, message_id ) for oid in oids ],
+            )
+            db.execute('COMMIT')
+
+    def checkpoint_posts(self, oids, stage):
+        """
+        Records that a stage is done for the emails that the posts with the
+        given OIDs were made from.
+        """
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.executemany(
+                'INSERT OR IGNORE INTO stages (message_id, stage, state, done_at) '
+                'SELECT message_id, ?, ?, ? FROM message_posts WHERE oid = ?',
+                [ ( stage, 'null', time.time(), oid ) for oid in oids ],
+            )
+            db.execute('COMMIT')
+
+    def stages(self, message_id):
+        """
+        Returns a dictionary of the names of the stages of an email that are
+        done to their states.
+        """
+
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT stage, state FROM stages WHERE message_id = ?',
+                ( message_id, ),
+            ).fetchall()
+        return { stage: json.loads(state) for stage, state in rows }
+
+    def unfinished(self, stage, until):
+        """
+        Returns the OIDs of the posts of the emails whose `stage` is done, but
+        whose `until` stage isn't, e.g. posts that were written but never
+        committed.
+        """
+
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT oid FROM message_posts WHERE message_id IN ('
+                'SELECT message_id FROM stages WHERE stage = ? EXCEPT '
+                'SELECT message_id FROM stages WHERE stage = ?) ORDER BY oid',
+                ( stage, until ),
+            ).fetchall()
+        return [ oid for oid, in rows ]
+
+    def dead_jobs(self):
+        """
+        Returns a list of (ID, payload, error) tuples for jobs in the
+        dead-letter area.
+        """
+
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT id, payload, error FROM jobs WHERE status = ? '
+                'ORDER BY id',
+                ( DEAD, ),
+            ).fetchall()
+        return [ (i, json.loads(p), e) for i, p, e in rows ]
+
+
+def run_next(queue, handler):
+    """
+    Claims the next job from a queue and passes its payload to `handler`. The
+    job is completed if the handler returns, or failed (to be retried, or
+    marked dead) if it raises. Errors from the queue itself are raised.
+
+    Returns
+    -------
+    `True` if a job was run, or `False` if the queue was empty.
+    """
+
+    job = queue.claim()
+    if job is None:
+        return False
+
+    job_id, payload = job
+    logging.info('Starting job {0}'.format(job_id))
+    try:
+        handler(payload)
+    except Exception as e:
+        logging.exception(e)
+        queue.fail(job_id, repr(e))
+    else:
+        queue.complete(job_id)
+        logging.info('Finished job {0}'.format(job_id))
+    return True
+
+
+def work(queue, handler, stop, poll_interval = 1.0):
+    """
+    Repeatedly runs jobs from a queue (see `run_next`) until `stop` is set.
+    """
+
+    while not stop.is_set():
+        # Errors from the queue itself (e.g. the database staying locked)
+        # are logged and retried, so that they never stop the worker.
+        try:
+            ran = run_next(queue, handler)
+        except Exception as e:
+            logging.exception(e)
+            ran = False
+
+        if not ran:
+            stop.wait(poll_interval)
+
+
+def start_workers(queue, handler, count, poll_interval = 1.0):
+    """
+    Starts `count` daemon threads that work on jobs from `queue`.
+
+    Returns
+    -------
+    A `threading.Event` that stops the workers when set.
+    """
+
+    stop = threading.Event()
+    for i in range(count):
+        threading.Thread(
+            target = work,
+            args = ( queue, handler, stop, poll_interval ),
+            name = 'worker-{0}'.format(i),
+            daemon = True,
+        ).start()
+    return stop
@@ -0,0 +1,148 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+
+QUANTILES = [ 0.5, 0.95, 0.99 ]
+
+
+class Histogram:
+    """
+    Tracks the durations of, and number of bytes processed by, one stage of
+    the pipeline. Quantiles are computed from the most recent `size`
+    observations, so memory use is bounded.
+    """
+
+    def __init__(self, size = 1024):
+        self.recent = deque(maxlen = size)
+        self.count = 0
+        self.sum = 0.0
+        self.bytes = 0
+
+    def observe(self, seconds, nbytes = 0):
+        self.recent.append(seconds)
+        self.count += 1
+        self.sum += seconds
+        self.bytes += nbytes
+
+    def quantile(self, q):
+        if not self.recent:
+            return float('nan')
+        ordered = sorted(self.recent)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class Span:
+    """
+    A timed stage, as yielded by `Metrics.timer`. The number of bytes that
+    the stage processed can be recorded by setting `bytes`.
+    """
+
+    def __init__(self):
+        self.bytes = 0
+
+
+class Metrics:
+    """
+    A registry of per-stage histograms, which can be rendered in the
+    Prometheus text format.
+    """
+
+    def __init__(self, prefix = 'uploader'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, stage, seconds, nbytes = 0, **labels):
+        """
+        Records that `stage` took `seconds` and processed `nbytes` bytes.
+        Keyword arguments are added as labels, e.g. `width = 320`.
+        """
+
+        key = ( stage, tuple(sorted(labels.items())) )
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds, nbytes)
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """
+        Times the body of a `with` block as `stage`. Durations are only
+        recorded if the block doesn't raise.
+        """
+
+        span = Span()
+        start = time.monotonic()
+        yield span
+        self.observe(stage, time.monotonic() - start, span.bytes, **labels)
+
+    def timed(self, stage):
+        """
+        A decorator that times every call of a function as `stage`.
+        """
+
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                with self.timer(stage):
+                    return f(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def render(self):
+        """
+        Renders all histograms in the Prometheus text exposition format.
+        """
+
+        seconds = '{0}_stage_seconds'.format(self.prefix)
+        nbytes = '{0}_stage_bytes_total'.format(self.prefix)
+
+        with self.lock:
+            items = sorted(self.histograms.items())
+            lines = [
+                '# HELP {0} Time spent in each pipeline stage.'.format(seconds),
+                '# TYPE {0} summary'.format(seconds),
+            ]
+            for (stage, labels), histogram in items:
+                label_str = format_labels(( ( 'stage', stage ), ) + labels)
+                for q in QUANTILES:
+                    lines.append('{0}{1} {2}'.format(
+                        seconds,
+                        format_labels(
+                            ( ( 'stage', stage ), ) + labels + ( ( 'quantile', q ), )
+                        ),
+                        histogram.quantile(q),
+                    ))
+                lines.append('{0}_sum{1} {2}'.format(
+                    seconds, label_str, histogram.sum
+                ))
+                lines.append('{0}_count{1} {2}'.format(
+                    seconds, label_str, histogram.count
+                ))
+
+            lines.extend([
+                '# HELP {0} Bytes processed by each pipeline stage.'.format(nbytes),
+                '# TYPE {0} counter'.format(nbytes),
+            ])
+            for (stage, labels), histogram in items:
+                lines.append('{0}{1} {2}'.format(
+                    nbytes,
+                    format_labels(( ( 'stage', stage ), ) + labels),
+                    histogram.bytes,
+                ))
+
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    return '{' + ','.join(
+        '{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for k, v in labels
+    ) + '}'
+
+
+# The registry used by the server.
+metrics = Metrics()
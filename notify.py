@@ -1,10 +1,18 @@
 #!/home/aaron/uploader/.venv/bin/python
 
+import html
 import json
-from os import environ, listdir, path
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from os import environ, path
 from configparser import ConfigParser
+from string import Formatter
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from posts import PostIndex
 
 DRY = environ.get('DRY')
 
@@ -15,74 +23,279 @@ config = ConfigParser()
 config.read(path.join(UPLOADER_DIR, 'config.ini'))
 config = config[mode]
 
-def compute_new_post_count():
+# Updates are sent with Mailgun's batch sending, one API call per group of up
+# to `BATCH_SIZE` recipients with the same templates, or, in "concurrent"
+# mode, one call per recipient, `NOTIFY_THREADS` at a time.
+NOTIFY_MODE = config.get('notify-mode', 'batch')
+NOTIFY_THREADS = config.getint('notify-threads', 8)
+BATCH_SIZE = 1000
 
-    all_posts = listdir(path.join(UPLOADER_DIR, 'blog/_posts'))
-    all_posts = [ int(p.split('.')[0].split('-')[-1]) for p in all_posts ]
-    all_posts = sorted(all_posts)
-    latest = all_posts[-1]
+session = requests.Session()
+session.auth = ('api', config.get('mailgun-key'))
+session.mount('https://', HTTPAdapter(pool_maxsize = NOTIFY_THREADS))
 
-    with open(path.join(UPLOADER_DIR, 'latest.txt'), 'r+') as f:
-        old_latest = int(f.read().strip())
+def read_latest():
+    """
+    Returns the number of the last post that was announced according to
+    latest.txt, which the notifier kept its place in before the journal, or
+    `None` if there's no latest.txt.
+    """
 
-        if not DRY:
-            # Update 'latest.txt' with the new latest.
-            f.seek(0)
-            f.write(str(latest) + '\n')
-            f.truncate()
+    try:
+        with open(path.join(UPLOADER_DIR, 'latest.txt')) as f:
+            return int(f.read().strip())
+    except FileNotFoundError:
+        return None
 
-    return latest - old_latest
+def get_new_posts(post_index):
+    """
+    Reads the posts that have been added since the last update from the post
+    index's journal. The first time, the posts after the one in latest.txt
+    are new.
 
-def send_update(recipient, new_count):
+    Returns
+    -------
+    A tuple of a list of the new posts' journal entries (one per post) and the
+    journal offset to checkpoint once the update has been sent.
+    """
 
-    if new_count == 1:
-        has, post, it = ('has', 'post', 'it')
-    else:
-        has, post, it = ('have', 'posts', 'them')
+    checkpoint = post_index.get_checkpoint('notify', after_oid = read_latest())
+    entries = post_index.journal(after = checkpoint)
 
-    address = recipient['address']
-    text_content = recipient['text'].format(
-        n = new_count,
-        has = has,
-        post = post,
-        it = it,
+    # A post that was written more than once (e.g. by a retried job) is only
+    # included once, with its latest entry.
+    posts = { e['oid']: e for e in entries }
+    new_posts = sorted(posts.values(), key = lambda e: e['oid'])
+
+    return new_posts, entries[-1]['offset'] if entries else checkpoint
+
+def post_url(oid):
+    return 'http://{0}/{1}'.format(config['domain'], oid)
+
+def image_url(key):
+    assets_url = config.get(
+        'assets-url',
+        'https://{0}.s3.amazonaws.com'.format(config['aws-bucket']),
     )
-    html_content = recipient['html'].format(
-        n = new_count,
-        has = has,
-        post = post,
-        it = it,
+    return '{0}/{1}'.format(assets_url, key)
+
+# The values that templates can use.
+TEMPLATE_FIELDS = [ 'n', 'has', 'post', 'it', 'summaries', 'thumbnails' ]
+
+PLURALS = {
+    True: { 'has': 'has', 'post': 'post', 'it': 'it' },
+    False: { 'has': 'have', 'post': 'posts', 'it': 'them' },
+}
+
+class Template:
+    """
+    An email template from emails.json, in `str.format` syntax, parsed once
+    when it's loaded. Templates that use fields other than `TEMPLATE_FIELDS`
+    are rejected then, rather than when the first update is sent.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.parts = []
+        for literal, field, spec, conversion in Formatter().parse(source):
+            if field is not None and field not in TEMPLATE_FIELDS:
+                raise ValueError('Unknown template field {%s}' % field)
+            self.parts.append(( literal, field, spec, conversion ))
+
+    def render(self, values):
+        out = []
+        for literal, field, spec, conversion in self.parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion in ( 's', 'a' ):
+                value = str(value) if conversion == 's' else ascii(value)
+            out.append(format(value, spec or ''))
+        return ''.join(out)
+
+@lru_cache(maxsize = None)
+def compile_template(source):
+    """
+    Returns the `Template` for a template's source. Recipients with identical
+    templates share the same `Template`.
+    """
+
+    return Template(source)
+
+def load_recipients(recipients):
+    """
+    Compiles the recipients' templates (from emails.json), returning copies of
+    the recipients with `Template`s in place of their `text` and `html`.
+    """
+
+    return [
+        dict(
+            r,
+            text = compile_template(r['text']),
+            html = compile_template(r['html']),
+        )
+        for r in recipients
+    ]
+
+def template_values(new_posts):
+    """
+    Computes the values of the `TEMPLATE_FIELDS` for the new posts: `n`,
+    `has`, `post` and `it` describe the number of new posts, and `summaries`
+    (for text) and `thumbnails` (for HTML) list them.
+    """
+
+    values = dict(PLURALS[len(new_posts) == 1], n = len(new_posts))
+
+    values['summaries'] = '\n'.join(
+        '{0} {1}'.format(p['summary'] or 'Post #%d' % p['oid'], post_url(p['oid']))
+        for p in new_posts
     )
+    values['thumbnails'] = '\n'.join(
+        '<a href="{0}"><img src="{1}" alt="{2}" width="320" /></a>'.format(
+            post_url(p['oid']),
+            image_url(p['og_image']),
+            html.escape(p['summary'] or 'Post #%d' % p['oid']),
+        )
+        for p in new_posts if p['og_image']
+    )
+
+    return values
+
+def render(template, new_posts):
+    """
+    Fills in an email template (a `Template` or its source) for the new
+    posts.
+    """
 
-    data = {
-        'to': address,
+    if not isinstance(template, Template):
+        template = compile_template(template)
+    return template.render(template_values(new_posts))
+
+def make_message(text, html_content):
+    """
+    Makes the parts of an update that are the same for every recipient with
+    the same templates.
+    """
+
+    return {
         'from': config['mailgun-from'],
         'subject': 'New photos on {}'.format(config['domain']),
-        'text': text_content,
+        'text': text,
         'html': html_content,
         'bcc': config['mailgun-bcc'],
         'h:Reply-To': config['mailgun-reply-to'],
     }
 
+def post_message(data):
+    if not DRY:
+        response = session.post(config['mailgun-notifications-url'], data = data)
+        response.raise_for_status()
+
+def send_update(recipient, message):
+
+    address = recipient['address']
+    data = dict(message, to = address)
+
     print('Sending update to %s' % address)
+    post_message(data)
 
-    if not DRY:
-        response = requests.post(
-            config['mailgun-notifications-url'],
-            auth = ('api', config['mailgun-key']),
-            data = data,
+def send_batch(recipients, message):
+    """
+    Sends an update to a batch of recipients that share the same templates,
+    in one Mailgun API call. The recipient variables make Mailgun send each
+    recipient their own message (rather than one message to everyone), and
+    the templates can use them, e.g. `%recipient.name%`.
+    """
+
+    addresses = [ r['address'] for r in recipients ]
+    data = dict(message, to = addresses)
+    data['recipient-variables'] = json.dumps({
+        r['address']: {
+            k: v for k, v in r.items() if k not in ( 'text', 'html' )
+        }
+        for r in recipients
+    })
+
+    print('Sending update to %s' % ', '.join(addresses))
+    post_message(data)
+
+def send_updates(recipients, new_posts, mode = None):
+    """
+    Sends an update to every recipient, without stopping at the first
+    failure. Recipients are grouped by their templates, and each group's
+    message is rendered once and shared by all of its recipients.
+
+    Returns
+    -------
+    A dictionary of each recipient's address to the exception that sending to
+    them raised, or `None` if it succeeded.
+    """
+
+    mode = mode or NOTIFY_MODE
+
+    groups = {}
+    for r in load_recipients(recipients):
+        groups.setdefault(( r['text'], r['html'] ), []).append(r)
+
+    if mode == 'concurrent':
+        size = 1
+        send = lambda batch, message: send_update(batch[0], message)
+    else:
+        size = BATCH_SIZE
+        send = send_batch
+
+    values = template_values(new_posts)
+    batches = []
+    for ( text, html_template ), group in groups.items():
+        message = make_message(text.render(values), html_template.render(values))
+        batches.extend(
+            ( group[i:i + size], message ) for i in range(0, len(group), size)
         )
-        response.raise_for_status()
+
+    def try_send(batch):
+        try:
+            send(*batch)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(NOTIFY_THREADS) as pool:
+        errors = list(pool.map(try_send, batches))
+
+    return {
+        r['address']: error
+        for ( batch, _ ), error in zip(batches, errors)
+        for r in batch
+    }
 
 if __name__ == '__main__':
 
-    new_post_count = compute_new_post_count()
+    post_index = PostIndex(
+        config.get('post-index', path.join(UPLOADER_DIR, 'posts.db')),
+        path.join(UPLOADER_DIR, 'blog/_posts'),
+    )
+    new_posts, offset = get_new_posts(post_index)
 
-    if new_post_count > 0:
+    if new_posts:
         with open(path.join(UPLOADER_DIR, 'emails.json')) as f:
             emails = json.load(f)
 
-        for recipient in emails['recipients']:
-            send_update(recipient, new_post_count)
+        results = send_updates(emails['recipients'], new_posts)
+
+        # Recipients that failed aren't retried, because the others would get
+        # the update again.
+        if not DRY:
+            post_index.set_checkpoint('notify', offset)
+
+        failed = { a: e for a, e in results.items() if e is not None }
+
+        for address, error in failed.items():
+            print('Failed to send update to %s (%s)' % (address, error))
+
+        if failed:
+            print('Sent %d of %d updates' % (len(results) - len(failed), len(results)))
+            sys.exit(1)
 
         print('Updates sent successfully')
@@ -0,0 +1,220 @@
+import logging
+from configparser import ConfigParser
+from os import environ, listdir, path
+
+import database
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS posts (
+    oid INTEGER PRIMARY KEY,
+    file TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS journal (
+    offset_ INTEGER PRIMARY KEY AUTOINCREMENT,
+    oid INTEGER NOT NULL,
+    date TEXT,
+    summary TEXT NOT NULL,
+    og_image TEXT
+);
+'''
+
+
+def parse_oid(file_name):
+    """
+    Gets the OID of a post from its file name, e.g. 2017-01-16-3.md -> 3.
+    """
+
+    return int(file_name.split('.')[0].split('-')[-1])
+
+
+class PostIndex:
+    """
+    A persistent index of the blog's posts, stored in a SQLite database, so
+    that the server and the notifier don't need to scan the `_posts`
+    directory.
+
+    OIDs are handed out from a counter, inside a transaction, so concurrent
+    requests (even in different processes) never get the same OID. The index
+    is built from `_posts` when it's first created and can be rebuilt at any
+    time with `rebuild`.
+
+    Every post that's added is also appended to a journal, which readers
+    (like the notifier) consume from a checkpointed offset, so they only see
+    the posts that are new to them.
+
+    Parameters
+    ----------
+    db_path: The path to the SQLite database file.
+    posts_dir: The path to the blog's `_posts` directory.
+    """
+
+    def __init__(self, db_path, posts_dir):
+        self.db_path = db_path
+        self.posts_dir = posts_dir
+        with self.connect() as db:
+            db.executescript(SCHEMA)
+            initialized = db.execute(
+                "SELECT 1 FROM counters WHERE name = 'next_oid'"
+            ).fetchone()
+        if not initialized:
+            self.rebuild()
+
+    def connect(self):
+        return database.connect(self.db_path)
+
+    def rebuild(self):
+        """
+        Rebuilds the index from the files in `_posts`. The OID counter never
+        goes backwards, so OIDs that were handed out but haven't been written
+        yet are not reused.
+        """
+
+        posts = [ (parse_oid(p), p) for p in listdir(self.posts_dir) ]
+        logging.info('Rebuilding post index ({0} posts)'.format(len(posts)))
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('DELETE FROM posts')
+            db.executemany('INSERT INTO posts (oid, file) VALUES (?, ?)', posts)
+            db.execute(
+                "INSERT OR IGNORE INTO counters (name, value) "
+                "VALUES ('next_oid', 0)"
+            )
+            db.execute(
+                "UPDATE counters SET value = MAX(value, ?) "
+                "WHERE name = 'next_oid'",
+                ( max([ oid for oid, _ in posts ], default = -1) + 1, ),
+            )
+            db.execute('COMMIT')
+
+    def allocate(self, count = 1):
+        """
+        Reserves `count` consecutive OIDs and returns the first one.
+        """
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            oid, = db.execute(
+                "SELECT value FROM counters WHERE name = 'next_oid'"
+            ).fetchone()
+            db.execute(
+                "UPDATE counters SET value = ? WHERE name = 'next_oid'",
+                ( oid + count, ),
+            )
+            db.execute('COMMIT')
+        return oid
+
+    def peek(self):
+        """
+        Returns the OID that `allocate` would reserve next, without reserving
+        it.
+        """
+
+        with self.connect() as db:
+            oid, = db.execute(
+                "SELECT value FROM counters WHERE name = 'next_oid'"
+            ).fetchone()
+        return oid
+
+    def add(self, oid, file_name, date = None, summary = '', og_image = None):
+        """
+        Records that the post with the given OID has been written, and
+        appends it to the journal.
+        """
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                'INSERT OR REPLACE INTO posts (oid, file) VALUES (?, ?)',
+                ( oid, file_name ),
+            )
+            db.execute(
+                'INSERT INTO journal (oid, date, summary, og_image) '
+                'VALUES (?, ?, ?, ?)',
+                ( oid, date, summary or '', og_image ),
+            )
+            db.execute('COMMIT')
+
+    def journal(self, after = 0):
+        """
+        Returns the journal entries after the offset `after`, oldest first, as
+        dictionaries with `offset`, `oid`, `date`, `summary` and `og_image`
+        keys.
+        """
+
+        with self.connect() as db:
+            rows = db.execute(
+                'SELECT offset_, oid, date, summary, og_image FROM journal '
+                'WHERE offset_ > ? ORDER BY offset_',
+                ( after, ),
+            ).fetchall()
+        keys = [ 'offset', 'oid', 'date', 'summary', 'og_image' ]
+        return [ dict(zip(keys, row)) for row in rows ]
+
+    def get_checkpoint(self, name, after_oid = None):
+        """
+        Returns the journal offset that the reader `name` has consumed up to.
+        A new reader starts at the end of the journal or, with `after_oid`,
+        just before the first post with a greater OID, e.g. to pick up where
+        a reader that kept track of OIDs left off.
+        """
+
+        with self.connect() as db:
+            db.execute('BEGIN IMMEDIATE')
+            db.execute(
+                'INSERT OR IGNORE INTO counters (name, value) '
+                'SELECT ?, COALESCE('
+                '(SELECT MIN(offset_) - 1 FROM journal WHERE oid > ?), '
+                'MAX(offset_), 0) FROM journal',
+                ( 'checkpoint:' + name, after_oid ),
+            )
+            offset, = db.execute(
+                'SELECT value FROM counters WHERE name = ?',
+                ( 'checkpoint:' + name, ),
+            ).fetchone()
+            db.execute('COMMIT')
+        return offset
+
+    def set_checkpoint(self, name, offset):
+        """
+        Records that the reader `name` has consumed the journal up to `offset`.
+        """
+
+        with self.connect() as db:
+            db.execute(
+                'INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)',
+                ( 'checkpoint:' + name, offset ),
+            )
+
+    def file(self, oid):
+        """
+        Returns the file name of the post with the given OID, or `None` if
+        there is no such post.
+        """
+
+        with self.connect() as db:
+            row = db.execute(
+                'SELECT file FROM posts WHERE oid = ?', ( oid, )
+            ).fetchone()
+        return row[0] if row else None
+
+
+if __name__ == '__main__':
+
+    # Rebuild the index, e.g. after posts were added or removed by hand.
+    UPLOADER_DIR = path.dirname(path.realpath(__file__))
+
+    config = ConfigParser()
+    config.read(path.join(UPLOADER_DIR, 'config.ini'))
+    config = config[environ.get('MODE', 'prod')]
+
+    PostIndex(
+        config.get('post-index', path.join(UPLOADER_DIR, 'posts.db')),
+        path.join(UPLOADER_DIR, 'blog/_posts'),
+    ).rebuild()
+
+    print('Post index rebuilt successfully')
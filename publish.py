@@ -0,0 +1,547 @@
+import logging
+import os
+import threading
+import time
+from io import BytesIO
+
+from git import Actor, GitCommandError, Repo
+from gitdb import IStream, LooseObjectDB
+from gitdb.util import bin_to_hex
+
+from metrics import metrics
+
+TREE_MODE = b'40000'
+
+
+def ssh_command(control_path, persist = 600):
+    """
+    Returns a `GIT_SSH_COMMAND` that keeps the SSH connection to GitHub open
+    for `persist` seconds after it's last used, and shares it between git
+    commands, so pulls and pushes don't each pay for a new connection and
+    handshake.
+
+    Parameters
+    ----------
+    control_path: The path of the connection's control socket (see
+    `ControlPath` in ssh_config(5)).
+    persist: The number of seconds to keep the connection open for.
+    """
+
+    return (
+        'ssh -o ControlMaster=auto -o ControlPath={0} -o ControlPersist={1}'
+    ).format(control_path, persist)
+
+
+def pull_rebase(git):
+    """
+    Pulls the blog's branch from GitHub, rebasing any local commits that
+    haven't been pushed yet onto it. If the rebase fails, it's aborted, so
+    that the repository is left as it was and the next attempt starts over.
+    """
+
+    try:
+        git.pull('--rebase', 'origin', 'master')
+    except GitCommandError:
+        try:
+            git.rebase('--abort')
+        except GitCommandError:
+            pass
+        raise
+
+
+class Pusher:
+    """
+    Pushes the blog's branch to GitHub in the background, so that a slow or
+    failed push never holds up (or fails) a job.
+
+    Pushes are debounced: each call to `schedule` pushes `delay` seconds
+    later, unless it's called again in the meantime, and then only the
+    latest commit is pushed. If the push is rejected because GitHub has
+    commits the blog doesn't, the branch is rebased onto them and pushed
+    again. Other failures are retried after `retry` seconds, doubling up to
+    `max_retry` seconds, until a push succeeds.
+
+    `lock` is only held to read the commit to push and to rebase, so jobs
+    can carry on committing while a push is in progress.
+
+    Parameters
+    ----------
+    git: A GitPython `Git` object for the blog's repository.
+    lock: The lock that all git operations on the repository hold.
+    delay: The number of seconds to wait for more commits before pushing.
+    retry: The number of seconds to wait before retrying a failed push.
+    max_retry: The longest time to wait before retrying.
+    dry: If truthy, only log what would be done.
+    on_push: A function that's called with the OIDs of the posts in each
+    successful push.
+    """
+
+    def __init__(
+        self,
+        git,
+        lock,
+        delay = 2.0,
+        retry = 30.0,
+        max_retry = 600.0,
+        dry = False,
+        on_push = None,
+    ):
+        self.git = git
+        self.lock = lock
+        self.delay = delay
+        self.retry = retry
+        self.max_retry = max_retry
+        self.dry = dry
+        self.on_push = on_push
+        self.timer = None
+        self.failures = 0
+
+        # The OIDs of the posts that are committed, but not pushed yet.
+        self.unpushed = []
+
+        # Only one push happens at a time.
+        self.push_lock = threading.Lock()
+
+    def schedule(self, delay = None, oids = ()):
+        """
+        Pushes after `delay` seconds (by default, `self.delay`), replacing
+        any push that was already scheduled.
+
+        Parameters
+        ----------
+        delay: The number of seconds to wait before pushing.
+        oids: The OIDs of the posts that were committed since the last
+        push.
+        """
+
+        with self.lock:
+            self.unpushed.extend(oid for oid in oids if oid not in self.unpushed)
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(
+                self.delay if delay is None else delay,
+                self.push,
+            )
+            self.timer.daemon = True
+            self.timer.start()
+
+    def push(self):
+        """
+        Pushes the branch now. If that fails, another push is scheduled.
+
+        Returns
+        -------
+        `True` if the branch was pushed.
+        """
+
+        with self.push_lock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+
+                logging.info('Pushing blog')
+                if self.dry:
+                    return True
+                head, oids = self.head()
+
+            try:
+                with metrics.timer('push'):
+                    try:
+                        self.push_commit(head)
+                    except GitCommandError as e:
+                        if 'rejected' not in str(e.stderr):
+                            raise
+                        logging.info('Push was rejected, rebasing')
+                        with self.lock:
+                            pull_rebase(self.git)
+                            head, oids = self.head()
+                        self.push_commit(head)
+            except Exception as e:
+                with self.lock:
+                    self.failures += 1
+                    delay = min(self.retry * 2 ** (self.failures - 1), self.max_retry)
+                    logging.warning(
+                        'Could not push blog ({0!r}), retrying in {1} seconds'.format(e, delay)
+                    )
+                    self.schedule(delay)
+                return False
+
+            with self.lock:
+                self.failures = 0
+                self.unpushed = [ oid for oid in self.unpushed if oid not in oids ]
+            if self.on_push is not None:
+                self.on_push(oids)
+            return True
+
+    def head(self):
+        """
+        Returns the SHA-1 of the commit to push and the OIDs of the posts
+        that pushing it publishes. Must be called while holding `lock`.
+        """
+
+        return self.git.rev_parse('HEAD'), list(self.unpushed)
+
+    def push_commit(self, sha):
+        """
+        Pushes a commit to the remote branch, even if HEAD has moved since.
+        """
+
+        self.git.push('origin', '{0}:refs/heads/master'.format(sha))
+
+    def flush(self):
+        """
+        Pushes right away if a push is scheduled, e.g. before exiting.
+        """
+
+        # `push` takes `push_lock` before `lock`, so it's called without
+        # holding `lock`.
+        with self.lock:
+            scheduled = self.timer is not None
+        if scheduled:
+            self.push()
+
+
+class SitePublisher:
+    """
+    Commits new posts to the blog's repository and pushes them to GitHub.
+
+    Posts are collected into batches: a batch is committed and pushed once
+    `window` seconds have passed since its first post was added, or as soon
+    as it has `max_posts` posts, whichever comes first. This way a burst of
+    emails results in a single commit, a single push and a single rebuild of
+    the site. With `push_delay`, commits are pushed in the background by a
+    `Pusher` instead.
+
+    Parameters
+    ----------
+    git: A GitPython `Git` object for the blog's repository.
+    window: The number of seconds to wait for more posts before committing.
+    If this is 0, every post is committed and pushed right away.
+    max_posts: The largest number of posts to put in a single commit.
+    dry: If truthy, only log what would be done.
+    post_index: The `PostIndex` to find the posts' files in. With an index,
+    posts are committed without scanning `_posts` (see `write_commit`).
+    push_delay: If given, commits are pushed in the background, this many
+    seconds after the last one.
+    push_retry: The number of seconds to wait before retrying a failed push
+    in the background.
+    commit_retry: The least number of seconds to wait before retrying a
+    failed commit (otherwise, the posts are retried after `window` seconds).
+    on_commit: A function that's called with the OIDs of the posts in each
+    commit.
+    on_push: A function that's called with the OIDs of the posts in each
+    successful push.
+    """
+
+    def __init__(
+        self,
+        git,
+        window = 10.0,
+        max_posts = 10,
+        dry = False,
+        post_index = None,
+        push_delay = None,
+        push_retry = 30.0,
+        commit_retry = 10.0,
+        on_commit = None,
+        on_push = None,
+    ):
+        self.git = git
+        self.window = window
+        self.max_posts = max_posts
+        self.dry = dry
+        self.post_index = post_index
+        self.commit_retry = commit_retry
+        self.on_commit = on_commit
+        self.on_push = on_push
+        self.repo = None
+        self.objects = None
+        self.trees = {}
+
+        # All git operations on the repository happen while holding `lock`.
+        self.lock = threading.RLock()
+        self.pending = []
+        self.timer = None
+        self.pusher = Pusher(
+            git,
+            self.lock,
+            delay = push_delay,
+            retry = push_retry,
+            dry = dry,
+            on_push = on_push,
+        ) if push_delay is not None else None
+
+    def sync(self):
+        """
+        Ensures the local copy of the blog is up to date with GitHub. The pull
+        is skipped if the local HEAD already has the remote's commit, i.e. it
+        is the same or ahead (e.g. when a push failed).
+
+        Returns
+        -------
+        `True` if anything was pulled.
+        """
+
+        with self.lock:
+            if self.dry:
+                logging.info('Pulling blog')
+                return False
+
+            remote = self.git.ls_remote('origin', 'refs/heads/master').split()
+            head = self.git.rev_parse('HEAD')
+            if remote and self.is_ancestor(remote[0], head):
+                logging.debug('Blog is up to date, skipping pull')
+                return False
+
+            # Commits that are waiting to be pushed are rebased onto GitHub's.
+            pull_rebase(self.git)
+            return self.git.rev_parse('HEAD') != head
+
+    def is_ancestor(self, commit, head):
+        if commit == head:
+            return True
+
+        # Fails if `commit` isn't an ancestor, or isn't known locally at all.
+        try:
+            self.git.merge_base('--is-ancestor', commit, head)
+        except GitCommandError:
+            return False
+        return True
+
+    def add(self, *oids):
+        """
+        Adds posts, which must already be written to `_posts`, to the next
+        batch. Posts added together are always committed together.
+        """
+
+        with self.lock:
+            # Posts can be added again, e.g. by a retried job.
+            self.pending.extend(oid for oid in oids if oid not in self.pending)
+            if self.window <= 0 or len(self.pending) >= self.max_posts:
+                self.flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.window, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """
+        Commits and pushes all pending posts. If that fails, the posts are
+        kept so that they're included in the next batch, which is flushed
+        after `window` (or at least `commit_retry`) seconds.
+        """
+
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+            oids, self.pending = self.pending, []
+            if not oids:
+                return
+
+            try:
+                self.commit(oids)
+            except Exception as e:
+                logging.exception(e)
+                self.pending = oids + self.pending
+
+                # Even without a window, the posts are retried in the
+                # background, because their jobs have already finished.
+                self.timer = threading.Timer(
+                    max(self.window, self.commit_retry),
+                    self.flush,
+                )
+                self.timer.daemon = True
+                self.timer.start()
+
+    def close(self):
+        """
+        Commits all pending posts and pushes them, e.g. before exiting.
+        """
+
+        self.flush()
+        if self.pusher is not None:
+            self.pusher.flush()
+
+    def commit(self, oids, message = None):
+        """
+        Commits the posts with the given OIDs in a single commit and pushes
+        it (or schedules a push, with a `Pusher`). The commit message defaults
+        to one saying the posts were added.
+        """
+
+        if message is None and len(oids) == 1:
+            message = 'Add post {0}'.format(oids[0])
+        elif message is None:
+            message = 'Add posts {0}'.format(', '.join(map(str, oids)))
+
+        logging.info('Uploading blog post(s) {0}'.format(
+            ', '.join(map(str, oids))
+        ))
+
+        if self.dry:
+            return
+
+        files = [ self.post_index.file(oid) for oid in oids ] \
+            if self.post_index is not None else [ None ]
+
+        with metrics.timer('commit'):
+            if None not in files:
+                self.write_commit(
+                    [ os.path.join('_posts', f) for f in files ],
+                    message,
+                )
+
+            # Anything left in `_posts` by a failed commit is simply picked
+            # up by this one.
+            elif self.git.status('--porcelain', '_posts'):
+                self.git.add('_posts')
+                self.git.commit('-m', message)
+        if self.on_commit is not None:
+            self.on_commit(oids)
+
+        if self.pusher is not None:
+            self.pusher.schedule(oids = oids)
+        else:
+            with metrics.timer('push'):
+                self.git.push('origin', 'master')
+            if self.on_push is not None:
+                self.on_push(oids)
+
+    def write_commit(self, paths, message):
+        """
+        Commits the given files by writing their blobs, trees and the commit
+        straight into the repository, rather than with `git add` and `git
+        commit`, which both scan `_posts`. Only the given files and the trees
+        above them are read (objects are read through a single long-running
+        `git cat-file`), the branch is moved with `git update-ref` and the
+        index is brought up to date with `git update-index`, so the cost of a
+        commit barely grows with the number of posts.
+
+        Parameters
+        ----------
+        paths: The paths of the files to commit, relative to the repository.
+
+        Returns
+        -------
+        `True` if a commit was made, or `False` if nothing had changed.
+        """
+
+        if self.repo is None:
+            self.repo = Repo(self.git.working_dir)
+            # GitPython's own object database starts `git hash-object` for
+            # every object it writes, so objects are written as loose
+            # objects instead.
+            self.objects = LooseObjectDB(
+                os.path.join(self.repo.git_dir, 'objects')
+            )
+
+        blobs = {}
+        for path in paths:
+            with open(os.path.join(self.repo.working_tree_dir, path), 'rb') as f:
+                blobs[path] = self.store('blob', f.read())
+
+        # The entries of the trees that were written by the last commit are
+        # kept, so that `_posts` doesn't have to be read back every time.
+        parent = self.repo.head.commit
+        written = {}
+        tree = self.write_tree(parent.tree.binsha, [
+            ( path.split('/'), binsha ) for path, binsha in blobs.items()
+        ], written)
+        self.trees = written
+        if tree == parent.tree.binsha:
+            return False
+
+        config = self.repo.config_reader()
+        now = int(time.time())
+        date = '{0} {1}'.format(now, time.strftime('%z', time.localtime(now)))
+        author = Actor.author(config)
+        committer = Actor.committer(config)
+        commit = self.store('commit', '\n'.join([
+            'tree {0}'.format(bin_to_hex(tree).decode('ascii')),
+            'parent {0}'.format(parent.hexsha),
+            'author {0} <{1}> {2}'.format(author.name, author.email, date),
+            'committer {0} <{1}> {2}'.format(committer.name, committer.email, date),
+            '',
+            message,
+            '',
+        ]).encode('utf-8'))
+
+        # `lock` only keeps out this process, so the branch is only moved if
+        # it's still at `parent`, e.g. not if `backfill.py` committed in the
+        # meantime. Otherwise this raises, and the posts stay pending.
+        self.git.update_ref(
+            '-m', 'commit: ' + message,
+            'HEAD',
+            bin_to_hex(commit).decode('ascii'),
+            parent.hexsha,
+        )
+
+        args = []
+        for path, binsha in blobs.items():
+            args.extend([ '--cacheinfo', '100644,{0},{1}'.format(
+                bin_to_hex(binsha).decode('ascii'),
+                path,
+            ) ])
+        self.git.update_index('--add', *args)
+        return True
+
+    def store(self, kind, data):
+        """
+        Writes an object to the repository and returns its binary SHA-1.
+        """
+
+        return self.objects.store(IStream(kind, len(data), BytesIO(data))).binsha
+
+    def write_tree(self, binsha, changes, written):
+        """
+        Writes a copy of a tree with some of its files replaced or added,
+        along with any trees under it that contain them.
+
+        Parameters
+        ----------
+        binsha: The binary SHA-1 of the tree, or `None` for a new tree.
+        changes: A list of tuples of each file's path, split into its parts,
+        and the binary SHA-1 of its new blob.
+        written: A dictionary that the entries of the new trees are added to,
+        by their SHA-1s.
+
+        Returns
+        -------
+        The binary SHA-1 of the new tree.
+        """
+
+        entries = dict(self.trees.get(binsha, {}))
+        if binsha is not None and binsha not in self.trees:
+            raw = self.repo.odb.stream(binsha).read()
+            i = 0
+            while i < len(raw):
+                space = raw.index(b' ', i)
+                nul = raw.index(b'\0', space)
+                entries[raw[space + 1:nul]] = ( raw[i:space], raw[nul + 1:nul + 21] )
+                i = nul + 21
+
+        subtrees = {}
+        for parts, blob in changes:
+            name = parts[0].encode('utf-8')
+            if len(parts) == 1:
+                entries[name] = ( b'100644', blob )
+            else:
+                subtrees.setdefault(name, []).append(( parts[1:], blob ))
+
+        for name, subchanges in subtrees.items():
+            _, old = entries.get(name, ( TREE_MODE, None ))
+            entries[name] = ( TREE_MODE, self.write_tree(old, subchanges, written) )
+
+        # Git sorts trees by name, as if the names of subtrees ended in "/".
+        new = self.store('tree', b''.join(
+            mode + b' ' + name + b'\0' + sha
+            for name, ( mode, sha ) in sorted(
+                entries.items(),
+                key = lambda e: e[0] + b'/' if e[1][0] == TREE_MODE else e[0],
+            )
+        ))
+        written[new] = entries
+        return new
@@ -0,0 +1,127 @@
+import threading
+import time
+from collections import OrderedDict
+
+import database
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tokens (
+    token TEXT PRIMARY KEY,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tokens_expires_at ON tokens (expires_at);
+'''
+
+
+class ReplayCache:
+    """
+    Remembers the Mailgun webhook tokens that have been seen in the last
+    `ttl` seconds, so that replayed requests can be rejected. Requests older
+    than the TTL are rejected by their timestamp anyway, so tokens are
+    forgotten once they expire.
+
+    Tokens are kept in an `OrderedDict` in the order they were added, which
+    is also the order they expire in, so lookups are O(1) and expired tokens
+    are evicted from the front. At most `max_entries` tokens are kept, even
+    under a burst of requests. The cache is thread-safe, but it isn't shared
+    between processes (see `SQLiteReplayCache`).
+
+    Parameters
+    ----------
+    ttl: The number of seconds to remember a token for.
+    max_entries: The largest number of tokens to remember.
+    """
+
+    def __init__(self, ttl = 60.0, max_entries = 100000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.tokens = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, token):
+        """
+        Records that a token has been seen.
+
+        Returns
+        -------
+        `False` if the token had already been seen (i.e. the request is a
+        replay), otherwise `True`.
+        """
+
+        now = time.monotonic()
+        with self.lock:
+            while self.tokens:
+                oldest, expires_at = next(iter(self.tokens.items()))
+                if expires_at > now:
+                    break
+                del self.tokens[oldest]
+
+            if token in self.tokens:
+                return False
+
+            self.tokens[token] = now + self.ttl
+            if len(self.tokens) > self.max_entries:
+                self.tokens.popitem(last = False)
+            return True
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+class SQLiteReplayCache:
+    """
+    A `ReplayCache` stored in a SQLite database, so that several processes
+    (e.g. more than one server) reject the same replays. Expired tokens are
+    deleted as new ones are added.
+
+    Each thread keeps its own connection open, because verifying a request
+    has to stay fast even during a burst of webhooks.
+
+    Parameters
+    ----------
+    path: The path to the SQLite database file.
+    ttl: The number of seconds to remember a token for.
+    """
+
+    def __init__(self, path, ttl = 60.0):
+        self.path = path
+        self.ttl = ttl
+        self.local = threading.local()
+        self.connect().executescript(SCHEMA)
+
+    def connect(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = database.open_database(self.path)
+            db.execute('PRAGMA synchronous = NORMAL')
+            self.local.db = db
+        return db
+
+    def add(self, token):
+        """
+        Records that a token has been seen.
+
+        Returns
+        -------
+        `False` if the token had already been seen (i.e. the request is a
+        replay), otherwise `True`.
+        """
+
+        now = time.time()
+        db = self.connect()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM tokens WHERE expires_at <= ?', ( now, ))
+            added = db.execute(
+                'INSERT OR IGNORE INTO tokens (token, expires_at) VALUES (?, ?)',
+                ( token, now + self.ttl ),
+            ).rowcount
+        finally:
+            db.execute('COMMIT')
+        return added == 1
+
+    def __len__(self):
+        return self.connect().execute(
+            'SELECT COUNT(*) FROM tokens WHERE expires_at > ?',
+            ( time.time(), ),
+        ).fetchone()[0]
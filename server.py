@@ -1,34 +1,47 @@
+import atexit
 import datetime
 import hashlib
 import hmac
 import html
 import json
 import logging
+import math
+import multiprocessing
 import re
+import threading
 import time
-from contextlib import contextmanager
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from configparser import ConfigParser
-from os import listdir, remove, environ, getcwd, chdir
-from os.path import join, basename, dirname, realpath
+from io import BytesIO
+from os import remove, environ, cpu_count
+from os.path import join, basename, dirname, getsize, realpath
+from tempfile import SpooledTemporaryFile, TemporaryDirectory
 
 import requests
 import boto3
-from bottle import abort, post, request, run
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotoConfig
+from botocore.exceptions import ClientError
+from bottle import HTTPResponse, abort, get, post, request, run
 from git import Repo
-from PIL import Image
-from PIL.ExifTags import TAGS as EXIF_TAGS
+from requests.adapters import HTTPAdapter
+from PIL import Image, features
 from requests.exceptions import RequestException
 
+from archive import OriginalArchive
+from dedup import RenditionCache
+from jobs import JobQueue, start_workers
+from metrics import metrics
+from posts import PostIndex
+from publish import SitePublisher, ssh_command
+from replay import ReplayCache, SQLiteReplayCache
+from streaming import StreamBuffer
+
 uploader_dirpath = dirname(realpath(__file__))
 rel = lambda f: join(uploader_dirpath, f)
 
-@contextmanager
-def pushd(where):
-    start_dir = getcwd()
-    chdir(where)
-    yield
-    chdir(start_dir)
-
 mode = environ.get('MODE', 'prod')
 config = ConfigParser()
 config.read(rel('config.ini'))
@@ -41,103 +54,459 @@ logging.basicConfig(
     level = logging.DEBUG if DRY else logging.INFO,
 )
 
-S3 = boto3.client('s3')
+MB = 1024 * 1024
+
+UPLOAD_THREADS = config.getint('upload-threads', 8)
+UPLOAD_ATTEMPTS = config.getint('upload-attempts', 3)
+
+# Every upload thread can have a multipart transfer in flight, each using up
+# to `max_concurrency` connections, so the connection pool has to be big
+# enough for all of them to share it.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold = config.getint('multipart-threshold', 8 * MB),
+    multipart_chunksize = config.getint('multipart-chunksize', 8 * MB),
+    max_concurrency = 4,
+)
+S3 = boto3.client('s3', config = BotoConfig(
+    max_pool_connections = UPLOAD_THREADS * TRANSFER_CONFIG.max_concurrency,
+))
+upload_pool = ThreadPoolExecutor(UPLOAD_THREADS)
+
+DOWNLOAD_THREADS = config.getint('download-threads', 4)
+DOWNLOAD_CHUNK_SIZE = config.getint('download-chunk-size', MB)
+MAX_ATTACHMENT_BYTES = config.getint('max-attachment-bytes', 64 * MB)
+
+# With incremental decoding, images are decoded while they're still being
+# downloaded, at the cost of holding a second copy of the download in memory.
+INCREMENTAL_DECODE = config.getboolean('incremental-decode', False)
+
+download_pool = ThreadPoolExecutor(DOWNLOAD_THREADS)
+decode_pool = ThreadPoolExecutor(DOWNLOAD_THREADS)
 git = Repo(rel('blog')).git if mode != 'test' else None
 
+# Git commands share one SSH connection to GitHub, which is kept open for
+# `ssh-control-persist` seconds after it's last used.
+if git is not None and config.getint('ssh-control-persist', 600) > 0 \
+        and 'GIT_SSH_COMMAND' not in environ:
+    git.update_environment(GIT_SSH_COMMAND = ssh_command(
+        config.get('ssh-control-path', '~/.ssh/uploader-%C'),
+        config.getint('ssh-control-persist', 600),
+    ))
+
+post_index = PostIndex(
+    config.get('post-index', rel('posts.db')),
+    rel('blog/_posts'),
+) if mode != 'test' else None
+
+rendition_cache = RenditionCache(
+    config.get('dedup-cache', rel('renditions.db')),
+    max_entries = config.getint('dedup-cache-size', 10000),
+) if mode != 'test' else None
+
+# Mailgun tokens are remembered for as long as their requests' timestamps
+# are accepted. With `replay-db`, they're remembered in a SQLite database, so
+# that every server process rejects the same replays.
+REPLAY_WINDOW = 60
+replay_cache = SQLiteReplayCache(
+    config['replay-db'],
+    ttl = REPLAY_WINDOW,
+) if config.get('replay-db') and mode != 'test' else ReplayCache(
+    ttl = REPLAY_WINDOW,
+)
+
+# Originals are archived on S3, with a local cache in front, so that posts
+# can be re-rendered later (see `backfill.py`).
+archive = OriginalArchive(
+    S3,
+    config.get('archive-bucket', config['aws-bucket']),
+    config.get('archive-prefix', 'originals'),
+    config.get('archive-cache', rel('originals')),
+    max_bytes = config.getint('archive-cache-bytes', 1024 ** 3),
+) if mode != 'test' and config.getboolean('archive-originals', True) else None
+
+# If "head", cached renditions are checked to still exist on S3 before
+# they're reused.
+DEDUP_VERIFY = config.get('dedup-verify', 'none')
+
+publisher = SitePublisher(
+    git,
+    window = config.getfloat('commit-window', 10.0),
+    max_posts = config.getint('commit-max-posts', 10),
+    dry = DRY,
+    post_index = post_index if config.getboolean('fast-commit', True) else None,
+    push_delay = config.getfloat('push-delay', 2.0),
+    push_retry = config.getfloat('push-retry', 30.0),
+    commit_retry = config.getfloat('commit-retry', 10.0),
+    on_commit = lambda oids: jobs.checkpoint_posts(oids, 'committed'),
+    on_push = lambda oids: jobs.checkpoint_posts(oids, 'pushed'),
+) if mode != 'test' else None
+
+jobs = JobQueue(
+    config.get('queue-path', rel('jobs.db')),
+    max_attempts = config.getint('job-attempts', 5),
+    backoff = config.getfloat('job-backoff', 30.0),
+    checkpoint_ttl = config.getfloat('checkpoint-ttl', 30 * 24 * 3600.0),
+) if mode != 'test' else None
+
+# The transposition that puts an image upright, for each EXIF orientation.
 ORIENTATIONS = [
     None,
     None,
     None,
-    -180,
+    Image.ROTATE_180,
     None,
     None,
-    -90,
+    Image.ROTATE_270,
     None,
-    -270,
+    Image.ROTATE_90,
 ]
 
+# The only EXIF tags that are used, by their numbers. Both are in the image's
+# first IFD, so the rest of the EXIF data never needs to be parsed.
+EXIF_FIELDS = { 274: 'Orientation', 306: 'DateTime' }
+
+# Each job gets its own scratch directory in `TEMP_PATH`, so that jobs
+# running at the same time never write to the same files.
 TEMP_PATH = '/tmp'
 
+# In memory mode, attachments and renditions are kept in memory instead of
+# being written to `TEMP_PATH`. Attachments larger than the spill threshold
+# are still spilled to (anonymous) temporary files.
+IN_MEMORY = config.getboolean('in-memory', False)
+SPILL_THRESHOLD = config.getint('spill-threshold', 32 * 1024 * 1024)
+
+# Whether an email with several photos becomes a single gallery post or one
+# post per photo ("posts").
+MULTI_PHOTO = config.get('multi-photo', 'posts')
+
+# The rendition profile: the sizes (of the larger dimension) that photos are
+# resized to, whether photos smaller than a size are scaled up to it, and the
+# encoder options for each format. Lower qualities and slower, more thorough
+# encoder settings trade encode time for fewer bytes served.
+RENDITION_WIDTHS = sorted(
+    float(w) for w in config.get('rendition-widths', '320, 640, 960, 1280').split(',')
+)
+UPSCALE = config.getboolean('upscale', False)
+
+
+def get_encoder_options(fmt, **defaults):
+    """
+    Gets the encoder options for a rendition format from config.ini, where
+    they're prefixed with the format's name, e.g. `jpeg-quality = 85`.
+    Options without a default (e.g. `jpeg-subsampling = 4:4:4`) are only
+    passed to the encoder if they're set.
+    """
+
+    options = {}
+    for option in [ 'quality', 'subsampling', 'method', 'optimize', 'progressive' ]:
+        key = '%s-%s' % (fmt.lower(), option)
+        default = defaults.get(option)
+        if isinstance(default, bool):
+            value = config.getboolean(key, default)
+        elif isinstance(default, int):
+            value = config.getint(key, default)
+        else:
+            value = config.get(key, default)
+        if value is not None:
+            options[option] = value
+    return options
+
+JPEG_OPTIONS = get_encoder_options(
+    'JPEG',
+    quality = 75,
+    optimize = True,
+    progressive = True,
+)
+
+# The formats that renditions can be made in, by their Pillow names, with
+# their file extensions, mimetypes and encoder options.
+FORMATS = {
+    'JPEG': ( 'jpg', 'image/jpeg', JPEG_OPTIONS ),
+    'WEBP': (
+        'webp',
+        'image/webp',
+        get_encoder_options('WEBP', quality = 80, method = 4),
+    ),
+    'AVIF': ( 'avif', 'image/avif', get_encoder_options('AVIF', quality = 60) ),
+}
+
+CONTENT_TYPES = { ext: mimetype for ext, mimetype, _ in FORMATS.values() }
+
+
+def get_rendition_formats():
+    """
+    Gets the formats to make renditions in from the `formats` config option,
+    e.g. "jpeg, webp". JPEG renditions are always made, because they're the
+    fallback for browsers that don't support the other formats. Formats that
+    this build of Pillow can't encode are skipped.
+    """
+
+    formats = [ 'JPEG' ]
+    for fmt in config.get('formats', 'jpeg').upper().split(','):
+        fmt = fmt.strip()
+        if not fmt or fmt in formats:
+            continue
+        if fmt not in FORMATS or not features.check(fmt.lower()):
+            logging.warning('Cannot make renditions in format %s' % fmt)
+            continue
+        formats.append(fmt)
+    return formats
+
+RENDITION_FORMATS = get_rendition_formats()
+
+
+def rendition_name(name, width, fmt = 'JPEG'):
+    """
+    Returns the file name of an image's rendition, e.g. "12-640.webp".
+    """
+
+    return '%s-%d.%s' % (name, width, FORMATS[fmt][0])
+
+ENCODE_PROCESSES = config.getint('encode-processes', cpu_count() or 1)
+
 MAILGUN_AUTH = ( 'api', config['mailgun-key'] )
 
+# A keep-alive session for fetching attachments from Mailgun's storage, so
+# that connections (and TLS handshakes) are reused between downloads.
+mailgun = requests.Session()
+mailgun.auth = MAILGUN_AUTH
+mailgun.mount('https://', HTTPAdapter(pool_maxsize = DOWNLOAD_THREADS))
+
+# A downloaded attachment: its path or file object, its mimetype, the SHA-256
+# digest of its contents and, if it was decoded while downloading, its image.
+Download = namedtuple('Download', [ 'source', 'content_type', 'digest', 'image' ])
+
 
 authorized_senders = re.compile(config['authorized-senders-pattern'])
-def is_authorized():
-    sender = request.forms.get('from')
-    return authorized_senders.match(sender) is not None
+def is_authorized(sender):
+    return authorized_senders.match(sender or '') is not None
+
 
+MAILGUN_KEY = bytes(config['mailgun-key'], 'utf-8')
 
-cached_mailgun_token = None
 def verify_mailgun_request(timestamp, token, signature):
     """
     Ensures that a webhook request from Mailgun is valid.
     Raises an exception if the request is invalid.
     """
 
-    # Check to avoid reused tokens to prevent replay attacks.
-    global cached_mailgun_token
-    if token == cached_mailgun_token:
-        raise ValueError('Mailgun token is identical to the previous one')
-    cached_mailgun_token = token
-
-    # Ensure that request timestamp is not older than 1 minute.
-    if time.time() - int(timestamp) > 60:
-        raise ValueError('Mailgun timestamp is older than 60 seconds')
+    # Ensure that request timestamp is within a minute of now. Requests from
+    # further in the future could outlive their tokens in the replay cache.
+    if abs(time.time() - int(timestamp)) > REPLAY_WINDOW:
+        raise ValueError('Mailgun timestamp is more than 60 seconds from now')
 
     # Ensure that request signature matches up.
-    api_key = bytes(config['mailgun-key'], 'utf-8')
     message = (timestamp + token).encode('utf-8')
-    computed = hmac.new(api_key, message, hashlib.sha256).hexdigest()
+    computed = hmac.new(MAILGUN_KEY, message, hashlib.sha256).hexdigest()
     if not hmac.compare_digest(computed, signature):
         raise ValueError('Computed signature does not match request signature')
 
+    # Check to avoid reused tokens to prevent replay attacks. This is done
+    # last, so that invalid requests can't use up tokens.
+    if not replay_cache.add(token):
+        raise ValueError('Mailgun token has already been used')
+
 
-def download_attachments(attachments):
+def parse_attachments(attachments):
     """
-    Downloads a media attachment from Mailgun.
+    Parses and validates the attachments in a Mailgun request.
 
     Parameters
     ----------
     attachments: A string of attachments JSON data from a Mailgun request.
 
+    Returns
+    -------
+    A list of tuples containing each image attachment's URL, file name, and
+    mimetype.
+    """
+
+    parsed = []
+    for attachment in json.loads(attachments):
+        url = attachment['url']
+        name = attachment['name']
+        content_type = attachment['content-type']
+
+        # Currently only images are valid. Other attachments (e.g. signatures)
+        # are skipped.
+        # TODO: Eventually, if other file types (or no files) are supported,
+        # this check should be made more robust.
+        if not content_type.startswith('image'):
+            logging.warning("Skipping unsupported file type '%s'" % content_type)
+            continue
+
+        parsed.append(( url, name, content_type ))
+
+    if not parsed:
+        raise ValueError('No image attachments')
+
+    return parsed
+
+
+def decode_stream(stream):
+    """
+    Opens and decodes an image from a file object that may still be
+    downloading. The image is decoded in draft mode (see `draft_image`).
+    """
+
+    with metrics.timer('decode'):
+        img = Image.open(stream)
+        draft_image(img, max(RENDITION_WIDTHS))
+        img.load()
+    return img
+
+
+def download_attachment(url, save_path):
+    """
+    Downloads a single attachment from Mailgun to `save_path` or, in memory
+    mode, to a temporary file object. The attachment is hashed while it's
+    downloaded and, with incremental decoding, decoded at the same time too.
+
     Returns
     -------
     A tuple containing
-    (1) A path to where the attachment is saved on disk.
-    (2) A mimetype string for the attachment file.
+    (1) `save_path` or, in memory mode, the temporary file object.
+    (2) The SHA-256 digest of the attachment as a hex string.
+    (3) The decoded `PIL.Image`, or `None` if it wasn't decoded.
+    """
+
+    digest = hashlib.sha256()
+    stream = decoded = None
+
+    with metrics.timer('download') as span:
+        response = mailgun.get(url, stream = True)
+        response.raise_for_status()
+
+        length = int(response.headers.get('Content-Length') or 0)
+        if length > MAX_ATTACHMENT_BYTES:
+            response.close()
+            raise ValueError('Attachment is too large (%d bytes)' % length)
+
+        if IN_MEMORY:
+            f = SpooledTemporaryFile(max_size = SPILL_THRESHOLD)
+        else:
+            f = open(save_path, 'wb')
+
+        if INCREMENTAL_DECODE:
+            stream = StreamBuffer()
+            decoded = decode_pool.submit(decode_stream, stream)
+
+        try:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                span.bytes += f.write(chunk)
+                if span.bytes > MAX_ATTACHMENT_BYTES:
+                    raise ValueError('Attachment is larger than %d bytes' % (
+                        MAX_ATTACHMENT_BYTES
+                    ))
+                digest.update(chunk)
+                if stream is not None:
+                    stream.write(chunk)
+        except:
+            f.close()
+            response.close()
+            raise
+        finally:
+            if stream is not None:
+                stream.close_write()
+
+    if IN_MEMORY:
+        f.seek(0)
+        source = f
+    else:
+        f.close()
+        source = save_path
+
+    # If the image can't be decoded this way, `process_image` will try again
+    # (and fail properly) by itself.
+    img = None
+    if decoded is not None:
+        try:
+            img = decoded.result()
+        except Exception as e:
+            logging.warning('Could not decode %s while downloading (%s)' % (
+                url, e
+            ))
+
+    return source, digest.hexdigest(), img
+
+
+def download_attachments(attachments, scratch = None, only = None):
+    """
+    Downloads the media attachments from Mailgun, all at the same time.
+
+    Parameters
+    ----------
+    attachments: A string of attachments JSON data from a Mailgun request.
+    scratch: The directory to save the attachments in. Defaults to
+    `TEMP_PATH`.
+    only: The indexes of the attachments to download. Defaults to all of
+    them.
+
+    Returns
+    -------
+    A list of `Download`s, one per downloaded attachment.
     """
 
-    # Attempt to parse the attachment from the request form.
-    attachment = json.loads(attachments)[0]
-    url = attachment['url']
-    name = attachment['name']
-    content_type = attachment['content-type']
+    # Attempt to parse the attachments from the request form.
+    parsed = [
+        ( i, attachment )
+        for i, attachment in enumerate(parse_attachments(attachments))
+        if only is None or i in only
+    ]
 
-    # Currently only images are valid.
-    # TODO: Eventually, if other file types (or no files) are supported,
-    # this check should be made more robust.
-    if not content_type.startswith('image'):
-        raise ValueError("Unsupported file type '%s'" % content_type)
+    # SIDE EFFECT: Download the parsed attachments to a temporary location.
+    # Attachments often have the same name (e.g. "image.jpeg"), so the saved
+    # files are prefixed with their index.
+    futures = [
+        download_pool.submit(
+            download_attachment,
+            url,
+            join(scratch or TEMP_PATH, '{0}-{1}'.format(i, name)),
+        )
+        for i, (url, name, _) in parsed
+    ]
 
-    # SIDE EFFECT: Download the parsed attachment to a temporary location.
-    save_path = join(TEMP_PATH, name)
-    response = requests.get(url, auth = MAILGUN_AUTH, stream = True)
-    response.raise_for_status()
-    with open(save_path, 'wb') as f:
-        for chunk in response:
-            f.write(chunk)
+    # Every download is waited for, even after one fails, so none of them is
+    # still writing to the scratch directory when it's removed. The ones that
+    # succeeded are closed before the first error is raised.
+    downloads = []
+    errors = []
+    for future, (_, (_, _, content_type)) in zip(futures, parsed):
+        try:
+            source, digest, img = future.result()
+        except Exception as e:
+            errors.append(e)
+            continue
+        downloads.append(Download(source, content_type, digest, img))
+
+    if errors:
+        for download in downloads:
+            if not isinstance(download.source, str):
+                download.source.close()
+            if download.image is not None:
+                download.image.close()
+        raise errors[0]
+    return downloads
+
+def get_new_oid(count = 1):
+    """
+    Reserves `count` consecutive OIDs for new posts and returns the first one.
+    Dry runs don't reserve anything, so they never leave gaps in the blog's
+    post numbers.
+    """
 
-    return save_path, content_type
+    if DRY:
+        return post_index.peek()
 
-def get_new_oid():
-    posts = listdir(rel('blog/_posts'))
-    sorted_oids = sorted([ int(p.split('.')[0].split('-')[-1]) for p in posts ])
-    return sorted_oids[-1] + 1
+    return post_index.allocate(count)
 
 
+@metrics.timed('exif')
 def get_img_data(img):
     """
-    Gets an image's EXIF metadata.
+    Gets the parts of an image's EXIF metadata that are used (see
+    `EXIF_FIELDS`). Only the image's first IFD is read, rather than building a
+    dictionary of every tag.
 
     Parameters
     ----------
@@ -148,15 +517,103 @@ def get_img_data(img):
     A dictionary keyed by EXIF tags with their data as the values.
     """
 
-    # Certain image files do not contain EXIF data, and `_getexif()` calls
-    # raise an `AttributeError`. If this happens, just return an empty dict.
-    try:
-        img_exif = img._getexif()
-        return {
-            EXIF_TAGS[k]: v for k, v in img_exif.items() if k in EXIF_TAGS
-        }
-    except AttributeError:
-        return {}
+    # Images without EXIF data (e.g. PNGs) have an empty `Exif`.
+    img_exif = img.getexif()
+
+    return {
+        name: img_exif[tag] for tag, name in EXIF_FIELDS.items()
+        if tag in img_exif
+    }
+
+
+@metrics.timed('hash')
+def hash_file(source):
+    """
+    Computes the SHA-256 digest of a file's contents.
+
+    Parameters
+    ----------
+    source: A path to a file or a seekable file object, which is rewound
+    afterwards.
+
+    Returns
+    -------
+    The digest as a hex string.
+    """
+
+    digest = hashlib.sha256()
+
+    if isinstance(source, str):
+        with open(source, 'rb') as f:
+            for chunk in iter(lambda: f.read(MB), b''):
+                digest.update(chunk)
+    else:
+        for chunk in iter(lambda: source.read(MB), b''):
+            digest.update(chunk)
+        source.seek(0)
+
+    return digest.hexdigest()
+
+
+def rendition_profile():
+    """
+    Identifies the sizes that images are currently resized to, so that
+    renditions made with other `rendition-widths` (or `upscale`) settings
+    aren't reused.
+
+    Returns
+    -------
+    A short hash of the `RENDITION_WIDTHS` and `UPSCALE` settings.
+    """
+
+    profile = json.dumps([ RENDITION_WIDTHS, UPSCALE ])
+    return hashlib.sha256(profile.encode('utf-8')).hexdigest()[:16]
+
+
+def find_renditions(digest):
+    """
+    Looks up the renditions of an image that has already been uploaded.
+
+    Parameters
+    ----------
+    digest: The SHA-256 digest of the original image.
+
+    Returns
+    -------
+    A tuple of the name of the image's files, a list of their widths and a
+    list of their formats, or `None` if the image hasn't been uploaded before
+    (in all of the `RENDITION_FORMATS`, with the current `rendition_profile`).
+    If `dedup-verify` is "head", the renditions are also checked to still be
+    on S3.
+    """
+
+    if rendition_cache is None:
+        return None
+
+    cached = rendition_cache.get(digest, rendition_profile())
+    if cached is None:
+        return None
+
+    name, widths, formats = cached
+    if not set(RENDITION_FORMATS) <= set(formats):
+        return None
+
+    if DEDUP_VERIFY != 'head':
+        return cached
+
+    for fmt in formats:
+        for w in widths:
+            key = rendition_name(name, w, fmt)
+            try:
+                S3.head_object(Bucket = config['aws-bucket'], Key = key)
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ( '404', 'NoSuchKey' ):
+                    raise
+                logging.warning('Cached rendition %s is missing' % key)
+                rendition_cache.remove(digest)
+                return None
+
+    return cached
 
 
 def delete(*paths):
@@ -170,22 +627,101 @@ def delete(*paths):
             remove(path)
 
 
-def upload_files(*file_paths):
+def upload_file(source):
     """
-    Uploads files to the specified Amazon S3 bucket.
+    Uploads a file to the specified Amazon S3 bucket. Large files are
+    uploaded in parts, and failed parts are retried individually. If the
+    upload still fails, the whole file is retried up to `UPLOAD_ATTEMPTS`
+    times.
+
+    Parameters
+    ----------
+    source: Either a path to a file, which is uploaded using its file name as
+    the key, or a tuple of a key and a seekable file object to upload.
+
+    Returns
+    -------
+    A dictionary with the file's S3 key, its size in bytes and the number of
+    seconds it took to upload.
     """
 
-    for path in file_paths:
-        file_name = basename(path)
-        logging.info('Uploading {0} to Amazon S3'.format(path))
-        if not DRY:
-            with open(path, 'rb') as f:
-                S3.put_object(
-                    Bucket = config['aws-bucket'],
-                    Key = file_name,
-                    Body = f,
-                    ACL = 'public-read',
-                )
+    if isinstance(source, str):
+        key = basename(source)
+        size = getsize(source)
+    else:
+        key, f = source
+        size = f.seek(0, 2)
+
+    extra_args = { 'ACL': 'public-read' }
+    content_type = CONTENT_TYPES.get(key.rsplit('.', 1)[-1])
+    if content_type:
+        extra_args['ContentType'] = content_type
+
+    if isinstance(source, str):
+        def upload():
+            S3.upload_file(
+                source,
+                config['aws-bucket'],
+                key,
+                ExtraArgs = extra_args,
+                Config = TRANSFER_CONFIG,
+            )
+    else:
+        def upload():
+            f.seek(0)
+            S3.upload_fileobj(
+                f,
+                config['aws-bucket'],
+                key,
+                ExtraArgs = extra_args,
+                Config = TRANSFER_CONFIG,
+            )
+
+    start = time.monotonic()
+
+    for attempt in range(1, UPLOAD_ATTEMPTS + 1):
+        try:
+            upload()
+            break
+        except Exception as e:
+            if attempt == UPLOAD_ATTEMPTS:
+                raise
+            logging.warning('Upload of {0} failed ({1}), retrying'.format(
+                key, e
+            ))
+
+    seconds = time.monotonic() - start
+    metrics.observe('upload', seconds, size)
+    logging.info('Uploaded {0} ({1} bytes) in {2:.3f}s'.format(
+        key, size, seconds
+    ))
+    return { 'key': key, 'bytes': size, 'seconds': seconds }
+
+
+def upload_files(*sources):
+    """
+    Uploads files to the specified Amazon S3 bucket. The files are all
+    uploaded at the same time, sharing one pool of connections.
+
+    Parameters
+    ----------
+    sources: Paths or (key, file object) tuples, as accepted by
+    `upload_file`.
+
+    Returns
+    -------
+    A list with the result of `upload_file` for each file.
+    """
+
+    for source in sources:
+        key = source if isinstance(source, str) else source[0]
+        logging.info('Uploading {0} to Amazon S3'.format(key))
+
+    if DRY:
+        return []
+
+    futures = [ upload_pool.submit(upload_file, source) for source in sources ]
+    return [ future.result() for future in futures ]
 
 
 def autolink_posts(text):
@@ -204,7 +740,9 @@ def autolink_posts(text):
 
 def resize_image(img, metadata):
     """
-    Resizes an image into four different sizes.
+    Resizes an image to each of the `RENDITION_WIDTHS`. Unless `UPSCALE` is
+    set, sizes larger than the image are skipped, and an image smaller than
+    all of them is only "resized" to its own size.
 
     Parameters
     ----------
@@ -214,51 +752,298 @@ def resize_image(img, metadata):
 
     Returns
     -------
-    A list of four resized `PIL.Image`s.
+    A list of resized `PIL.Image`s, from smallest to largest.
     """
 
-    degree_to_rotate = ORIENTATIONS[metadata.get('Orientation', 0)]
-    if degree_to_rotate is not None:
-        img = img.rotate(degree_to_rotate, expand = True)
+    # The resized images are only rotated at the end, so that a rotated copy
+    # of the full-size image is never made.
+    transpose = ORIENTATIONS[metadata.get('Orientation', 0)]
+    sideways = transpose in ( Image.ROTATE_90, Image.ROTATE_270 )
 
     width, height = img.size
     larger_dimension = width if width > height else height
-    scales = [ x / larger_dimension for x in [ 320.0, 640.0, 960.0, 1280.0 ] ]
+    targets = [ x for x in RENDITION_WIDTHS if UPSCALE or x <= larger_dimension ]
+    scales = [ x / larger_dimension for x in targets or [ larger_dimension ] ]
     new_sizes = [ (round(width * s), round(height * s)) for s in scales ]
-    return [ img.resize(size, Image.LANCZOS) for size in new_sizes ]
 
+    # Cascade the resizes: only the largest size is made from the source
+    # image, and each smaller size is made from the next larger one, which is
+    # much cheaper than resampling the whole source every time.
+    resized = []
+    for size in reversed(new_sizes):
+        with metrics.timer('resize', width = size[1] if sideways else size[0]):
+            img = img.resize(size, Image.LANCZOS)
+        resized.append(img)
+
+    if transpose is not None:
+        resized = [ r.transpose(transpose) for r in resized ]
+
+    return resized[::-1]
+
+
+def draft_image(img, size):
+    """
+    Configures a JPEG image to be decoded at a reduced scale, as long as the
+    decoded image is still at least `size` pixels in its larger dimension.
+    Downscaling in the decoder (in the DCT domain) is much faster than
+    decoding at full resolution and resizing. Has no effect on other formats
+    or once the image has been loaded.
+    """
+
+    width, height = img.size
+    scale = size / max(width, height)
+    if scale < 1:
+        img.draft(img.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+
+
+def flatten_image(img):
+    """
+    Converts an image that JPEG can't store (e.g. a PNG with transparency or
+    a palette, like a logo in an email's signature) to RGB. Transparent areas
+    become white. RGB and greyscale images are returned as they are.
+    """
+
+    if img.mode in ( 'RGB', 'L' ):
+        return img
+
+    if img.mode in ( 'RGBA', 'LA', 'PA' ) or 'transparency' in img.info:
+        rgba = img.convert('RGBA')
+        flat = Image.new('RGB', img.size, ( 255, 255, 255 ))
+        flat.paste(rgba, mask = rgba.getchannel('A'))
+        rgba.close()
+        return flat
+
+    return img.convert('RGB')
+
+
+# The pool is created from the job workers' threads, so its processes are
+# started by a fork server rather than forked from this (threaded) process.
+ENCODE_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+)
+
+encode_pool = None
+encode_pool_lock = threading.Lock()
+def get_encode_pool():
+    global encode_pool
+    with encode_pool_lock:
+        if encode_pool is None:
+            encode_pool = ProcessPoolExecutor(ENCODE_PROCESSES, mp_context = ENCODE_CONTEXT)
+    return encode_pool
+
+def reset_encode_pool(pool):
+    """
+    Discards a broken encoding pool (e.g. after one of its processes was
+    killed), so the next `get_encode_pool` starts a new one. Does nothing if
+    another thread has already replaced it.
+    """
+
+    global encode_pool
+    with encode_pool_lock:
+        if encode_pool is pool:
+            encode_pool = None
+    pool.shutdown(wait = False)
+
+
+def encode_image(mode, size, data, fmt = 'JPEG', path = None):
+    """
+    Encodes raw image data in one of the rendition `FORMATS`. Runs in the
+    encoding process pool, so it takes the image's raw data rather than a
+    `PIL.Image`.
+
+    Returns
+    -------
+    A tuple of the number of seconds the encoding took, the size of the
+    encoded image in bytes and, if it wasn't saved to `path`, its bytes.
+    """
+
+    start = time.monotonic()
+    img = Image.frombytes(mode, size, data)
+    if path is not None:
+        img.save(path, fmt, **FORMATS[fmt][2])
+        return time.monotonic() - start, getsize(path), None
+
+    f = BytesIO()
+    img.save(f, fmt, **FORMATS[fmt][2])
+    return time.monotonic() - start, f.tell(), f.getvalue()
+
+
+def save_images(images, targets, formats = None):
+    """
+    Encodes a list of images and saves them to the corresponding targets,
+    which are either paths or writable file objects. The encoding is spread
+    across a pool of processes, because (especially with `optimize` and
+    `progressive`, or in formats like WebP and AVIF) it is the most
+    CPU-intensive part of processing an image.
+
+    Parameters
+    ----------
+    images: A list of `PIL.Image`s.
+    targets: A list of paths or file objects, one per image.
+    formats: A list of formats (see `FORMATS`), one per image. Defaults to
+    JPEG for all images.
+    """
+
+    formats = formats or [ 'JPEG' ] * len(images)
+
+    if ENCODE_PROCESSES <= 1 or len(images) <= 1:
+        for img, target, fmt in zip(images, targets, formats):
+            with metrics.timer('encode', width = img.size[0], format = fmt) as span:
+                img.save(target, fmt, **FORMATS[fmt][2])
+                span.bytes = (
+                    getsize(target) if isinstance(target, str) else target.tell()
+                )
+        return
+
+    # File objects can't be shared with the pool's processes, so the encoded
+    # bytes are sent back and written to them here. If a process dies, the
+    # pool is broken for good, so it's replaced and the images are encoded
+    # once more.
+    for attempt in range(2):
+        pool = get_encode_pool()
+        try:
+            futures = [
+                pool.submit(
+                    encode_image,
+                    img.mode,
+                    img.size,
+                    img.tobytes(),
+                    fmt,
+                    target if isinstance(target, str) else None,
+                )
+                for img, target, fmt in zip(images, targets, formats)
+            ]
+            results = [ future.result() for future in futures ]
+            break
+        except BrokenProcessPool:
+            reset_encode_pool(pool)
+            if attempt:
+                raise
+            logging.warning('Encoding pool is broken, starting a new one')
+
+    for img, result, target, fmt in zip(images, results, targets, formats):
+        seconds, nbytes, data = result
+        metrics.observe('encode', seconds, nbytes, width = img.size[0], format = fmt)
+        if data is not None:
+            target.write(data)
+
+
+def make_renditions(img, metadata, name, formats, scratch = None, in_memory = None):
+    """
+    Resizes an image (see `resize_image`) and saves every size in each of
+    `formats` as {name}-{width}.{ext}. All of the encodes run at the same
+    time. The image is closed afterwards.
+
+    Parameters
+    ----------
+    img: The `PIL.Image` to make renditions of.
+    metadata: A dictionary of EXIF data for the image.
+    name: The name to give the renditions' files.
+    formats: The formats (see `FORMATS`) to save the renditions in.
+    scratch: The directory to save the renditions in. Defaults to
+    `TEMP_PATH`.
+    in_memory: Whether to save the renditions in memory buffers instead.
+    Defaults to `IN_MEMORY`.
 
-def create_img_tag(oid, widths, summary):
+    Returns
+    -------
+    A tuple of a list of the renditions' widths and a list of their files,
+    either paths or, in memory mode, tuples of their names and file objects
+    (which `upload_files` accepts).
+    """
+
+    draft_image(img, max(RENDITION_WIDTHS))
+    flat = flatten_image(img)
+    resized = resize_image(flat, metadata)
+    widths = [ r.size[0] for r in resized ]
+
+    renditions = [ (r, fmt) for fmt in formats for r in resized ]
+    file_names = [
+        rendition_name(name, r.size[0], fmt) for r, fmt in renditions
+    ]
+    if in_memory is None:
+        in_memory = IN_MEMORY
+    if in_memory:
+        new_files = [ (f, BytesIO()) for f in file_names ]
+        targets = [ f for _, f in new_files ]
+    else:
+        new_files = [ join(scratch or TEMP_PATH, f) for f in file_names ]
+        targets = new_files
+    save_images(
+        [ r for r, _ in renditions ],
+        targets,
+        [ fmt for _, fmt in renditions ],
+    )
+    for r in resized:
+        r.close()
+    flat.close()
+    img.close()
+
+    return widths, new_files
+
+
+def create_img_tag(oid, widths, summary, formats = ( 'JPEG', )):
     """
     Creates an HTML <img> tag for an image post. Uses the OID, widths, and
-    optional summary for the different components of the tag.
+    optional summary for the different components of the tag. If there are
+    renditions in formats other than JPEG, the <img> is wrapped in a
+    <picture> element with a <source> for each of them, so that browsers can
+    pick the best format they support.
 
     Parameters
     ----------
-    oid: A number representing the OID of the <img>'s associated post.
-    widths: A list of numbers representing each width of the image.
+    oid: A number representing the OID of the <img>'s associated post, or the
+    name of the image's files if it's not the post's only image (e.g. "12-1").
+    widths: A list of numbers representing each width of the image, from
+    smallest to largest.
     summary: A summary image that, if truthy, will cause an "alt" attribute to
     be added to the tag.
+    formats: The formats (see `FORMATS`) the image has renditions in.
 
     Returns
     -------
-    A string <img> tag.
+    A string <img> (or <picture>) tag.
     """
 
     assets_url = '{{ site.assets_url }}'
+    sizes = '(min-width: 700px) 50vw, calc(100vw - 2rem)'
 
-    # Use the second-to-smallest file (widths[1]) as the default.
-    src = '%s/%d-%d.jpg' % (assets_url, oid, widths[1])
-    srcset = [ '%s/%d-%d.jpg %dw' % (assets_url, oid, w, w) for w in widths ]
+    # Use the second-to-smallest file (widths[1]) as the default, if there is
+    # more than one.
+    src = '%s/%s-%d.jpg' % (assets_url, oid, widths[min(1, len(widths) - 1)])
+    srcset = [ '%s/%s-%d.jpg %dw' % (assets_url, oid, w, w) for w in widths ]
     img_tag = '<img src="{0}" '.format(src)
-    img_tag += 'srcset="{0}, {1}, {2}, {3}" '.format(*srcset)
-    img_tag += 'sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" '
+    img_tag += 'srcset="{0}" '.format(', '.join(srcset))
+    img_tag += 'sizes="{0}" '.format(sizes)
     img_tag += 'alt="{{ page.summary }}" ' if summary else ''
     img_tag += '/>'
 
+    # Sources are listed from the smallest files to the largest, because
+    # browsers use the first one they support.
+    sources = [
+        '<source type="{0}" srcset="{1}" sizes="{2}" />'.format(
+            FORMATS[fmt][1],
+            ', '.join(
+                '%s/%s %dw' % (assets_url, rendition_name(oid, w, fmt), w)
+                for w in widths
+            ),
+            sizes,
+        )
+        for fmt in [ 'AVIF', 'WEBP' ] if fmt in formats
+    ]
+    if sources:
+        return '<picture>{0}{1}</picture>'.format(''.join(sources), img_tag)
+
     return img_tag
 
-def process_image(post_object, img_path):
+def process_image(
+    post_object,
+    img_path,
+    name = None,
+    digest = None,
+    img = None,
+    scratch = None,
+):
     """
     Processes an uploaded image file, extract information from it to generate
     a post.
@@ -266,14 +1051,29 @@ def process_image(post_object, img_path):
     Parameters
     ----------
     post_object: A dictionary of post data that will be updated.
-    img_path: A temp path to the uploaded image file.
+    img_path: A temp path to the uploaded image file or, in memory mode, a
+    file object containing it.
+    name: The name to give the image's files, which defaults to the post's
+    OID. Posts with several images need a different name for each one.
+    digest: The SHA-256 digest of the image file, if it's already known.
+    img: The image, if it has already been opened (e.g. by
+    `download_attachment`).
+    scratch: The directory to save the renditions in before they're
+    uploaded. Defaults to `TEMP_PATH`.
     """
 
     oid = post_object['oid']
+    name = name or str(oid)
 
     logging.info('Making image post #%s' % oid)
 
-    img = Image.open(img_path)
+    # Images that have been seen before don't need to be resized and
+    # uploaded again.
+    digest = digest or hash_file(img_path)
+    cached = find_renditions(digest)
+
+    if img is None:
+        img = Image.open(img_path)
 
     metadata = get_img_data(img)
 
@@ -282,33 +1082,89 @@ def process_image(post_object, img_path):
         dt = metadata['DateTime']
         post_object['date'] = dt.split(' ')[0].replace(':', '-')
 
-    logging.info('Resizing image #%s (%s)' % (oid, img_path))
+    formats = RENDITION_FORMATS
 
-    # 1. Get list of resized `Image`s.
-    resized = resize_image(img, metadata)
+    if cached is not None:
+        name, widths, formats = cached
+        logging.info('Image #%s was already uploaded as %s' % (oid, name))
+        img.close()
+        new_files = []
+    else:
+        logging.info('Resizing image #%s (%s)' % (oid, img_path))
+        widths, new_files = make_renditions(img, metadata, name, formats, scratch)
 
-    # 2. Make a list of their widths.
-    widths = [ r.size[0] for r in resized ]
+    # Keep the original, so that the image can be re-rendered later. Now
+    # that the image is closed, it's uploaded alongside the renditions.
+    archived = upload_pool.submit(
+        archive.put,
+        digest,
+        img_path,
+        name,
+    ) if archive is not None and not DRY else None
 
-    # 3. Save them as {oid}-{width}.jpg in a temporary location.
-    new_files = [ join(TEMP_PATH, '%d-%d.jpg' % (oid, w)) for w in widths ]
-    for r, f in zip(resized, new_files):
-        r.save(f, optimize = True, progressive = True)
-        r.close()
+    if cached is None:
+        # Upload resized images to S3.
+        upload_files(*new_files)
 
-    img.close()
+        if rendition_cache is not None and not DRY:
+            rendition_cache.put(digest, name, widths, formats, rendition_profile())
 
-    # Upload resized images to S3.
-    upload_files(*new_files)
+    if archived is not None:
+        archived.result()
 
     # Clean up temporary files.
-    delete(img_path, *new_files)
+    if IN_MEMORY:
+        img_path.close()
+    else:
+        delete(img_path, *new_files)
 
     # Use the largest of the resized images for the OpenGraph image meta tag.
-    post_object['og_image'] = '%d-%d.jpg' % (oid, max(widths))
-    post_object['content'] = create_img_tag(oid, widths, post_object['summary'])
+    post_object['og_image'] = rendition_name(name, max(widths))
+    post_object['content'] = create_img_tag(
+        name,
+        widths,
+        post_object['summary'],
+        formats,
+    )
+
+
+def process_images(post_objects, downloads, names, scratch = None, done = None):
+    """
+    Runs `process_image` for several downloaded images at the same time.
 
+    Parameters
+    ----------
+    done: A function that's called with the index of each image that's
+    processed successfully, even if another image fails.
+    """
 
+    with ThreadPoolExecutor(len(downloads)) as pool:
+        futures = [
+            pool.submit(
+                process_image,
+                post_object,
+                download.source,
+                name,
+                download.digest,
+                download.image,
+                scratch,
+            )
+            for post_object, download, name in zip(post_objects, downloads, names)
+        ]
+        errors = []
+        for i, future in enumerate(futures):
+            try:
+                future.result()
+            except Exception as e:
+                errors.append(e)
+                continue
+            if done is not None:
+                done(i)
+        if errors:
+            raise errors[0]
+
+
+@metrics.timed('write_post')
 def create_post(post_object):
     """
     Converts a post object dictionary into an actual post and writes it
@@ -317,7 +1173,8 @@ def create_post(post_object):
     Parameters
     ----------
     post_object: A dictionary of data for the post. Includes things like OID,
-    content, summary, date, etc.
+    content, summary, date, etc. The content is either a string or, for posts
+    with several images, a list of strings.
     """
 
     oid = post_object['oid']
@@ -350,10 +1207,14 @@ def create_post(post_object):
         '    <a href="/%s">%s</a>' % (oid, date_str),
         '  </time>',
         '  <a href="/%s">' % oid,
-        '    %s' % post_object['content'],
-        '  </a>',
     ])
 
+    content = post_object['content']
+    if isinstance(content, str):
+        content = [ content ]
+    lines.extend([ '    %s' % c for c in content ])
+    lines.append('  </a>')
+
     summary = post_object['summary']
     if summary:
         lines.append('  <span>%s</span>' % autolink_posts(summary))
@@ -367,71 +1228,227 @@ def create_post(post_object):
     if not DRY:
         with open(file_name, 'w') as f:
             f.write(contents)
+        # The summary is escaped for the post's HTML, but the journal keeps
+        # the subject as it was sent (see `notify.template_values`).
+        post_index.add(
+            oid,
+            basename(file_name),
+            date = '{d:%Y-%m-%d}'.format(d = date),
+            summary = html.unescape(summary),
+            og_image = post_object.get('og_image'),
+        )
+
+def resume_publishing():
+    """
+    Commits and pushes the posts that were written, but not committed or not
+    pushed, before the server last stopped.
+    """
+
+    uncommitted = jobs.unfinished('written', 'committed')
+    if uncommitted:
+        update_site(*uncommitted)
+    elif publisher.pusher is not None:
+        unpushed = jobs.unfinished('committed', 'pushed')
+        if unpushed:
+            publisher.pusher.schedule(oids = unpushed)
+
 
-def update_site(new_post_number):
+def update_site(*new_post_numbers):
     """
-    Adds a new post and pushes the site to GitHub, where it will be republished.
+    Adds new posts and pushes the site to GitHub, where it will be republished.
+    Posts are committed and pushed in batches (see `SitePublisher`), so this
+    may return before the posts are published. Posts passed in the same call
+    are always committed together.
 
     Parameters
     ----------
-    new_post_number: The OID/number of the new post (used for logging and for
-    generating the commit message.)
+    new_post_numbers: The OIDs/numbers of the new posts (used for logging and
+    for generating the commit message.)
     """
 
-    logging.info('Uploading blog post #{0}'.format(new_post_number))
+    logging.info('Queueing blog post(s) #{0} for upload'.format(
+        ', #'.join(map(str, new_post_numbers))
+    ))
+    publisher.add(*new_post_numbers)
 
-    if not DRY:
-        with pushd(uploader_dirpath):
-            git.add('_posts')
-            git.commit('-m', 'Add post {0}'.format(new_post_number))
-            git.push('origin', 'master')
 
+def process_upload(payload):
+    """
+    Runs the whole pipeline for an uploaded email: downloads its attachments,
+    processes them, writes the post(s) and publishes the site. This is run by
+    the queue workers, outside of the webhook request.
 
-@post('/upload')
-def upload():
+    An email with several photos becomes either a single gallery post or one
+    post per photo, depending on the `multi-photo` config option.
 
-    if not is_authorized():
-        logging.error('Unauthorized request to /upload')
-        abort(406)
+    Parameters
+    ----------
+    payload: A dictionary of the fields from the Mailgun request that are
+    needed to make the post ("message_id", "subject" and "attachments").
+    """
 
-    # Verify that the request is legitimate.
-    timestamp = request.forms.get('timestamp')
-    token = request.forms.get('token')
-    signature = request.forms.get('signature')
-    verify_mailgun_request(timestamp, token, signature)
+    # Each stage of an email that's done is checkpointed under its
+    # Message-Id, so that a retry picks up at the first unfinished stage and
+    # reuses the same OIDs, rather than making the posts again.
+    message_id = payload.get('message_id')
+    done = jobs.stages(message_id) if message_id else {}
+
+    def checkpoint(stage, state = None, oids = ()):
+        if message_id and not DRY:
+            jobs.checkpoint(message_id, stage, state, oids)
+
+    if 'written' in done:
+        oids = done['written']
+        logging.info('Post(s) #{0} were already written'.format(
+            ', #'.join(map(str, oids))
+        ))
+        if 'committed' not in done:
+            update_site(*oids)
+        return
+
+    # Ensure the local blog copy is up to date. If posts were added
+    # elsewhere, the index has to be brought up to date too.
+    with metrics.timer('git_pull'):
+        pulled = publisher.sync()
+    if pulled:
+        post_index.rebuild()
+
+    summary = html.escape(payload.get('subject', ''))
+    count = len(parse_attachments(payload['attachments']))
+    gallery = MULTI_PHOTO == 'gallery'
+
+    if 'allocated' in done:
+        first_oid = done['allocated']
+    else:
+        first_oid = get_new_oid(1 if gallery else count)
+        checkpoint('allocated', first_oid)
+
+    # Each image's part of the post is checkpointed once it has been
+    # downloaded, resized and uploaded.
+    images = [ done.get('uploaded-%d' % i) for i in range(count) ]
+    todo = [ i for i, image in enumerate(images) if image is None ]
+
+    if todo:
+        # Every job works in its own scratch directory, which is removed
+        # (along with anything left in it by a failure) when the job is done.
+        with TemporaryDirectory(dir = TEMP_PATH, prefix = 'job-') as scratch:
+            downloads = download_attachments(payload['attachments'], scratch, todo)
+
+            # This section creates the main content for the post, based on
+            # the type of uploaded file. The `process_<type>` functions update
+            # the `post_object` with values that will be used to write the
+            # post, but also perform side effects (like resizing, uploading,
+            # etc.) Currently only images are downloaded.
+            if gallery:
+                post_objects = [ { 'oid': first_oid, 'summary': summary } for _ in todo ]
+                names = [
+                    '%d-%d' % (first_oid, i) if i else str(first_oid) for i in todo
+                ]
+            else:
+                post_objects = [
+                    { 'oid': first_oid + i, 'summary': summary } for i in todo
+                ]
+                names = [ None ] * len(todo)
+
+            def image_done(j):
+                images[todo[j]] = post_objects[j]
+                checkpoint('uploaded-%d' % todo[j], post_objects[j])
+
+            process_images(post_objects, downloads, names, scratch, image_done)
+
+    if gallery:
+        # The gallery is dated and previewed by its first image.
+        post_object = dict(images[0])
+        post_object['content'] = [ i['content'] for i in images ]
+        post_objects = [ post_object ]
+    else:
+        post_objects = images
 
-    # Ensure the local blog copy is up to date.
-    with pushd(uploader_dirpath):
-        git.pull('origin', 'master')
+    for post_object in post_objects:
+        create_post(post_object)
 
-    try:
+    oids = [ p['oid'] for p in post_objects ]
+    checkpoint('written', oids, oids)
+    update_site(*oids)
 
-        post_object = {}
 
-        new_oid = get_new_oid()
-        post_object['oid'] = new_oid
+@get('/metrics')
+def get_metrics():
+    return HTTPResponse(metrics.render(), headers = {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+    })
 
-        summary = request.forms.get('subject', '')
-        post_object['summary'] = html.escape(summary)
 
-        fpath, ftype = download_attachments(request.forms.get('attachments'))
+class UploadRejected(Exception):
+    """
+    Raised by `queue_upload` for webhooks that will never be processed, which
+    are answered with a 406 so that Mailgun doesn't retry them.
+    """
 
-        # This section creates the main content for the post, based on the
-        # type of uploaded file. The `process_<type>` functions update the
-        # `post_object` with values that will be used to write the post,
-        # but also perform side effects (like resizing, uploading, etc.)
-        if ftype.startswith('image'):
-            process_image(post_object, fpath)
 
-        create_post(post_object)
+def queue_upload(forms):
+    """
+    Verifies a webhook request from Mailgun and adds a job for it to the
+    queue. This is the `/upload` contract, shared by the Bottle server and the
+    async server (see `async_server.py`).
 
-        update_site(new_oid)
+    Parameters
+    ----------
+    forms: A mapping of the request's form fields.
 
+    Returns
+    -------
+    The ID of the job.
+    """
+
+    if not is_authorized(forms.get('from')):
+        logging.error('Unauthorized request to /upload')
+        raise UploadRejected('Unauthorized sender')
+
+    # Verify that the request is legitimate.
+    timestamp = forms.get('timestamp')
+    token = forms.get('token')
+    signature = forms.get('signature')
+    verify_mailgun_request(timestamp, token, signature)
+
+    payload = {
+        'message_id': forms.get('Message-Id'),
+        'subject': forms.get('subject', ''),
+        'attachments': forms.get('attachments'),
+    }
+
+    # Reject requests that could never be processed now, rather than letting
+    # them fail in the background.
+    try:
+        parse_attachments(payload['attachments'])
     except Exception as e:
         logging.exception(e)
+        raise UploadRejected(str(e))
+
+    # The rest of the work is done by the queue workers, so that Mailgun
+    # doesn't time out waiting for it.
+    job_id = jobs.put(payload)
+    logging.info('Queued job {0}'.format(job_id))
+    return job_id
+
+
+@post('/upload')
+def upload():
+    try:
+        queue_upload(request.forms)
+    except UploadRejected:
         abort(406)
 
 
 if __name__ == '__main__':
+    atexit.register(publisher.close)
+    jobs.recover()
+    resume_publishing()
+    start_workers(
+        jobs,
+        process_upload,
+        config.getint('workers', 1),
+        poll_interval = config.getfloat('queue-poll-interval', 1.0),
+    )
     logging.info('Starting server')
     run(host = 'localhost', port = 8080)
@@ -0,0 +1,78 @@
+import threading
+from io import SEEK_CUR, SEEK_END, SEEK_SET
+
+
+class StreamBuffer:
+    """
+    A read-only file object over data that is still arriving, e.g. from a
+    download. One thread appends data with `write` and calls `close_write`
+    when it's done, while another reads (and seeks) as if the data were
+    already there: reads block until enough data has arrived.
+
+    This lets Pillow open and decode an image while it's being downloaded.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.pos = 0
+        self.done = False
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def write(self, chunk):
+        with self.cond:
+            self.data.extend(chunk)
+            self.cond.notify_all()
+        return len(chunk)
+
+    def close_write(self):
+        """
+        Marks the end of the data. Reads past the end return short (or empty)
+        results from then on.
+        """
+
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def wait(self, size):
+        """
+        Waits until at least `size` bytes have arrived or the data is
+        complete.
+        """
+
+        with self.cond:
+            self.cond.wait_for(lambda: self.done or len(self.data) >= size)
+
+    def read(self, size = -1):
+        if size is None or size < 0:
+            self.wait(float('inf'))
+            end = len(self.data)
+        else:
+            self.wait(self.pos + size)
+            end = min(self.pos + size, len(self.data))
+
+        chunk = bytes(self.data[self.pos:end])
+        self.pos = max(self.pos, end)
+        return chunk
+
+    def seek(self, offset, whence = SEEK_SET):
+        if whence == SEEK_CUR:
+            offset += self.pos
+        elif whence == SEEK_END:
+            self.wait(float('inf'))
+            offset += len(self.data)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.closed = True
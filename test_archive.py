@@ -0,0 +1,103 @@
+import os
+import shutil
+from io import BytesIO
+from unittest.mock import patch, Mock
+
+from botocore.exceptions import ClientError
+from nose.tools import eq_
+
+from archive import OriginalArchive
+from fixtures import make_temp_dir, remove_temp_dirs
+
+def teardown():
+    remove_temp_dirs()
+
+class FakeS3:
+
+    def __init__(self):
+        self.objects = {}
+
+    def upload_file(self, path, bucket, key):
+        with open(path, 'rb') as f:
+            self.objects[key] = f.read()
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({ 'Error': { 'Code': '404' } }, 'HeadObject')
+        return {}
+
+    def upload_fileobj(self, f, bucket, key):
+        self.objects[key] = f.read()
+
+    def download_fileobj(self, bucket, key, f):
+        f.write(self.objects[key])
+
+def make_archive(**kwargs):
+    s3 = FakeS3()
+    return s3, OriginalArchive(s3, 'bucket', 'originals', make_temp_dir(), **kwargs)
+
+def make_original(contents):
+    path = os.path.join(make_temp_dir(), 'original.jpg')
+    with open(path, 'wb') as f:
+        f.write(contents)
+    return path
+
+def test_put_and_get():
+    s3, archive = make_archive()
+    archive.put('abc', make_original(b'abc'), '12')
+
+    eq_(s3.objects, { 'originals/abc': b'abc' })
+    eq_(archive.lookup('12'), 'abc')
+    eq_(archive.lookup('13'), None)
+
+    # Originals are fetched from S3 when they aren't cached.
+    shutil.rmtree(archive.cache_dir)
+    os.makedirs(archive.cache_dir)
+    archive = OriginalArchive(s3, 'bucket', 'originals', archive.cache_dir)
+    with open(archive.get('abc'), 'rb') as f:
+        eq_(f.read(), b'abc')
+
+def test_put_file_object():
+    s3, archive = make_archive()
+    f = BytesIO(b'abc')
+    f.read()
+    archive.put('abc', f)
+
+    # File objects are streamed to S3, without being cached.
+    eq_(s3.objects, { 'originals/abc': b'abc' })
+    eq_(f.tell(), 0)
+    assert not os.path.exists(archive.path('abc'))
+
+def test_put_existing():
+    s3, archive = make_archive()
+    s3.upload_file = Mock()
+    s3.objects['originals/abc'] = b'abc'
+
+    # Originals that are already on S3 aren't uploaded again, but the names
+    # of the images made from them are still remembered.
+    archive.put('abc', make_original(b'abc'), '12')
+    archive.put('abc', make_original(b'abc'), '13')
+    assert not s3.upload_file.called
+    eq_(archive.lookup('13'), 'abc')
+
+def test_eviction():
+    s3, archive = make_archive(max_bytes = 5)
+
+    with patch('time.time', Mock(return_value = 1)):
+        archive.put('a', make_original(b'aa'))
+    with patch('time.time', Mock(return_value = 2)):
+        archive.put('b', make_original(b'bb'))
+
+    # Using 'a' makes 'b' the least recently used.
+    with patch('time.time', Mock(return_value = 3)):
+        archive.get('a')
+    with patch('time.time', Mock(return_value = 4)):
+        archive.put('c', make_original(b'cc'))
+
+    assert os.path.exists(archive.path('a'))
+    assert not os.path.exists(archive.path('b'))
+    assert os.path.exists(archive.path('c'))
+
+    # Evicted originals are still on S3.
+    with open(archive.get('b'), 'rb') as f:
+        eq_(f.read(), b'bb')
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import sqlite3
+from unittest.mock import patch, Mock
+
+from nose.tools import eq_
+
+old_mode = os.environ.get('MODE', None)
+os.environ['MODE'] = 'test'
+
+from async_server import app, parse_form, work
+import server
+
+def teardown():
+    if old_mode:
+        os.environ['MODE'] = old_mode
+    else:
+        del os.environ['MODE']
+
+def call(method, path, body = b'', content_type = 'application/x-www-form-urlencoded'):
+    """
+    Makes a request to the ASGI app and returns its status and body.
+    """
+
+    chunks = [ body[:10], body[10:] ]
+    async def receive():
+        chunk = chunks.pop(0)
+        return { 'type': 'http.request', 'body': chunk, 'more_body': bool(chunks) }
+
+    sent = []
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'headers': [ ( b'content-type', content_type.encode() ) ],
+    }
+    asyncio.run(app(scope, receive, send))
+    return sent[0]['status'], sent[1]['body']
+
+def test_parse_form():
+    eq_(parse_form('application/x-www-form-urlencoded', b'a=1&b=%C3%A9+x'), { 'a': '1', 'b': 'é x' })
+
+    body = (
+        b'--XX\r\nContent-Disposition: form-data; name="subject"\r\n\r\nHi \xc3\xa9\r\n'
+        b'--XX\r\nContent-Disposition: form-data; name="f"; filename="x.jpg"\r\n\r\nabc\r\n'
+        b'--XX--\r\n'
+    )
+    eq_(parse_form('multipart/form-data; boundary=XX', body), { 'subject': 'Hi é' })
+
+@patch('server.queue_upload')
+def test_upload(queue_upload):
+    status, _ = call('POST', '/upload', b'from=joe%40foo.bar&subject=Hi&attachments=%5B%5D')
+    eq_(status, 200)
+    queue_upload.assert_called_once_with({
+        'from': 'joe@foo.bar',
+        'subject': 'Hi',
+        'attachments': '[]',
+    })
+
+    queue_upload.side_effect = server.UploadRejected
+    eq_(call('POST', '/upload')[0], 406)
+
+    queue_upload.side_effect = ValueError('Computed signature does not match request signature')
+    eq_(call('POST', '/upload')[0], 500)
+
+@patch('async_server.MAX_BODY_BYTES', 16)
+@patch('server.queue_upload')
+def test_upload_too_large(queue_upload):
+    eq_(call('POST', '/upload', b'x' * 32)[0], 413)
+    assert not queue_upload.called
+
+def test_routes():
+    status, body = call('GET', '/metrics')
+    eq_(status, 200)
+    assert body.startswith(b'# HELP')
+    eq_(call('GET', '/nothing')[0], 404)
+
+def test_work():
+    queue = Mock()
+    queue.claim.side_effect = [ ( 1, 'a' ), ( 2, 'b' ), None ]
+    handled = []
+
+    def handler(payload):
+        if payload == 'a':
+            raise ValueError(payload)
+        handled.append(payload)
+
+    async def run():
+        task = asyncio.ensure_future(work(queue, handler, None, poll_interval = 10))
+        while queue.claim.call_count < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(run())
+    eq_(handled, [ 'b' ])
+    queue.fail.assert_called_once_with(1, "ValueError('a')")
+    queue.complete.assert_called_once_with(2)
+
+def test_work_queue_error():
+    results = iter([ sqlite3.OperationalError('database is locked'), ( 1, 'a' ) ])
+    def claim():
+        result = next(results, None)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    queue = Mock()
+    queue.claim.side_effect = claim
+    handler = Mock()
+
+    # The task survives the database being locked.
+    async def run():
+        task = asyncio.ensure_future(work(queue, handler, None, poll_interval = 0))
+        while queue.claim.call_count < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    asyncio.run(run())
+    handler.assert_called_once_with('a')
+    queue.complete.assert_called_once_with(1)
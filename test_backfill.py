@@ -0,0 +1,186 @@
+import os
+from unittest.mock import patch, Mock
+
+from nose.tools import eq_
+from PIL import Image
+
+old_mode = os.environ.get('MODE', None)
+os.environ['MODE'] = 'test'
+
+from backfill import Checkpoints, backfill, backfill_profile, find_images, rewrite_post
+from fixtures import make_temp_dir, remove_temp_dirs
+from server import create_img_tag, hash_file, rendition_profile
+
+def teardown():
+    remove_temp_dirs()
+    if old_mode:
+        os.environ['MODE'] = old_mode
+    else:
+        del os.environ['MODE']
+
+def make_post(oid, names, summary = ''):
+    lines = [
+        '---',
+        'layout: post',
+        "summary: '%s'" % (summary or 'Post #%d' % oid),
+        'og_image: %s-1280.jpg' % names[0],
+        '---',
+        '',
+        '<p>',
+        '  <a href="/%d">' % oid,
+    ]
+    lines.extend(
+        '    %s' % create_img_tag(name, [ 320, 640, 960, 1280 ], summary)
+        for name in names
+    )
+    lines.extend([ '  </a>', '</p>', '' ])
+    return '\n'.join(lines)
+
+def make_blog():
+    posts_dir = make_temp_dir()
+    posts = {
+        '2017-01-16-3.md': make_post(3, [ '3' ], 'Hi'),
+        '2017-01-17-4.md': make_post(4, [ '4', '4-1' ]),
+    }
+    for file_name, contents in posts.items():
+        with open(os.path.join(posts_dir, file_name), 'w') as f:
+            f.write(contents)
+
+    originals = make_temp_dir()
+    for name in [ '3', '4', '4-1' ]:
+        Image.new('RGB', size = (800, 600)).save(os.path.join(originals, name + '.jpg'))
+
+    return posts_dir, originals
+
+def test_find_images():
+    posts_dir, _ = make_blog()
+    eq_(find_images(posts_dir), {
+        '2017-01-16-3.md': [ '3' ],
+        '2017-01-17-4.md': [ '4', '4-1' ],
+    })
+
+def test_rewrite_post():
+    contents = make_post(3, [ '3' ], 'Hi')
+    rewritten = rewrite_post(contents, { '3': ( [ 320, 640 ], [ 'JPEG', 'WEBP' ] ) })
+
+    assert 'og_image: 3-640.jpg' in rewritten
+    assert '    <picture><source type="image/webp"' in rewritten
+    assert 'alt="{{ page.summary }}"' in rewritten
+    assert '3-960.jpg' not in rewritten
+
+    # Posts whose images weren't re-rendered are left alone.
+    eq_(rewrite_post(contents, {}), contents)
+
+@patch('server.publisher')
+@patch('server.upload_files')
+def test_backfill(upload_files, publisher):
+    upload_files.side_effect = lambda *paths: [ { 'bytes': 1 } for _ in paths ]
+    posts_dir, originals = make_blog()
+    os.remove(os.path.join(originals, '4-1.jpg'))
+    checkpoints = Checkpoints(os.path.join(make_temp_dir(), 'backfill.db'))
+
+    report = backfill(originals, checkpoints, posts_dir, processes = 1)
+
+    eq_(report['images'], 2)
+    eq_(report['missing'], 1)
+    eq_(report['posts_rewritten'], 2)
+    eq_(upload_files.call_count, 2)
+    publisher.commit.assert_called_once_with([ 3, 4 ], 'Re-render images in 2 posts')
+
+    # The 800px originals aren't scaled up.
+    eq_(checkpoints.all(backfill_profile([ 'JPEG' ]))['3'], ( [ 320, 640 ], [ 'JPEG' ] ))
+    with open(os.path.join(posts_dir, '2017-01-17-4.md')) as f:
+        contents = f.read()
+    assert '4-960.jpg' not in contents
+    assert '4-1-960.jpg' in contents
+
+    # Running it again only renders what's left.
+    Image.new('RGB', size = (800, 600)).save(os.path.join(originals, '4-1.jpg'))
+    report = backfill(originals, checkpoints, posts_dir, processes = 1)
+    eq_(report['images'], 1)
+    eq_(report['skipped'], 2)
+
+@patch('server.publisher')
+@patch('server.upload_files')
+def test_backfill_new_settings(upload_files, publisher):
+    upload_files.side_effect = lambda *paths: [ { 'bytes': 1 } for _ in paths ]
+    posts_dir, originals = make_blog()
+    checkpoints = Checkpoints(os.path.join(make_temp_dir(), 'backfill.db'))
+    backfill(originals, checkpoints, posts_dir, processes = 1, commit = False)
+
+    # After the sizes change, every image is rendered again and the posts
+    # are rewritten with the new sizes.
+    with patch('server.RENDITION_WIDTHS', [ 320.0, 480.0 ]):
+        report = backfill(originals, checkpoints, posts_dir, processes = 1)
+        eq_(report['images'], 3)
+        eq_(report['skipped'], 0)
+        eq_(report['posts_rewritten'], 2)
+        eq_(
+            checkpoints.all(backfill_profile([ 'JPEG' ]))['3'],
+            ( [ 320, 480 ], [ 'JPEG' ] ),
+        )
+
+    with open(os.path.join(posts_dir, '2017-01-16-3.md')) as f:
+        contents = f.read()
+    assert '3-480.jpg' in contents
+    assert '3-640.jpg' not in contents
+
+    # The checkpoints made with the old sizes are gone.
+    eq_(checkpoints.all(backfill_profile([ 'JPEG' ])), {})
+
+@patch('server.publisher')
+@patch('server.upload_files')
+def test_backfill_shared_image(upload_files, publisher):
+    upload_files.side_effect = lambda *paths: [ { 'bytes': 1 } for _ in paths ]
+    posts_dir, originals = make_blog()
+
+    # Post 5 reused post 3's renditions.
+    with open(os.path.join(posts_dir, '2017-01-18-5.md'), 'w') as f:
+        f.write(make_post(5, [ '3' ]))
+    checkpoints = Checkpoints(os.path.join(make_temp_dir(), 'backfill.db'))
+
+    report = backfill(originals, checkpoints, posts_dir, processes = 1)
+
+    eq_(report['images'], 3)
+    eq_(report['failed'], 0)
+    eq_(upload_files.call_count, 3)
+    eq_(report['posts_rewritten'], 3)
+
+@patch('server.publisher')
+@patch('server.upload_files')
+def test_backfill_archive(upload_files, publisher):
+    upload_files.side_effect = lambda *paths: [ { 'bytes': 1 } for _ in paths ]
+    posts_dir, originals = make_blog()
+    archive = Mock()
+    archive.lookup.side_effect = lambda name: 'digest-' + name if name != '4-1' else None
+    archive.get.side_effect = lambda digest: os.path.join(
+        originals,
+        digest[len('digest-'):] + '.jpg',
+    )
+    checkpoints = Checkpoints(os.path.join(make_temp_dir(), 'backfill.db'))
+
+    report = backfill(archive, checkpoints, posts_dir, processes = 1)
+
+    eq_(report['images'], 2)
+    eq_(report['missing'], 1)
+    eq_(sorted(c[0][0] for c in archive.get.call_args_list), [ 'digest-3', 'digest-4' ])
+
+@patch('server.publisher')
+@patch('server.rendition_cache')
+@patch('server.upload_files')
+def test_backfill_rendition_cache(upload_files, rendition_cache, publisher):
+    upload_files.side_effect = lambda *paths: [ { 'bytes': 1 } for _ in paths ]
+    posts_dir, originals = make_blog()
+    checkpoints = Checkpoints(os.path.join(make_temp_dir(), 'backfill.db'))
+
+    backfill(originals, checkpoints, posts_dir, processes = 1)
+
+    # Repeats of the originals now point at the new renditions.
+    rendition_cache.put.assert_any_call(
+        hash_file(os.path.join(originals, '3.jpg')),
+        '3',
+        [ 320, 640 ],
+        [ 'JPEG' ],
+        rendition_profile(),
+    )
+    eq_(rendition_cache.put.call_count, 3)
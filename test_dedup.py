@@ -0,0 +1,69 @@
+import os
+import sqlite3
+from unittest.mock import patch, Mock
+
+from nose.tools import eq_
+
+from dedup import RenditionCache
+from fixtures import make_temp_dir, remove_temp_dirs
+
+def teardown():
+    remove_temp_dirs()
+
+def make_cache(**kwargs):
+    return RenditionCache(
+        os.path.join(make_temp_dir(), 'renditions.db'),
+        **kwargs
+    )
+
+def test_get_and_put():
+    cache = make_cache()
+    eq_(cache.get('abc'), None)
+    cache.put('abc', '12', [ 320, 640 ])
+    eq_(cache.get('abc'), ( '12', [ 320, 640 ], [ 'JPEG' ] ))
+
+    cache.put('abc', '12', [ 320, 640 ], [ 'JPEG', 'WEBP' ])
+    eq_(cache.get('abc'), ( '12', [ 320, 640 ], [ 'JPEG', 'WEBP' ] ))
+
+def test_profile():
+    cache = make_cache()
+    cache.put('abc', '12', [ 320, 640 ], profile = 'a')
+    eq_(cache.get('abc', 'a'), ( '12', [ 320, 640 ], [ 'JPEG' ] ))
+    eq_(cache.get('abc', 'b'), None)
+    eq_(cache.get('abc'), ( '12', [ 320, 640 ], [ 'JPEG' ] ))
+
+def test_remove():
+    cache = make_cache()
+    cache.put('abc', '12', [ 320 ])
+    cache.remove('abc')
+    eq_(cache.get('abc'), None)
+
+def test_eviction():
+    cache = make_cache(max_entries = 2)
+
+    with patch('time.time', Mock(return_value = 1)):
+        cache.put('a', '1', [ 320 ])
+    with patch('time.time', Mock(return_value = 2)):
+        cache.put('b', '2', [ 320 ])
+
+    # Using 'a' makes 'b' the least recently used.
+    with patch('time.time', Mock(return_value = 3)):
+        cache.get('a')
+    with patch('time.time', Mock(return_value = 4)):
+        cache.put('c', '3', [ 320 ])
+
+    eq_(cache.get('a'), ( '1', [ 320 ], [ 'JPEG' ] ))
+    eq_(cache.get('b'), None)
+    eq_(cache.get('c'), ( '3', [ 320 ], [ 'JPEG' ] ))
+
+def test_migration():
+    path = os.path.join(make_temp_dir(), 'renditions.db')
+    with sqlite3.connect(path) as db:
+        db.execute(
+            'CREATE TABLE renditions (digest TEXT PRIMARY KEY, name TEXT NOT NULL, '
+            'widths TEXT NOT NULL, used_at REAL NOT NULL)'
+        )
+        db.execute("INSERT INTO renditions VALUES ('abc', '12', '[320]', 1)")
+
+    # Caches from before formats were added only have JPEGs.
+    eq_(RenditionCache(path).get('abc'), ( '12', [ 320 ], [ 'JPEG' ] ))
@@ -0,0 +1,156 @@
+import os
+import sqlite3
+import threading
+from unittest.mock import patch, Mock
+
+from nose.tools import eq_
+
+from fixtures import make_temp_dir, remove_temp_dirs
+from jobs import JobQueue, run_next, work
+
+def teardown():
+    remove_temp_dirs()
+
+def make_queue(**kwargs):
+    return JobQueue(os.path.join(make_temp_dir(), 'jobs.db'), **kwargs)
+
+def test_put_and_claim():
+    queue = make_queue()
+    first = queue.put({ 'subject': 'first' })
+    queue.put({ 'subject': 'second' })
+
+    eq_(queue.claim(), (first, { 'subject': 'first' }))
+    eq_(queue.claim()[1], { 'subject': 'second' })
+    eq_(queue.claim(), None)
+
+def test_complete():
+    queue = make_queue()
+    job_id = queue.put({})
+    queue.claim()
+    queue.complete(job_id)
+    queue.recover()
+    eq_(queue.claim(), None)
+
+def test_fail_retries_with_backoff():
+    queue = make_queue(max_attempts = 3, backoff = 10)
+    job_id = queue.put({})
+    queue.claim()
+
+    with patch('time.time', Mock(return_value = 1000)):
+        queue.fail(job_id, 'oops')
+
+    # The job isn't ready until the backoff has passed.
+    with patch('time.time', Mock(return_value = 1009)):
+        eq_(queue.claim(), None)
+    with patch('time.time', Mock(return_value = 1010)):
+        eq_(queue.claim(), (job_id, {}))
+
+def test_fail_dead_letter():
+    queue = make_queue(max_attempts = 2, backoff = 0)
+    job_id = queue.put({ 'subject': 'bad' })
+
+    queue.claim()
+    queue.fail(job_id, 'first')
+    queue.claim()
+    queue.fail(job_id, 'second')
+
+    eq_(queue.claim(), None)
+    eq_(queue.dead_jobs(), [ (job_id, { 'subject': 'bad' }, 'second') ])
+
+def test_recover():
+    queue = make_queue()
+    job_id = queue.put({})
+    queue.claim()
+    eq_(queue.claim(), None)
+    queue.recover()
+    eq_(queue.claim(), (job_id, {}))
+
+def test_run_next():
+    queue = make_queue(max_attempts = 1)
+    bad = queue.put({ 'ok': False })
+    handled = []
+
+    def handler(payload):
+        if not payload['ok']:
+            raise ValueError('not ok')
+        handled.append(payload)
+
+    # The failed job is out of attempts, so it's dead.
+    eq_(run_next(queue, handler), True)
+    eq_(queue.dead_jobs(), [ (bad, { 'ok': False }, "ValueError('not ok')") ])
+
+    queue.put({ 'ok': True })
+    eq_(run_next(queue, handler), True)
+    eq_(handled, [ { 'ok': True } ])
+    eq_(run_next(queue, handler), False)
+
+def test_work():
+    queue = make_queue(backoff = 60)
+    bad = queue.put({ 'ok': False })
+    queue.put({ 'ok': True })
+    stop = threading.Event()
+
+    def handler(payload):
+        if not payload['ok']:
+            raise ValueError('not ok')
+        stop.set()
+
+    work(queue, handler, stop, poll_interval = 0)
+
+    eq_(queue.claim(), None)
+    queue.recover()
+    eq_(queue.claim(), None)
+
+    # Only the failed job remains, waiting to be retried.
+    with patch('time.time', Mock(return_value = 2 ** 40)):
+        eq_(queue.claim(), (bad, { 'ok': False }))
+
+def test_work_queue_error():
+    queue = make_queue()
+    queue.put({})
+    stop = threading.Event()
+    handler = Mock(side_effect = lambda payload: stop.set())
+
+    # The worker survives the database being locked.
+    claim = queue.claim
+    queue.claim = Mock(side_effect = [ sqlite3.OperationalError('database is locked'), claim() ])
+    work(queue, handler, stop, poll_interval = 0)
+
+    handler.assert_called_once_with({})
+
+def test_checkpoints():
+    queue = make_queue()
+    eq_(queue.stages('<a@foo.bar>'), {})
+
+    queue.checkpoint('<a@foo.bar>', 'allocated', 20)
+    queue.checkpoint('<a@foo.bar>', 'uploaded-0', { 'oid': 20 })
+    queue.checkpoint('<a@foo.bar>', 'written', [ 20, 21 ], [ 20, 21 ])
+    queue.checkpoint('<b@foo.bar>', 'written', [ 22 ], [ 22 ])
+    eq_(queue.stages('<a@foo.bar>'), {
+        'allocated': 20,
+        'uploaded-0': { 'oid': 20 },
+        'written': [ 20, 21 ],
+    })
+    eq_(queue.unfinished('written', 'committed'), [ 20, 21, 22 ])
+
+    # Later stages are recorded by the posts' OIDs.
+    queue.checkpoint_posts([ 20, 21 ], 'committed')
+    eq_(queue.unfinished('written', 'committed'), [ 22 ])
+    eq_(queue.unfinished('committed', 'pushed'), [ 20, 21 ])
+
+    queue.checkpoint_posts([ 20, 21 ], 'pushed')
+    eq_(queue.unfinished('committed', 'pushed'), [])
+    assert 'pushed' in queue.stages('<a@foo.bar>')
+    assert 'pushed' not in queue.stages('<b@foo.bar>')
+
+def test_checkpoint_ttl():
+    queue = make_queue(checkpoint_ttl = 60)
+
+    with patch('time.time', Mock(return_value = 1000)):
+        queue.checkpoint('<a@foo.bar>', 'written', [ 20 ], [ 20 ])
+    queue.checkpoint('<b@foo.bar>', 'written', [ 21 ], [ 21 ])
+
+    # Old emails are forgotten.
+    queue.recover()
+    eq_(queue.stages('<a@foo.bar>'), {})
+    eq_(queue.unfinished('written', 'committed'), [ 21 ])
@@ -0,0 +1,71 @@
+from unittest.mock import patch, Mock
+
+from nose.tools import eq_, raises
+
+from metrics import Histogram, Metrics
+
+def test_histogram():
+    histogram = Histogram(size = 100)
+    for i in range(1, 201):
+        histogram.observe(i / 100, nbytes = 10)
+
+    # Only the last 100 observations are used for quantiles.
+    eq_(histogram.quantile(0.5), 1.51)
+    eq_(histogram.quantile(0.99), 2.0)
+    eq_(histogram.count, 200)
+    eq_(histogram.bytes, 2000)
+
+def test_timer():
+    metrics = Metrics()
+
+    with patch('time.monotonic', Mock(side_effect = [ 10.0, 10.5 ])):
+        with metrics.timer('download') as span:
+            span.bytes = 1024
+
+    histogram = metrics.histograms[( 'download', () )]
+    eq_(histogram.sum, 0.5)
+    eq_(histogram.bytes, 1024)
+
+@raises(ValueError)
+def test_timer_error():
+    metrics = Metrics()
+    try:
+        with metrics.timer('download'):
+            raise ValueError
+    finally:
+        eq_(metrics.histograms, {})
+
+def test_timed():
+    metrics = Metrics()
+
+    @metrics.timed('resize')
+    def resize(x):
+        return x * 2
+
+    eq_(resize(2), 4)
+    eq_(metrics.histograms[( 'resize', () )].count, 1)
+
+def test_render():
+    metrics = Metrics()
+    metrics.observe('encode', 0.25, 100, width = 320)
+    metrics.observe('upload', 0.5, 200)
+
+    eq_(metrics.render(), '\n'.join([
+        '# HELP uploader_stage_seconds Time spent in each pipeline stage.',
+        '# TYPE uploader_stage_seconds summary',
+        'uploader_stage_seconds{stage="encode",width="320",quantile="0.5"} 0.25',
+        'uploader_stage_seconds{stage="encode",width="320",quantile="0.95"} 0.25',
+        'uploader_stage_seconds{stage="encode",width="320",quantile="0.99"} 0.25',
+        'uploader_stage_seconds_sum{stage="encode",width="320"} 0.25',
+        'uploader_stage_seconds_count{stage="encode",width="320"} 1',
+        'uploader_stage_seconds{stage="upload",quantile="0.5"} 0.5',
+        'uploader_stage_seconds{stage="upload",quantile="0.95"} 0.5',
+        'uploader_stage_seconds{stage="upload",quantile="0.99"} 0.5',
+        'uploader_stage_seconds_sum{stage="upload"} 0.5',
+        'uploader_stage_seconds_count{stage="upload"} 1',
+        '# HELP uploader_stage_bytes_total Bytes processed by each pipeline stage.',
+        '# TYPE uploader_stage_bytes_total counter',
+        'uploader_stage_bytes_total{stage="encode",width="320"} 100',
+        'uploader_stage_bytes_total{stage="upload"} 200',
+        '',
+    ]))
@@ -0,0 +1,172 @@
+import html
+import json
+import os
+from unittest.mock import patch, mock_open, Mock
+
+from nose.tools import eq_, raises
+from requests import HTTPError
+
+old_mode = os.environ.get('MODE', None)
+os.environ['MODE'] = 'test'
+
+from notify import Template, compile_template, get_new_posts, render, send_updates
+from server import create_post
+from fixtures import remove_temp_dirs
+from test_posts import make_index
+
+def teardown():
+    remove_temp_dirs()
+    if old_mode:
+        os.environ['MODE'] = old_mode
+    else:
+        del os.environ['MODE']
+
+CONFIG = {
+    'mailgun-from': 'Photos <photos@foo.bar>',
+    'mailgun-bcc': 'me@foo.bar',
+    'mailgun-reply-to': 'me@foo.bar',
+    'mailgun-notifications-url': 'https://api.mailgun.net/v3/foo.bar/messages',
+    'domain': 'foo.bar',
+    'aws-bucket': 'aws.bucket',
+}
+
+def new_post(oid, summary = '', og_image = None):
+    return { 'oid': oid, 'date': '2017-05-05', 'summary': summary, 'og_image': og_image }
+
+def recipient(address, text = '{n} new {post}', html = '<p>{n} new {post}</p>'):
+    return { 'address': address, 'text': text, 'html': html }
+
+@patch('notify.config', CONFIG)
+def test_render():
+    template = '{n} {post} {has} been added, see {it}'
+    eq_(render(template, [ new_post(1) ]), '1 post has been added, see it')
+    eq_(render(template, [ new_post(1), new_post(2), new_post(3) ]), '3 posts have been added, see them')
+
+    # Summaries are journaled by `create_post`, from the escaped subject.
+    index = make_index([])
+    with patch('server.post_index', index), \
+            patch('server.open', mock_open(), create = True):
+        create_post({
+            'oid': 1,
+            'summary': html.escape('Joe & me'),
+            'og_image': '1-1280.jpg',
+            'content': '<img src="1-1280.jpg" />',
+        })
+    new_posts = index.journal() + [ new_post(2) ]
+    eq_(
+        render('{summaries}', new_posts),
+        'Joe & me http://foo.bar/1\nPost #2 http://foo.bar/2',
+    )
+    eq_(
+        render('{thumbnails}', new_posts),
+        '<a href="http://foo.bar/1"><img src="https://aws.bucket.s3.amazonaws.com/1-1280.jpg" alt="Joe &amp; me" width="320" /></a>',
+    )
+
+def test_template():
+    template = Template('{n!r} {post:>6}, see {it}')
+    eq_(template.render({ 'n': 2, 'post': 'posts', 'it': 'them' }), '2  posts, see them')
+
+    # Identical templates are only compiled once.
+    assert compile_template('{n} new') is compile_template('{n} new')
+
+@raises(ValueError)
+def test_template_unknown_field():
+    Template('Hi {name}')
+
+@patch('notify.config', CONFIG)
+@patch('notify.session')
+@patch('notify.Template.render')
+def test_send_updates_render_once(Template_render, session):
+    Template_render.return_value = 'rendered'
+    recipients = [ recipient('a@foo.bar'), recipient('b@foo.bar') ]
+    send_updates(recipients, [ new_post(1) ], mode = 'concurrent')
+
+    # Both recipients share the rendered text and HTML.
+    eq_(Template_render.call_count, 2)
+    eq_(session.post.call_count, 2)
+
+@patch('notify.read_latest', Mock(return_value = None))
+def test_get_new_posts():
+    index = make_index([ '2017-01-16-3.md' ])
+
+    # The notifier starts at the end of the journal.
+    eq_(get_new_posts(index), ( [], 0 ))
+
+    index.add(4, '2017-01-17-4.md', '2017-01-17', 'Hi', '4-1280.jpg')
+    index.add(5, '2017-01-17-5.md', '2017-01-17', 'Hello', '5-1280.jpg')
+    index.add(4, '2017-01-17-4.md', '2017-01-17', 'Hi again', '4-1280.jpg')
+
+    new_posts, offset = get_new_posts(index)
+    eq_([ ( p['oid'], p['summary'] ) for p in new_posts ], [ ( 4, 'Hi again' ), ( 5, 'Hello' ) ])
+    eq_(offset, 3)
+
+    index.set_checkpoint('notify', offset)
+    eq_(get_new_posts(index), ( [], 3 ))
+
+@patch('notify.config', CONFIG)
+@patch('notify.session')
+def test_send_updates_batch(session):
+
+    recipients = [
+        recipient('a@foo.bar'),
+        recipient('b@foo.bar'),
+        recipient('c@foo.bar', text = 'Hi, {n} new {post}'),
+    ]
+    results = send_updates(recipients, [ new_post(1), new_post(2) ], mode = 'batch')
+
+    eq_(results, { 'a@foo.bar': None, 'b@foo.bar': None, 'c@foo.bar': None })
+
+    # Recipients with the same templates are sent to in one call.
+    eq_(session.post.call_count, 2)
+    data = [
+        c[1]['data'] for c in session.post.call_args_list
+        if c[1]['data']['to'] == [ 'a@foo.bar', 'b@foo.bar' ]
+    ][0]
+    eq_(data['text'], '2 new posts')
+    eq_(
+        json.loads(data['recipient-variables']),
+        { 'a@foo.bar': { 'address': 'a@foo.bar' }, 'b@foo.bar': { 'address': 'b@foo.bar' } },
+    )
+
+@patch('notify.config', CONFIG)
+@patch('notify.BATCH_SIZE', 2)
+@patch('notify.session')
+def test_send_updates_batch_size(session):
+    recipients = [ recipient('%d@foo.bar' % i) for i in range(5) ]
+    send_updates(recipients, [ new_post(1) ], mode = 'batch')
+    eq_(
+        sorted(len(c[1]['data']['to']) for c in session.post.call_args_list),
+        [ 1, 2, 2 ],
+    )
+
+@patch('notify.config', CONFIG)
+@patch('notify.session')
+def test_send_updates_concurrent(session):
+
+    def post(url, data):
+        response = Mock()
+        if data['to'] == 'b@foo.bar':
+            response.raise_for_status.side_effect = HTTPError('400')
+        return response
+    session.post.side_effect = post
+
+    recipients = [ recipient('a@foo.bar'), recipient('b@foo.bar'), recipient('c@foo.bar') ]
+    results = send_updates(recipients, [ new_post(1) ], mode = 'concurrent')
+
+    # A failure doesn't stop the other updates from being sent.
+    eq_(session.post.call_count, 3)
+    eq_(results['a@foo.bar'], None)
+    assert isinstance(results['b@foo.bar'], HTTPError)
+    eq_(results['c@foo.bar'], None)
+
+@patch('notify.read_latest', Mock(return_value = 4))
+def test_get_new_posts_latest():
+    index = make_index([ '2017-01-16-3.md' ])
+    index.add(4, '2017-01-17-4.md', '2017-01-17', 'Hi', '4-1280.jpg')
+    index.add(5, '2017-01-17-5.md', '2017-01-17', 'Hello', '5-1280.jpg')
+
+    # The first run picks up after the post in latest.txt, even if posts
+    # were journaled before it.
+    new_posts, offset = get_new_posts(index)
+    eq_([ p['oid'] for p in new_posts ], [ 5 ])
+    eq_(offset, 2)
@@ -0,0 +1,98 @@
+import os
+
+from nose.tools import eq_
+
+from fixtures import make_temp_dir, remove_temp_dirs
+from posts import PostIndex, parse_oid
+
+def teardown():
+    remove_temp_dirs()
+
+def make_index(posts):
+    posts_dir = make_temp_dir()
+    for p in posts:
+        open(os.path.join(posts_dir, p), 'w').close()
+    db_path = os.path.join(make_temp_dir(), 'posts.db')
+    return PostIndex(db_path, posts_dir)
+
+def test_parse_oid():
+    eq_(parse_oid('2017-01-16-3.md'), 3)
+    eq_(parse_oid('2012-05-15-120.md'), 120)
+
+def test_allocate():
+    index = make_index([
+        '2012-05-15-0.md',
+        '2016-11-02-1.md',
+        '2017-01-16-3.md',
+    ])
+    eq_(index.allocate(), 4)
+    eq_(index.allocate(3), 5)
+    eq_(index.allocate(), 8)
+
+    # The counter is persistent.
+    eq_(PostIndex(index.db_path, index.posts_dir).allocate(), 9)
+
+def test_peek():
+    index = make_index([ '2017-01-16-3.md' ])
+    eq_(index.peek(), 4)
+    eq_(index.peek(), 4)
+    eq_(index.allocate(), 4)
+    eq_(index.peek(), 5)
+
+def test_allocate_empty():
+    index = make_index([])
+    eq_(index.allocate(), 0)
+
+def test_add_and_file():
+    index = make_index([ '2017-01-16-3.md' ])
+    eq_(index.file(3), '2017-01-16-3.md')
+    oid = index.allocate()
+    index.add(oid, '2017-01-17-%d.md' % oid)
+    eq_(index.file(4), '2017-01-17-4.md')
+    eq_(index.file(5), None)
+
+def test_journal():
+    index = make_index([])
+    eq_(index.get_checkpoint('reader'), 0)
+
+    index.add(0, '2017-01-17-0.md', '2017-01-17', 'Hi', '0-1280.jpg')
+    index.add(1, '2017-01-17-1.md')
+    eq_(index.journal(), [
+        { 'offset': 1, 'oid': 0, 'date': '2017-01-17', 'summary': 'Hi', 'og_image': '0-1280.jpg' },
+        { 'offset': 2, 'oid': 1, 'date': None, 'summary': '', 'og_image': None },
+    ])
+    eq_([ e['oid'] for e in index.journal(after = 1) ], [ 1 ])
+
+    # New readers start at the end of the journal.
+    eq_(index.get_checkpoint('late-reader'), 2)
+
+    index.set_checkpoint('reader', 1)
+    eq_(index.get_checkpoint('reader'), 1)
+
+def test_checkpoint_after_oid():
+    index = make_index([])
+    index.add(4, '2017-01-17-4.md')
+    index.add(5, '2017-01-17-5.md')
+    index.add(6, '2017-01-17-6.md')
+
+    # A new reader can start after the post it last saw.
+    eq_(index.get_checkpoint('reader', after_oid = 4), 1)
+    eq_(index.get_checkpoint('reader', after_oid = 5), 1)
+    eq_(index.get_checkpoint('caught-up', after_oid = 6), 3)
+    eq_(index.get_checkpoint('behind', after_oid = 2), 0)
+
+def test_rebuild():
+    index = make_index([ '2017-01-16-3.md' ])
+    eq_(index.allocate(), 4)
+
+    # A post written elsewhere is picked up by a rebuild.
+    open(os.path.join(index.posts_dir, '2017-01-17-10.md'), 'w').close()
+    index.rebuild()
+    eq_(index.file(10), '2017-01-17-10.md')
+    eq_(index.allocate(), 11)
+
+    # Rebuilding never hands out an OID again.
+    os.remove(os.path.join(index.posts_dir, '2017-01-17-10.md'))
+    index.rebuild()
+    eq_(index.file(10), None)
+    eq_(index.allocate(), 12)
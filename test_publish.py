@@ -0,0 +1,337 @@
+import os
+import threading
+import time
+from unittest.mock import Mock, DEFAULT
+
+from git import Repo
+from nose.tools import eq_
+
+from fixtures import make_temp_dir, remove_temp_dirs
+from publish import SitePublisher
+
+def teardown():
+    remove_temp_dirs()
+
+def make_blog():
+    """
+    Creates a bare "GitHub" repository and a clone of it to publish from.
+    """
+
+    root = make_temp_dir()
+    origin = Repo.init(os.path.join(root, 'origin.git'), bare = True)
+    blog = Repo.init(os.path.join(root, 'blog'))
+    blog.git.config('user.email', 'test@foo.bar')
+    blog.git.config('user.name', 'Test')
+    blog.git.checkout('-b', 'master')
+    write_post(blog, 0)
+    blog.git.add('_posts')
+    blog.git.commit('-m', 'Add post 0')
+    blog.git.remote('add', 'origin', origin.working_dir)
+    blog.git.push('origin', 'master')
+    return origin, blog
+
+def write_post(blog, oid):
+    posts = os.path.join(blog.working_dir, '_posts')
+    os.makedirs(posts, exist_ok = True)
+    with open(os.path.join(posts, '2017-01-01-%d.md' % oid), 'w') as f:
+        f.write('Post %d\n' % oid)
+
+def log(repo):
+    return repo.git.log('--format=%s', 'master').splitlines()
+
+def test_batch():
+    origin, blog = make_blog()
+    publisher = SitePublisher(blog.git, window = 60, max_posts = 10)
+
+    for oid in [ 1, 2, 3 ]:
+        write_post(blog, oid)
+        publisher.add(oid)
+
+    # Nothing is committed until the batch is flushed.
+    eq_(log(origin), [ 'Add post 0' ])
+
+    publisher.flush()
+    eq_(log(origin), [ 'Add posts 1, 2, 3', 'Add post 0' ])
+
+def test_max_posts():
+    origin, blog = make_blog()
+    publisher = SitePublisher(blog.git, window = 60, max_posts = 2)
+
+    for oid in [ 1, 2, 3 ]:
+        write_post(blog, oid)
+        publisher.add(oid)
+
+    eq_(log(origin), [ 'Add posts 1, 2', 'Add post 0' ])
+    eq_(publisher.pending, [ 3 ])
+
+def test_window():
+    origin, blog = make_blog()
+    publisher = SitePublisher(blog.git, window = 0.1, max_posts = 10)
+
+    write_post(blog, 1)
+    publisher.add(1)
+    time.sleep(0.5)
+
+    eq_(log(origin), [ 'Add post 1', 'Add post 0' ])
+
+def test_no_window():
+    origin, blog = make_blog()
+    publisher = SitePublisher(blog.git, window = 0)
+
+    write_post(blog, 1)
+    publisher.add(1)
+
+    eq_(log(origin), [ 'Add post 1', 'Add post 0' ])
+
+def test_no_window_retry():
+    origin, blog = make_blog()
+    git = Mock(wraps = blog.git)
+    publisher = SitePublisher(git, window = 0, commit_retry = 0.1)
+
+    # The commit fails, e.g. because HEAD was moved by another process, and
+    # is retried in the background.
+    git.commit.side_effect = [ Exception('HEAD has moved'), DEFAULT ]
+    write_post(blog, 1)
+    publisher.add(1)
+
+    eq_(publisher.pending, [ 1 ])
+    time.sleep(0.5)
+    eq_(publisher.pending, [])
+    eq_(log(origin), [ 'Add post 1', 'Add post 0' ])
+
+def test_sync():
+    origin, blog = make_blog()
+    publisher = SitePublisher(Mock(wraps = blog.git))
+
+    # The blog is up to date, so nothing is pulled.
+    eq_(publisher.sync(), False)
+    assert not publisher.git.pull.called
+
+    # Push a new commit from somewhere else.
+    other = Repo.clone_from(origin.working_dir, make_temp_dir())
+    other.git.config('user.email', 'test@foo.bar')
+    other.git.config('user.name', 'Test')
+    write_post(other, 1)
+    other.git.add('_posts')
+    other.git.commit('-m', 'Add post 1')
+    other.git.push('origin', 'master')
+
+    eq_(publisher.sync(), True)
+    publisher.git.pull.assert_called_once_with('--rebase', 'origin', 'master')
+    eq_(log(blog), [ 'Add post 1', 'Add post 0' ])
+
+def test_sync_ahead():
+    origin, blog = make_blog()
+    publisher = SitePublisher(Mock(wraps = blog.git))
+
+    # A local commit that hasn't been pushed yet doesn't need a pull.
+    write_post(blog, 1)
+    blog.git.add('_posts')
+    blog.git.commit('-m', 'Add post 1')
+
+    eq_(publisher.sync(), False)
+    assert not publisher.git.pull.called
+
+def test_sync_diverged():
+    origin, blog = make_blog()
+    publisher = SitePublisher(blog.git)
+
+    # A commit is waiting to be pushed when GitHub gets another one.
+    write_post(blog, 1)
+    blog.git.add('_posts')
+    blog.git.commit('-m', 'Add post 1')
+
+    other = Repo.clone_from(origin.working_dir, make_temp_dir())
+    other.git.config('user.email', 'test@foo.bar')
+    other.git.config('user.name', 'Test')
+    write_post(other, 2)
+    other.git.add('_posts')
+    other.git.commit('-m', 'Add post 2')
+    other.git.push('origin', 'master')
+
+    # The local commit is rebased onto GitHub's, rather than merged.
+    eq_(publisher.sync(), True)
+    eq_(log(blog), [ 'Add post 1', 'Add post 2', 'Add post 0' ])
+
+class FakeIndex:
+
+    def file(self, oid):
+        return '2017-01-01-%d.md' % oid if oid < 100 else None
+
+def test_write_commit():
+    origin, blog = make_blog()
+    git = Mock(wraps = blog.git, working_dir = blog.working_dir)
+    publisher = SitePublisher(git, window = 0, post_index = FakeIndex())
+
+    for oid in [ 1, 2 ]:
+        write_post(blog, oid)
+    publisher.add(1, 2)
+
+    # The posts are committed without `git add` or `git commit`.
+    eq_(log(origin), [ 'Add posts 1, 2', 'Add post 0' ])
+    assert not publisher.git.add.called
+    assert not publisher.git.commit.called
+    eq_(blog.git.status('--porcelain'), '')
+    eq_(
+        blog.git.show('--name-only', '--format=', 'HEAD').splitlines(),
+        [ '_posts/2017-01-01-1.md', '_posts/2017-01-01-2.md' ],
+    )
+
+    # Rewritten posts are committed too.
+    with open(os.path.join(blog.working_dir, '_posts', '2017-01-01-1.md'), 'w') as f:
+        f.write('Post 1, again\n')
+    publisher.commit([ 1 ], 'Rewrite post 1')
+    eq_(log(origin)[0], 'Rewrite post 1')
+    eq_(blog.git.status('--porcelain'), '')
+    eq_(blog.git.show('HEAD:_posts/2017-01-01-1.md'), 'Post 1, again')
+
+    # The objects are valid.
+    blog.git.fsck('--strict')
+
+def test_write_commit_race():
+    origin, blog = make_blog()
+    git = Mock(wraps = blog.git, working_dir = blog.working_dir)
+    publisher = SitePublisher(git, window = 60, post_index = FakeIndex())
+    write_post(blog, 1)
+    publisher.add(1)
+
+    # Another process (e.g. `backfill.py`) commits while the tree is written.
+    write_tree = publisher.write_tree
+    def other_commit(*args):
+        write_post(blog, 2)
+        blog.git.add('_posts/2017-01-01-2.md')
+        blog.git.commit('-m', 'Add post 2')
+        return write_tree(*args)
+    publisher.write_tree = Mock(side_effect = other_commit)
+
+    # The other commit isn't overwritten, and the post is kept for later.
+    publisher.flush()
+    eq_(log(blog), [ 'Add post 2', 'Add post 0' ])
+    eq_(publisher.pending, [ 1 ])
+
+    publisher.write_tree = write_tree
+    publisher.flush()
+    eq_(log(origin), [ 'Add post 1', 'Add post 2', 'Add post 0' ])
+    blog.git.fsck('--strict')
+
+def test_write_commit_fallback():
+    origin, blog = make_blog()
+    git = Mock(wraps = blog.git, working_dir = blog.working_dir)
+    publisher = SitePublisher(git, window = 0, post_index = FakeIndex())
+
+    # Posts that aren't in the index are committed the slow way.
+    write_post(blog, 100)
+    publisher.add(100)
+
+    eq_(log(origin), [ 'Add post 100', 'Add post 0' ])
+    publisher.git.add.assert_called_once_with('_posts')
+
+def test_background_push():
+    origin, blog = make_blog()
+    git = Mock(wraps = blog.git)
+    publisher = SitePublisher(git, window = 0, push_delay = 0.2)
+
+    for oid in [ 1, 2 ]:
+        write_post(blog, oid)
+        publisher.add(oid)
+
+    # The commits are pushed together, once they stop coming.
+    eq_(log(origin), [ 'Add post 0' ])
+    time.sleep(0.6)
+    eq_(log(origin), [ 'Add post 2', 'Add post 1', 'Add post 0' ])
+    eq_(git.push.call_count, 1)
+
+def test_background_push_unlocked():
+    origin, blog = make_blog()
+    git = Mock(wraps = blog.git)
+    on_push = Mock()
+    publisher = SitePublisher(git, window = 0, push_delay = 60, on_push = on_push)
+    write_post(blog, 1)
+    publisher.add(1)
+
+    # Posts can be committed while a push is in progress. They're left for
+    # the next push.
+    def push(*args):
+        write_post(blog, 2)
+        thread = threading.Thread(target = publisher.add, args = ( 2, ))
+        thread.start()
+        thread.join(5)
+        assert not thread.is_alive()
+        return blog.git.push(*args)
+    git.push.side_effect = push
+
+    assert publisher.pusher.push()
+    eq_(log(origin), [ 'Add post 1', 'Add post 0' ])
+    on_push.assert_called_once_with([ 1 ])
+    eq_(publisher.pusher.unpushed, [ 2 ])
+
+    git.push.side_effect = None
+    publisher.close()
+    eq_(log(origin), [ 'Add post 2', 'Add post 1', 'Add post 0' ])
+    on_push.assert_called_with([ 2 ])
+
+def test_background_push_rebase():
+    origin, blog = make_blog()
+    publisher = SitePublisher(blog.git, window = 0, push_delay = 60)
+
+    # Push a new commit from somewhere else.
+    other = Repo.clone_from(origin.working_dir, make_temp_dir())
+    other.git.config('user.email', 'test@foo.bar')
+    other.git.config('user.name', 'Test')
+    write_post(other, 1)
+    other.git.add('_posts')
+    other.git.commit('-m', 'Add post 1')
+    other.git.push('origin', 'master')
+
+    # The push is rejected, so the post is rebased onto the new commit.
+    write_post(blog, 2)
+    publisher.add(2)
+    assert publisher.pusher.push()
+    eq_(log(origin), [ 'Add post 2', 'Add post 1', 'Add post 0' ])
+    eq_(publisher.pusher.timer, None)
+
+def test_background_push_retry():
+    origin, blog = make_blog()
+    git = Mock(wraps = blog.git)
+    publisher = SitePublisher(git, window = 0, push_delay = 60, push_retry = 0.1)
+
+    # The first push fails, e.g. because GitHub can't be reached.
+    git.push.side_effect = [ Exception('Connection timed out'), DEFAULT ]
+    write_post(blog, 1)
+    publisher.add(1)
+
+    assert not publisher.pusher.push()
+    eq_(log(origin), [ 'Add post 0' ])
+    time.sleep(0.5)
+    eq_(log(origin), [ 'Add post 1', 'Add post 0' ])
+    eq_(git.push.call_count, 2)
+
+def test_close():
+    origin, blog = make_blog()
+    publisher = SitePublisher(blog.git, window = 60, push_delay = 60)
+
+    write_post(blog, 1)
+    publisher.add(1)
+    publisher.close()
+
+    eq_(log(origin), [ 'Add post 1', 'Add post 0' ])
+
+def test_callbacks():
+    origin, blog = make_blog()
+    on_commit = Mock()
+    on_push = Mock()
+    publisher = SitePublisher(
+        blog.git,
+        window = 0,
+        push_delay = 60,
+        on_commit = on_commit,
+        on_push = on_push,
+    )
+
+    write_post(blog, 1)
+    publisher.add(1)
+    on_commit.assert_called_once_with([ 1 ])
+    assert not on_push.called
+
+    publisher.close()
+    on_push.assert_called_once_with([ 1 ])
@@ -0,0 +1,53 @@
+import os
+from unittest.mock import patch, Mock
+
+from nose.tools import eq_
+
+from fixtures import make_temp_dir, remove_temp_dirs
+from replay import ReplayCache, SQLiteReplayCache
+
+def teardown():
+    remove_temp_dirs()
+
+def test_add():
+    cache = ReplayCache()
+    eq_(cache.add('abc'), True)
+    eq_(cache.add('def'), True)
+    eq_(cache.add('abc'), False)
+
+def test_expiry():
+    cache = ReplayCache(ttl = 60)
+
+    with patch('time.monotonic', Mock(return_value = 100)):
+        cache.add('abc')
+    with patch('time.monotonic', Mock(return_value = 130)):
+        cache.add('def')
+        eq_(cache.add('abc'), False)
+
+    # Expired tokens are forgotten.
+    with patch('time.monotonic', Mock(return_value = 161)):
+        eq_(cache.add('ghi'), True)
+        eq_(len(cache), 2)
+        eq_(cache.add('abc'), True)
+
+def test_max_entries():
+    cache = ReplayCache(max_entries = 2)
+    for token in [ 'a', 'b', 'c' ]:
+        cache.add(token)
+    eq_(len(cache), 2)
+    eq_(cache.add('c'), False)
+
+def test_sqlite():
+    path = os.path.join(make_temp_dir(), 'replay.db')
+    cache = SQLiteReplayCache(path, ttl = 60)
+
+    with patch('time.time', Mock(return_value = 100)):
+        eq_(cache.add('abc'), True)
+        eq_(cache.add('abc'), False)
+
+        # Other processes see the same tokens.
+        eq_(SQLiteReplayCache(path).add('abc'), False)
+
+    with patch('time.time', Mock(return_value = 161)):
+        eq_(len(cache), 0)
+        eq_(cache.add('abc'), True)
@@ -1,11 +1,24 @@
 import datetime
+import hashlib
+import hmac
+import html
 import json
 import os
-from unittest.mock import patch, mock_open, Mock, call, DEFAULT
+import tempfile
+import time
+from concurrent.futures.process import BrokenProcessPool
+from configparser import ConfigParser
+from io import BytesIO
+from unittest.mock import patch, mock_open, Mock, call, ANY, DEFAULT
 
 from nose.tools import eq_, raises, assert_raises
+from botocore.exceptions import ClientError
 from PIL import Image
 
+from dedup import RenditionCache
+from fixtures import make_temp_dir, remove_temp_dirs
+from replay import ReplayCache
+
 old_mode = os.environ.get('MODE', None)
 os.environ['MODE'] = 'test'
 
@@ -14,16 +27,31 @@ from server import (
     download_attachments,
     get_new_oid,
     get_img_data,
+    hash_file,
+    rendition_profile,
+    find_renditions,
+    get_rendition_formats,
+    get_encoder_options,
     delete,
     upload_files,
     autolink_posts,
     resize_image,
+    draft_image,
+    flatten_image,
+    make_renditions,
+    save_images,
     create_img_tag,
     process_image,
     create_post,
+    process_upload,
+    queue_upload,
+    UploadRejected,
+    Download,
 )
+import server
 
 def teardown():
+    remove_temp_dirs()
     if old_mode:
         os.environ['MODE'] = old_mode
     else:
@@ -57,8 +85,31 @@ def test_verify_mailgun_request_duplicate_token():
             'e473b85d8eaa5c71f2574dd81f42b7b478d1a320515d337ca8c7022419aacb84',
         )
 
-        expected_msg = 'Mailgun token is identical to the previous one'
-        assert str(err.exception) == expected_msg
+    eq_(str(err.exception), 'Mailgun token has already been used')
+
+def sign(timestamp, token):
+    message = (timestamp + token).encode('utf-8')
+    return hmac.new(server.MAILGUN_KEY, message, hashlib.sha256).hexdigest()
+
+@patch('time.time', Mock(return_value = 1501718220))
+@patch('server.replay_cache', ReplayCache())
+def test_verify_mailgun_request_replay():
+
+    verify_mailgun_request('1501718219', 'aaa', sign('1501718219', 'aaa'))
+    verify_mailgun_request('1501718219', 'bbb', sign('1501718219', 'bbb'))
+
+    # Any token seen in the last minute is rejected, not just the last one.
+    assert_raises(
+        ValueError,
+        verify_mailgun_request,
+        '1501718219',
+        'aaa',
+        sign('1501718219', 'aaa'),
+    )
+
+    # Requests with bad signatures don't use up tokens.
+    assert_raises(ValueError, verify_mailgun_request, '1501718219', 'ccc', 'bad')
+    verify_mailgun_request('1501718219', 'ccc', sign('1501718219', 'ccc'))
 
 def test_verify_mailgun_request_expired_timestamp():
 
@@ -71,8 +122,16 @@ def test_verify_mailgun_request_expired_timestamp():
             'e787eb21731cf1888e078796224c23c3327497668e0a83a23bcda76b19b23c20',
         )
 
-        expected_msg = 'Mailgun timestamp is older than 60 seconds'
-        assert str(err.exception) == expected_msg
+    eq_(str(err.exception), 'Mailgun timestamp is more than 60 seconds from now')
+
+@patch('time.time', Mock(return_value = 1501718220))
+def test_verify_mailgun_request_future_timestamp():
+
+    # This timestamp is more than 60s in the future.
+    with assert_raises(ValueError) as err:
+        verify_mailgun_request('1501718281', 'ddd', sign('1501718281', 'ddd'))
+
+    eq_(str(err.exception), 'Mailgun timestamp is more than 60 seconds from now')
 
 @patch('time.time', Mock(return_value = 1501718220))
 def test_verify_mailgun_request_invalid_signature():
@@ -88,22 +147,156 @@ def test_verify_mailgun_request_invalid_signature():
         expected_msg = 'Computed signature does not match request signature'
         assert str(err.exception) == expected_msg
 
-@patch('requests.get')
-@patch('server.open', mock_open(), create = True)
-def test_successful_download_attachments(_):
+def mock_response(*chunks, **headers):
+    response = Mock(headers = headers)
+    response.iter_content.return_value = iter(chunks)
+    return response
 
+@patch('server.mailgun')
+@patch('server.TEMP_PATH', new_callable = make_temp_dir)
+def test_successful_download_attachments(temp_path, mailgun):
+
+    mailgun.get.return_value = mock_response(b'abc', b'def')
     attachments = json.dumps([{
         'url': 'http://download.attachment/successful-image.jpg',
         'name': 'successful-image.jpg',
         'content-type': 'image/jpeg',
     }])
 
-    save_path, content_type = download_attachments(attachments)
+    [ download ] = download_attachments(attachments)
+
+    eq_(download.source, os.path.join(temp_path, '0-successful-image.jpg'))
+    eq_(download.content_type, 'image/jpeg')
+    eq_(download.digest, hashlib.sha256(b'abcdef').hexdigest())
+    eq_(download.image, None)
+    with open(download.source, 'rb') as f:
+        eq_(f.read(), b'abcdef')
+
+    mailgun.get.assert_called_once_with(
+        'http://download.attachment/successful-image.jpg',
+        stream = True,
+    )
+
+@patch('server.mailgun')
+@patch('server.TEMP_PATH', new_callable = make_temp_dir)
+def test_download_multiple_attachments(temp_path, mailgun):
+
+    mailgun.get.side_effect = lambda *args, **kwargs: mock_response(b'abc')
+    attachments = json.dumps([
+        {
+            'url': 'http://download.attachment/image.jpeg',
+            'name': 'image.jpeg',
+            'content-type': 'image/jpeg',
+        },
+        {
+            'url': 'http://download.attachment/signature.txt',
+            'name': 'signature.txt',
+            'content-type': 'text/plain',
+        },
+        {
+            'url': 'http://download.attachment/image.jpeg',
+            'name': 'image.jpeg',
+            'content-type': 'image/png',
+        },
+    ])
+
+    downloads = download_attachments(attachments)
+
+    eq_([ ( d.source, d.content_type ) for d in downloads ], [
+        ( os.path.join(temp_path, '0-image.jpeg'), 'image/jpeg' ),
+        ( os.path.join(temp_path, '1-image.jpeg'), 'image/png' ),
+    ])
+    eq_(mailgun.get.call_count, 2)
+
+@patch('server.IN_MEMORY', True)
+@patch('server.mailgun')
+def test_download_attachments_in_memory(mailgun):
+
+    mailgun.get.return_value = mock_response(b'abc', b'def')
+    attachments = json.dumps([{
+        'url': 'http://download.attachment/successful-image.jpg',
+        'name': 'successful-image.jpg',
+        'content-type': 'image/jpeg',
+    }])
+
+    [ download ] = download_attachments(attachments)
+
+    eq_(download.source.read(), b'abcdef')
+    eq_(download.content_type, 'image/jpeg')
+
+@patch('server.IN_MEMORY', True)
+@patch('server.MAX_ATTACHMENT_BYTES', 4)
+@patch('server.mailgun')
+def test_download_attachments_too_large(mailgun):
+
+    attachments = json.dumps([{
+        'url': 'http://download.attachment/huge-image.jpg',
+        'name': 'huge-image.jpg',
+        'content-type': 'image/jpeg',
+    }])
+
+    # Rejected by its Content-Length...
+    mailgun.get.return_value = mock_response(**{ 'Content-Length': '5' })
+    assert_raises(ValueError, download_attachments, attachments)
+    assert not mailgun.get.return_value.iter_content.called
+
+    # ...or once too much has been downloaded.
+    mailgun.get.return_value = mock_response(b'abc', b'def')
+    assert_raises(ValueError, download_attachments, attachments)
+
+@patch('server.IN_MEMORY', True)
+@patch('server.INCREMENTAL_DECODE', True)
+@patch('server.mailgun')
+def test_download_attachments_incremental_decode(mailgun):
+
+    img = Image.new('RGB', size = (64, 48), color = 'red')
+    f = BytesIO()
+    img.save(f, 'JPEG')
+    data = f.getvalue()
+
+    mailgun.get.return_value = mock_response(
+        *[ data[i:i + 100] for i in range(0, len(data), 100) ]
+    )
+    attachments = json.dumps([{
+        'url': 'http://download.attachment/image.jpg',
+        'name': 'image.jpg',
+        'content-type': 'image/jpeg',
+    }])
+
+    [ download ] = download_attachments(attachments)
+
+    eq_(download.image.size, (64, 48))
+    eq_(download.source.read(), data)
 
-    eq_(save_path, '/tmp/successful-image.jpg')
-    eq_(content_type, 'image/jpeg')
+@patch('server.download_attachment')
+def test_download_attachments_failure(download_attachment):
+    source = Mock()
+    def download(url, save_path):
+        if url.endswith('bad-image.jpg'):
+            raise ValueError('Attachment is too large')
+        time.sleep(0.1)
+        return source, 'digest', None
+    download_attachment.side_effect = download
 
-@raises(IndexError)
+    attachments = json.dumps([
+        {
+            'url': 'http://download.attachment/bad-image.jpg',
+            'name': 'bad-image.jpg',
+            'content-type': 'image/jpeg',
+        },
+        {
+            'url': 'http://download.attachment/slow-image.jpg',
+            'name': 'slow-image.jpg',
+            'content-type': 'image/jpeg',
+        },
+    ])
+
+    # The error is raised once the other download has finished, and its file
+    # is closed.
+    assert_raises(ValueError, download_attachments, attachments)
+    source.close.assert_called_once_with()
+
+@raises(ValueError)
 def test_download_attachments_no_attachment():
     attachments = json.dumps([])
     download_attachments(attachments)
@@ -117,28 +310,73 @@ def test_download_attachments_wront_type():
 
     with assert_raises(ValueError) as err:
         download_attachments(attachments)
-        assert str(err.exception) == "Unsupported file type 'text/plain'"
-
-@patch('server.listdir', Mock(return_value = [
-    '2012-05-15-0.md',
-    '2016-11-02-1.md',
-    '2017-01-16-3.md',
-]))
-def test_get_new_oid():
+        assert str(err.exception) == 'No image attachments'
+
+@patch('server.jobs')
+@patch('server.verify_mailgun_request')
+def test_queue_upload(verify_mailgun_request, jobs):
+    attachments = json.dumps([{
+        'url': 'http://download.attachment/image.jpg',
+        'name': 'image.jpg',
+        'content-type': 'image/jpeg',
+    }])
+    forms = {
+        'from': 'joe@foo.bar',
+        'timestamp': '1501718220',
+        'token': 'abc',
+        'signature': 'def',
+        'Message-Id': '<abc@foo.bar>',
+        'subject': 'Hi',
+        'attachments': attachments,
+    }
+    jobs.put.return_value = 7
+
+    eq_(queue_upload(forms), 7)
+    verify_mailgun_request.assert_called_once_with('1501718220', 'abc', 'def')
+    jobs.put.assert_called_once_with({
+        'message_id': '<abc@foo.bar>',
+        'subject': 'Hi',
+        'attachments': attachments,
+    })
+
+    # Unauthorized senders and emails without images are rejected.
+    assert_raises(UploadRejected, queue_upload, dict(forms, **{ 'from': 'joe@bar.baz' }))
+    assert_raises(UploadRejected, queue_upload, dict(forms, attachments = '[]'))
+    eq_(jobs.put.call_count, 1)
+
+@patch('server.post_index')
+def test_get_new_oid(post_index):
+    post_index.allocate.return_value = 4
     eq_(get_new_oid(), 4)
 
+@patch('server.DRY', True)
+@patch('server.post_index')
+def test_get_new_oid_dry(post_index):
+
+    # Dry runs don't use up post numbers.
+    post_index.peek.return_value = 4
+    eq_(get_new_oid(2), 4)
+    assert not post_index.allocate.called
+
 def test_get_img_data():
     img = Mock()
-    img._getexif = Mock(return_value = { 274: 3, 306: '2015:04:02' })
+    img.getexif = Mock(return_value = {
+        271: 'Apple',
+        274: 3,
+        306: '2015:04:02',
+    })
     exif = get_img_data(img)
     eq_(exif, { 'Orientation': 3, 'DateTime': '2015:04:02' })
 
 def test_get_img_data_no_data():
     img = Mock()
-    img._getexif = Mock(side_effect = AttributeError)
+    img.getexif = Mock(return_value = {})
     exif = get_img_data(img)
     eq_(exif, {})
 
+    # Images that can't have EXIF data have none.
+    eq_(get_img_data(Image.new('RGBA', (10, 10))), {})
+
 @patch('server.remove')
 def test_delete(remove):
     delete('1', '2', '3')
@@ -149,23 +387,56 @@ def test_delete(remove):
 def test_delete_error():
     delete('os error')
 
-@patch('server.open', mock_open(), create = True)
-@patch('botocore.client.BaseClient._make_api_call')
-def test_upload_files(put_object):
-    files = [ '/tmp/a.jpg', '/tmp/b.jpg', '/tmp/c.jpg' ]
-    upload_files(*files)
+@patch('server.S3')
+def test_upload_files(S3):
+    files = []
+    for contents in [ b'a', b'bb', b'ccc' ]:
+        fd, path = tempfile.mkstemp(suffix = '.jpg', dir = make_temp_dir())
+        os.write(fd, contents)
+        os.close(fd)
+        files.append(path)
+
+    results = upload_files(*files)
+
     for i, f in enumerate(files):
-        op, args = put_object.call_args_list[i][0]
-        eq_(op, 'PutObject')
+        key = os.path.basename(f)
+        S3.upload_file.assert_any_call(
+            f,
+            'aws.bucket',
+            key,
+            ExtraArgs = { 'ACL': 'public-read', 'ContentType': 'image/jpeg' },
+            Config = ANY,
+        )
+        eq_(results[i]['key'], key)
+        eq_(results[i]['bytes'], i + 1)
+
+@patch('server.S3')
+def test_upload_files_in_memory(S3):
+    f = BytesIO(b'abcd')
+    f.seek(2)
+
+    results = upload_files(( 'a.webp', f ))
 
-        # Ignore the 'Body' arg, which is a `MagicMock` object.
-        del args['Body']
+    S3.upload_fileobj.assert_called_once_with(
+        f,
+        'aws.bucket',
+        'a.webp',
+        ExtraArgs = { 'ACL': 'public-read', 'ContentType': 'image/webp' },
+        Config = ANY,
+    )
+    eq_(results[0]['bytes'], 4)
+
+@patch('server.S3')
+def test_upload_files_retry(S3):
+    fd, path = tempfile.mkstemp(suffix = '.jpg', dir = make_temp_dir())
+    os.close(fd)
+
+    S3.upload_file.side_effect = [ OSError, None ]
+    upload_files(path)
+    eq_(S3.upload_file.call_count, 2)
 
-        eq_(args, {
-            'Bucket': 'aws.bucket',
-            'Key': os.path.basename(f),
-            'ACL': 'public-read',
-        })
+    S3.upload_file.side_effect = OSError
+    assert_raises(OSError, upload_files, path)
 
 def test_autolink_posts():
 
@@ -198,6 +469,133 @@ def test_resize_image():
     assert resized[2].size == (720, 960)
     assert resized[3].size == (960, 1280)
 
+def test_resize_image_small():
+
+    # Sizes that would scale the image up are skipped...
+    img = Image.new('RGB', size = (800, 600))
+    eq_([ r.size for r in resize_image(img, {}) ], [ (320, 240), (640, 480) ])
+
+    # ...unless there are none left.
+    img = Image.new('RGB', size = (200, 100))
+    eq_([ r.size for r in resize_image(img, {}) ], [ (200, 100) ])
+
+    with patch('server.UPSCALE', True):
+        eq_(len(resize_image(img, {})), 4)
+
+@patch('server.RENDITION_WIDTHS', [ 480.0, 1600.0 ])
+def test_resize_image_widths():
+    img = Image.new('RGB', size = (2000, 1000))
+    eq_([ r.size for r in resize_image(img, {}) ], [ (480, 240), (1600, 800) ])
+
+def test_resize_image_orientation():
+
+    # The top-left corner is marked, to check which way the image is turned.
+    img = Image.new('L', size = (1600, 1200))
+    img.paste(255, (0, 0, 800, 600))
+
+    # Orientation 6 means the image must be rotated clockwise, which moves the
+    # mark to the top-right corner.
+    resized = resize_image(img, { 'Orientation': 6 })[0]
+    eq_(resized.size, (240, 320))
+    eq_(resized.getpixel((200, 40)), 255)
+    eq_(resized.getpixel((40, 40)), 0)
+
+    resized = resize_image(img, { 'Orientation': 3 })[0]
+    eq_(resized.getpixel((300, 200)), 255)
+    eq_(resized.getpixel((40, 40)), 0)
+
+    resized = resize_image(img, { 'Orientation': 8 })[0]
+    eq_(resized.getpixel((40, 280)), 255)
+    eq_(resized.getpixel((40, 40)), 0)
+
+def test_resize_image_cascade():
+
+    img = Mock(size = (2000, 1000))
+    resized = resize_image(img, {})
+
+    # Each size is made from the next larger one.
+    img.resize.assert_called_once_with((1280, 640), Image.LANCZOS)
+    eq_(resized[3], img.resize.return_value)
+    resized[3].resize.assert_called_once_with((960, 480), Image.LANCZOS)
+    eq_(resized[2], resized[3].resize.return_value)
+
+def test_draft_image():
+
+    img = Mock(size = (4000, 3000), mode = 'RGB')
+    draft_image(img, 1280)
+    img.draft.assert_called_once_with('RGB', (1280, 960))
+
+    # Images that are already small enough aren't drafted.
+    img = Mock(size = (1000, 800), mode = 'RGB')
+    draft_image(img, 1280)
+    assert not img.draft.called
+
+def test_flatten_image():
+    img = Image.new('RGB', (10, 10))
+    assert flatten_image(img) is img
+
+    # Transparent areas become white.
+    img = Image.new('RGBA', (10, 10), (0, 0, 0, 0))
+    img.putpixel((0, 0), (255, 0, 0, 255))
+    flat = flatten_image(img)
+    eq_(flat.mode, 'RGB')
+    eq_(flat.getpixel((0, 0)), (255, 0, 0))
+    eq_(flat.getpixel((5, 5)), (255, 255, 255))
+
+    eq_(flatten_image(Image.new('CMYK', (10, 10))).mode, 'RGB')
+
+def test_make_renditions_transparent():
+    img = Image.new('RGBA', (400, 300), (0, 0, 0, 0))
+    widths, paths = make_renditions(
+        img,
+        {},
+        'logo',
+        [ 'JPEG' ],
+        make_temp_dir(),
+        in_memory = False,
+    )
+
+    # Rather than failing to save it as a JPEG.
+    assert paths
+    for path in paths:
+        eq_(Image.open(path).mode, 'RGB')
+
+def test_save_images():
+
+    img = Image.new('RGB', size = (64, 48), color = 'red')
+    paths = [ os.path.join(make_temp_dir(), '%d.jpg' % i) for i in range(2) ]
+    save_images([ img, img.resize((32, 24)) ], paths)
+
+    eq_(Image.open(paths[0]).size, (64, 48))
+    eq_(Image.open(paths[1]).size, (32, 24))
+
+    buffers = [ BytesIO(), BytesIO() ]
+    save_images([ img, img.resize((32, 24)) ], buffers)
+
+    eq_(Image.open(buffers[1]).size, (32, 24))
+
+    buffers = [ BytesIO(), BytesIO() ]
+    save_images([ img, img ], buffers, [ 'JPEG', 'WEBP' ])
+
+    eq_(Image.open(buffers[0]).format, 'JPEG')
+    eq_(Image.open(buffers[1]).format, 'WEBP')
+
+@patch('server.ENCODE_PROCESSES', 2)
+def test_save_images_broken_pool():
+    broken = Mock()
+    broken.submit.side_effect = BrokenProcessPool('A process died')
+
+    # The broken pool is replaced, and the images are encoded in the new one.
+    with patch('server.encode_pool', broken):
+        buffers = [ BytesIO(), BytesIO() ]
+        img = Image.new('RGB', size = (64, 48), color = 'red')
+        save_images([ img, img ], buffers)
+
+        eq_(Image.open(buffers[1]).size, (64, 48))
+        broken.shutdown.assert_called_once_with(wait = False)
+        assert server.encode_pool is not broken
+        server.encode_pool.shutdown()
+
 def test_create_image_tag():
 
     SPECS = [
@@ -209,31 +607,93 @@ def test_create_image_tag():
             ( 888, [ 200, 400, 600, 800 ], 'Summary' ),
             '<img src="{{ site.assets_url }}/888-400.jpg" srcset="{{ site.assets_url }}/888-200.jpg 200w, {{ site.assets_url }}/888-400.jpg 400w, {{ site.assets_url }}/888-600.jpg 600w, {{ site.assets_url }}/888-800.jpg 800w" sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" alt="{{ page.summary }}" />',
         ),
+        (
+            ( '999-1', [ 200, 400, 600, 800 ], '' ),
+            '<img src="{{ site.assets_url }}/999-1-400.jpg" srcset="{{ site.assets_url }}/999-1-200.jpg 200w, {{ site.assets_url }}/999-1-400.jpg 400w, {{ site.assets_url }}/999-1-600.jpg 600w, {{ site.assets_url }}/999-1-800.jpg 800w" sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" />',
+        ),
     ]
 
     for args, expected in SPECS:
         yield eq_, create_img_tag(*args), expected
 
+def test_create_image_tag_widths():
+
+    eq_(
+        create_img_tag(5, [ 300, 600 ], ''),
+        '<img src="{{ site.assets_url }}/5-600.jpg" srcset="{{ site.assets_url }}/5-300.jpg 300w, {{ site.assets_url }}/5-600.jpg 600w" sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" />',
+    )
+    eq_(
+        create_img_tag(5, [ 200 ], ''),
+        '<img src="{{ site.assets_url }}/5-200.jpg" srcset="{{ site.assets_url }}/5-200.jpg 200w" sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)" />',
+    )
+
+def test_get_encoder_options():
+
+    parser = ConfigParser()
+    parser.read_dict({ 'test': {
+        'jpeg-quality': '90',
+        'jpeg-subsampling': '4:4:4',
+        'jpeg-progressive': 'no',
+    } })
+
+    with patch('server.config', parser['test']):
+        eq_(
+            get_encoder_options('JPEG', quality = 75, optimize = True, progressive = True),
+            {
+                'quality': 90,
+                'subsampling': '4:4:4',
+                'optimize': True,
+                'progressive': False,
+            },
+        )
+        eq_(get_encoder_options('WEBP', quality = 80), { 'quality': 80 })
+
+def test_create_image_tag_formats():
+
+    tag = create_img_tag(7, [ 300, 500, 700, 900 ], '', [ 'JPEG', 'WEBP', 'AVIF' ])
+    sizes = 'sizes="(min-width: 700px) 50vw, calc(100vw - 2rem)"'
+
+    # Browsers use the first <source> they support, so AVIF comes first and
+    # the JPEG <img> comes last.
+    eq_(
+        tag,
+        '<picture>'
+        '<source type="image/avif" srcset="{{ site.assets_url }}/7-300.avif 300w, {{ site.assets_url }}/7-500.avif 500w, {{ site.assets_url }}/7-700.avif 700w, {{ site.assets_url }}/7-900.avif 900w" ' + sizes + ' />'
+        '<source type="image/webp" srcset="{{ site.assets_url }}/7-300.webp 300w, {{ site.assets_url }}/7-500.webp 500w, {{ site.assets_url }}/7-700.webp 700w, {{ site.assets_url }}/7-900.webp 900w" ' + sizes + ' />'
+        + create_img_tag(7, [ 300, 500, 700, 900 ], '') +
+        '</picture>',
+    )
+
+@patch('server.config', { 'formats': 'webp, tiff, jpeg' })
+def test_get_rendition_formats():
+    eq_(get_rendition_formats(), [ 'JPEG', 'WEBP' ])
+
 @patch('PIL.Image.open')
 @patch.multiple(
     'server',
     create_img_tag = DEFAULT,
     upload_files = DEFAULT,
     delete = DEFAULT,
+    save_images = DEFAULT,
     resize_image = DEFAULT,
     get_img_data = DEFAULT,
+    hash_file = DEFAULT,
 )
 def test_process_image(
     Image_open,
     get_img_data,
     resize_image,
+    save_images,
     delete,
     upload_files,
     create_img_tag,
+    hash_file,
 ):
 
     # Setup
 
+    Image_open.return_value.size = (3000, 2000)
+
     get_img_data.return_value = { 'DateTime': '2017:05:05 13:21:05' }
 
     resized = [
@@ -255,10 +715,17 @@ def test_process_image(
 
     Image_open.assert_called_once_with('/path/to/file.jpg')
 
-    resized[0].save.assert_called_once_with('/tmp/111-150.jpg')
-    resized[1].save.assert_called_once_with('/tmp/111-200.jpg')
-    resized[2].save.assert_called_once_with('/tmp/111-300.jpg')
-    resized[3].save.assert_called_once_with('/tmp/111-500.jpg')
+    Image_open.return_value.draft.assert_called_once_with(
+        Image_open.return_value.mode,
+        (1280, 854),
+    )
+
+    save_images.assert_called_once_with(resized, [
+        '/tmp/111-150.jpg',
+        '/tmp/111-200.jpg',
+        '/tmp/111-300.jpg',
+        '/tmp/111-500.jpg',
+    ], [ 'JPEG' ] * 4)
 
     upload_files.assert_called_once_with(
         '/tmp/111-150.jpg',
@@ -283,6 +750,86 @@ def test_process_image(
         'content': '<img src="111.jpg" />',
     }
 
+@patch('PIL.Image.open')
+@patch.multiple(
+    'server',
+    rendition_cache = DEFAULT,
+    upload_files = DEFAULT,
+    delete = DEFAULT,
+    resize_image = DEFAULT,
+    get_img_data = DEFAULT,
+    hash_file = DEFAULT,
+    archive = DEFAULT,
+)
+def test_process_image_cached(Image_open, **mocks):
+
+    mocks['hash_file'].return_value = 'c0ffee'
+    mocks['get_img_data'].return_value = {}
+    mocks['rendition_cache'].get.return_value = (
+        '42',
+        [ 320, 640, 960, 1280 ],
+        [ 'JPEG' ],
+    )
+
+    post_object = { 'oid': 111, 'summary': '' }
+    process_image(post_object, '/path/to/file.jpg')
+
+    # The renditions of post #42 are reused.
+    mocks['rendition_cache'].get.assert_called_once_with('c0ffee', rendition_profile())
+    assert not mocks['resize_image'].called
+    assert not mocks['upload_files'].called
+    mocks['delete'].assert_called_once_with('/path/to/file.jpg')
+    mocks['archive'].put.assert_called_once_with('c0ffee', '/path/to/file.jpg', '42')
+    eq_(post_object['og_image'], '42-1280.jpg')
+    assert '42-640.jpg' in post_object['content']
+
+@patch('server.S3')
+@patch('server.DEDUP_VERIFY', 'head')
+@patch('server.rendition_cache')
+def test_find_renditions_head(rendition_cache, S3):
+
+    rendition_cache.get.return_value = ( '42', [ 320, 640 ], [ 'JPEG', 'WEBP' ] )
+    eq_(find_renditions('c0ffee'), ( '42', [ 320, 640 ], [ 'JPEG', 'WEBP' ] ))
+    S3.head_object.assert_any_call(Bucket = 'aws.bucket', Key = '42-640.jpg')
+    S3.head_object.assert_any_call(Bucket = 'aws.bucket', Key = '42-640.webp')
+
+    S3.head_object.side_effect = ClientError(
+        { 'Error': { 'Code': '404' } },
+        'HeadObject',
+    )
+    eq_(find_renditions('c0ffee'), None)
+    rendition_cache.remove.assert_called_once_with('c0ffee')
+
+@patch('server.RENDITION_FORMATS', [ 'JPEG', 'WEBP' ])
+@patch('server.rendition_cache')
+def test_find_renditions_missing_format(rendition_cache):
+
+    # Images that were uploaded before WebP was configured are made again.
+    rendition_cache.get.return_value = ( '42', [ 320, 640 ], [ 'JPEG' ] )
+    eq_(find_renditions('c0ffee'), None)
+
+def test_find_renditions_profile():
+
+    # Images that were resized to other widths are made again.
+    cache = RenditionCache(os.path.join(make_temp_dir(), 'renditions.db'))
+    with patch('server.rendition_cache', cache), \
+         patch('server.RENDITION_FORMATS', [ 'JPEG' ]):
+        with patch('server.RENDITION_WIDTHS', [ 320, 640 ]):
+            cache.put('c0ffee', '42', [ 320, 640 ], [ 'JPEG' ], rendition_profile())
+            eq_(find_renditions('c0ffee'), ( '42', [ 320, 640 ], [ 'JPEG' ] ))
+
+        with patch('server.RENDITION_WIDTHS', [ 320, 640, 1280 ]):
+            eq_(find_renditions('c0ffee'), None)
+
+def test_hash_file():
+
+    f = BytesIO(b'abc')
+    eq_(
+        hash_file(f),
+        'ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad',
+    )
+    eq_(f.tell(), 0)
+
 def test_create_post():
 
     today = datetime.datetime.today()
@@ -340,9 +887,38 @@ def test_create_post():
                 '',
             ])
         ),
+        (
+            {
+                'oid': 512,
+                'date': '2010-06-02',
+                'summary': '',
+                'content': [
+                    '<img src="512-960.jpg" />',
+                    '<img src="512-1-960.jpg" />',
+                ],
+            },
+            '\n'.join([
+                '---',
+                'layout: post',
+                "summary: 'Post #512'",
+                '---',
+                '',
+                '<p>',
+                '  <time>',
+                '    <a href="/512">June 2, 2010</a>',
+                '  </time>',
+                '  <a href="/512">',
+                '    <img src="512-960.jpg" />',
+                '    <img src="512-1-960.jpg" />',
+                '  </a>',
+                '</p>',
+                '',
+            ])
+        ),
     ]
 
-    def make_assertion(post_object, expected):
+    @patch('server.post_index')
+    def make_assertion(post_object, expected, post_index):
         with patch('server.open', mock_open(), create = True) as m:
             oid = post_object['oid']
             post_path = 'blog/_posts/%s-%d.md' % ( today_str, oid )
@@ -351,6 +927,130 @@ def test_create_post():
             m.assert_called_once_with(post_path, 'w')
             handle = m()
             handle.write.assert_called_once_with(expected)
+            post_index.add.assert_called_once_with(
+                oid,
+                os.path.basename(post_path),
+                date = post_object['date'],
+                summary = html.unescape(post_object['summary']),
+                og_image = post_object.get('og_image'),
+            )
 
     for post_object, expected in SPECS:
         yield make_assertion, post_object, expected
+
+@patch.multiple(
+    'server',
+    publisher = DEFAULT,
+    post_index = DEFAULT,
+    download_attachments = DEFAULT,
+    process_image = DEFAULT,
+    create_post = DEFAULT,
+)
+def test_process_upload(**mocks):
+
+    attachments = json.dumps([
+        { 'url': 'http://a', 'name': 'a.jpg', 'content-type': 'image/jpeg' },
+        { 'url': 'http://b', 'name': 'b.jpg', 'content-type': 'image/jpeg' },
+    ])
+
+    mocks['publisher'].sync.return_value = False
+    mocks['post_index'].allocate.return_value = 20
+    mocks['download_attachments'].return_value = [
+        Download('/tmp/0-a.jpg', 'image/jpeg', 'a', None),
+        Download('/tmp/1-b.jpg', 'image/jpeg', 'b', None),
+    ]
+    def process_image(post_object, img_path, name, digest, img, scratch):
+        post_object['content'] = '<img src="%s" />' % (name or post_object['oid'])
+    mocks['process_image'].side_effect = process_image
+
+    # One post per photo, committed together.
+    with patch('server.MULTI_PHOTO', 'posts'):
+        process_upload({ 'subject': 'A & B', 'attachments': attachments })
+
+    mocks['post_index'].allocate.assert_called_once_with(2)
+
+    # The job's files were kept in its own scratch directory, which is gone.
+    scratch = mocks['download_attachments'].call_args[0][1]
+    assert scratch.startswith(os.path.join(server.TEMP_PATH, 'job-'))
+    assert not os.path.exists(scratch)
+    eq_(mocks['process_image'].call_args[0][5], scratch)
+    eq_(mocks['create_post'].call_args_list, [
+        call({ 'oid': 20, 'summary': 'A &amp; B', 'content': '<img src="20" />' }),
+        call({ 'oid': 21, 'summary': 'A &amp; B', 'content': '<img src="21" />' }),
+    ])
+    mocks['publisher'].add.assert_called_once_with(20, 21)
+
+    # A single gallery post.
+    mocks['create_post'].reset_mock()
+    mocks['publisher'].reset_mock()
+    with patch('server.MULTI_PHOTO', 'gallery'):
+        process_upload({ 'subject': '', 'attachments': attachments })
+
+    mocks['create_post'].assert_called_once_with({
+        'oid': 20,
+        'summary': '',
+        'content': [ '<img src="20" />', '<img src="20-1" />' ],
+    })
+    mocks['publisher'].add.assert_called_once_with(20)
+
+@patch.multiple(
+    'server',
+    jobs = DEFAULT,
+    publisher = DEFAULT,
+    post_index = DEFAULT,
+    download_attachments = DEFAULT,
+    process_image = DEFAULT,
+    create_post = DEFAULT,
+)
+def test_process_upload_resume(**mocks):
+
+    attachments = json.dumps([
+        { 'url': 'http://a', 'name': 'a.jpg', 'content-type': 'image/jpeg' },
+        { 'url': 'http://b', 'name': 'b.jpg', 'content-type': 'image/jpeg' },
+    ])
+    payload = { 'message_id': '<abc@foo.bar>', 'subject': '', 'attachments': attachments }
+
+    # The first image was uploaded by an earlier attempt.
+    first = { 'oid': 20, 'summary': '', 'content': '<img src="20" />' }
+    mocks['jobs'].stages.return_value = { 'allocated': 20, 'uploaded-0': first }
+    mocks['publisher'].sync.return_value = False
+    mocks['download_attachments'].return_value = [
+        Download('/tmp/1-b.jpg', 'image/jpeg', 'b', None),
+    ]
+    def process_image(post_object, img_path, name, digest, img, scratch):
+        post_object['content'] = '<img src="%s" />' % (name or post_object['oid'])
+    mocks['process_image'].side_effect = process_image
+
+    with patch('server.MULTI_PHOTO', 'posts'):
+        process_upload(payload)
+
+    # Only the second image is downloaded, and the OIDs are reused.
+    mocks['jobs'].stages.assert_called_once_with('<abc@foo.bar>')
+    eq_(mocks['download_attachments'].call_args[0][2], [ 1 ])
+    assert not mocks['post_index'].allocate.called
+    eq_(mocks['create_post'].call_args_list, [
+        call(first),
+        call({ 'oid': 21, 'summary': '', 'content': '<img src="21" />' }),
+    ])
+    eq_(mocks['jobs'].checkpoint.call_args_list, [
+        call('<abc@foo.bar>', 'uploaded-1', { 'oid': 21, 'summary': '', 'content': '<img src="21" />' }, ()),
+        call('<abc@foo.bar>', 'written', [ 20, 21 ], [ 20, 21 ]),
+    ])
+    mocks['publisher'].add.assert_called_once_with(20, 21)
+
+    # Once the posts are written, they're only published.
+    mocks['jobs'].stages.return_value = { 'allocated': 20, 'written': [ 20, 21 ] }
+    mocks['download_attachments'].reset_mock()
+    mocks['create_post'].reset_mock()
+    mocks['publisher'].reset_mock()
+    process_upload(payload)
+
+    assert not mocks['download_attachments'].called
+    assert not mocks['create_post'].called
+    mocks['publisher'].add.assert_called_once_with(20, 21)
+
+    # Committed posts are left to the pusher.
+    mocks['jobs'].stages.return_value['committed'] = None
+    mocks['publisher'].reset_mock()
+    process_upload(payload)
+    assert not mocks['publisher'].add.called
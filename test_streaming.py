@@ -0,0 +1,46 @@
+import threading
+import time
+
+from nose.tools import eq_
+
+from streaming import StreamBuffer
+
+def test_read():
+    stream = StreamBuffer()
+    stream.write(b'abcdef')
+    eq_(stream.read(2), b'ab')
+    eq_(stream.tell(), 2)
+    eq_(stream.read(2), b'cd')
+
+    stream.close_write()
+    eq_(stream.read(10), b'ef')
+    eq_(stream.read(10), b'')
+
+def test_seek():
+    stream = StreamBuffer()
+    stream.write(b'abcdef')
+    stream.close_write()
+
+    stream.seek(4)
+    eq_(stream.read(), b'ef')
+    stream.seek(-3, 1)
+    eq_(stream.read(1), b'd')
+    eq_(stream.seek(-1, 2), 5)
+    eq_(stream.read(), b'f')
+
+def test_blocking_read():
+    stream = StreamBuffer()
+    stream.write(b'ab')
+
+    def write():
+        time.sleep(0.05)
+        stream.write(b'cd')
+        time.sleep(0.05)
+        stream.write(b'ef')
+        stream.close_write()
+
+    threading.Thread(target = write).start()
+
+    # Reads wait for the data to arrive.
+    eq_(stream.read(4), b'abcd')
+    eq_(stream.read(), b'ef')